@@ -0,0 +1,104 @@
+# --- 짧은 LLM 호출 마이크로 배칭 ---
+# 같은 종류의 짧은 JSON 요청(키워드, 힌트, 그림 형용사 등)을 짧은 시간 창(기본 30ms) 또는 N개 단위로 모아
+# 하나의 여러-항목 프롬프트로 보내고, 결과를 요청별로 나눠 돌려줍니다. 분당 요청 수(RPM) 제한을 덜 받게 됩니다.
+# 배치 응답을 해석하지 못하거나 특정 항목이 잘못되면 그 항목만 개별 호출로 다시 처리합니다.
+# LLM_BATCHING=1 일 때만 켜집니다.
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+LLM_BATCHING = os.getenv("LLM_BATCHING", "0") == "1"
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "30"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "8"))
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class MicroBatcher:
+    def __init__(self, name: str,
+                 run_batch: Callable[[List[Any]], Awaitable[List[Optional[Dict]]]],
+                 run_single: Callable[[Any], Awaitable[Dict]],
+                 is_valid: Callable[[Dict], bool] = lambda result: bool(result),
+                 enabled: bool = LLM_BATCHING, window_ms: float = BATCH_WINDOW_MS, max_items: int = BATCH_MAX_ITEMS):
+        self.name = name
+        self.run_batch = run_batch
+        self.run_single = run_single
+        self.is_valid = is_valid
+        self.enabled = enabled
+        self.window = window_ms / 1000
+        self.max_items = max_items
+        self._pending: Dict[str, Tuple[Any, asyncio.Future]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+        self.items = 0
+        self.batches = 0
+        self.fallbacks = 0
+
+    async def submit(self, item: Any) -> Dict:
+        if not self.enabled:
+            return await self.run_single(item)
+        self.items += 1
+        key = json.dumps(item, ensure_ascii=False, sort_keys=True, default=str)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = (item, asyncio.get_running_loop().create_future())
+            self._pending[key] = pending
+            if len(self._pending) >= self.max_items:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await asyncio.shield(pending[1])
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = list(self._pending.values())
+        self._pending = {}
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        results: List[Optional[Dict]] = [None] * len(batch)
+        if len(batch) > 1:
+            self.batches += 1
+            try:
+                results = list(await self.run_batch([item for item, _ in batch]))
+                results += [None] * (len(batch) - len(results))
+            except Exception:
+                logger.exception("Batch %s failed, falling back to single calls", self.name)
+        batched = len(batch) > 1
+        await asyncio.gather(*(self._settle(item, future, result, batched) for (item, future), result in zip(batch, results)))
+
+    async def _settle(self, item: Any, future: asyncio.Future, result: Optional[Dict], batched: bool):
+        try:
+            if result is None or not self.is_valid(result):
+                if batched:
+                    self.fallbacks += 1
+                result = await self.run_single(item)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "items": self.items, "batches": self.batches, "fallbacks": self.fallbacks}
+
+
+def split_batch_results(content: str, count: int) -> List[Optional[Dict]]:
+    """{"results": [{"id": 0, ...}, ...]} 응답을 id 순서대로 나눕니다. 빠진 id는 None 입니다."""
+    data = json.loads(content)
+    results: List[Optional[Dict]] = [None] * count
+    for entry in data.get("results", []):
+        if not isinstance(entry, dict):
+            continue
+        index = entry.pop("id", None)
+        if isinstance(index, int) and 0 <= index < count and results[index] is None:
+            results[index] = entry
+    return results
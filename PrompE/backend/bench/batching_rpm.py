@@ -0,0 +1,89 @@
+# --- 마이크로 배칭 RPM 벤치마크 ---
+# 교실 한 반이 동시에 서로 다른 주인공/문장을 보내는 상황을 흉내 내고,
+# 배칭을 끈 경우와 켠 경우의 OpenAI 호출 수(=RPM 사용량)와 지연 시간을 비교합니다.
+# 실제 OpenAI 대신 지연만 흉내 내는 가짜 호출을 사용하므로 비용이 들지 않습니다.
+#
+# 실행 (backend 디렉터리에서):
+#   python -m bench.batching_rpm --clients 30 --window-ms 30 --max-items 8
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+
+
+UPSTREAM_LATENCY = 0.8
+
+
+def fake_completion(content: dict):
+    message = types.SimpleNamespace(content=json.dumps(content, ensure_ascii=False))
+    return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=None)
+
+
+async def fake_create_chat(timeout, kwargs):
+    await asyncio.sleep(UPSTREAM_LATENCY)
+    user = kwargs["messages"][-1]["content"]
+    words = ["하나", "둘", "셋", "넷", "다섯", "여섯", "일곱", "여덟"]
+    single = {"adjectives": words, "verbs": words, "locations": words}
+    if isinstance(user, str) and user.startswith("["):
+        ids = [item["id"] for item in json.loads(user)]
+        return fake_completion({"results": [{"id": i, **single} for i in ids]})
+    return fake_completion(single)
+
+
+async def run_burst(clients: int, batching: bool, window_ms: float, max_items: int):
+    batcher = main.keyword_batcher
+    batcher.enabled = batching
+    batcher.window = window_ms / 1000
+    batcher.max_items = max_items
+    calls_before = main.llm.upstream_calls
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(index: int):
+            started = time.perf_counter()
+            response = await client.post(
+                "/api/suggest-keywords/",
+                json={"subject": f"주인공{index}"},
+                headers={"X-Cache-Bypass": "1"},
+            )
+            response.raise_for_status()
+            return time.perf_counter() - started
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(one(i) for i in range(clients)))
+        elapsed = time.perf_counter() - started
+    return {
+        "upstream_calls": main.llm.upstream_calls - calls_before,
+        "p50_ms": round(statistics.median(latencies) * 1000),
+        "max_ms": round(max(latencies) * 1000),
+        "wall_ms": round(elapsed * 1000),
+    }
+
+
+async def amain(args):
+    main.llm._create_chat = fake_create_chat
+    off = await run_burst(args.clients, False, args.window_ms, args.max_items)
+    on = await run_burst(args.clients, True, args.window_ms, args.max_items)
+    print(f"clients={args.clients} window={args.window_ms}ms max_items={args.max_items} upstream_latency={UPSTREAM_LATENCY}s")
+    print(f"batching off: {off}")
+    print(f"batching on : {on}")
+    if on["upstream_calls"]:
+        print(f"RPM reduction: {off['upstream_calls'] / on['upstream_calls']:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="마이크로 배칭 RPM 벤치마크")
+    parser.add_argument("--clients", type=int, default=30)
+    parser.add_argument("--window-ms", type=float, default=30)
+    parser.add_argument("--max-items", type=int, default=8)
+    asyncio.run(amain(parser.parse_args()))
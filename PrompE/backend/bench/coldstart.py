@@ -0,0 +1,179 @@
+# --- 콜드 스타트 벤치마크 ---
+# 워커가 새로 뜰 때(배포, 재시작, 오토스케일) 얼마나 빨리 요청을 받을 수 있는지 잽니다.
+#   import_s      새 프로세스에서 `import main` 에 걸린 시간
+#   ttfr_s        uvicorn 프로세스를 띄운 순간부터 GET / 가 처음 성공할 때까지 (time-to-first-request)
+#   first_db_ms   준비된 직후 첫 갤러리 피드 요청 지연 (DB 커넥션, 스키마)
+#   first_llm_ms  준비된 직후 첫 /api/chat/ 요청 지연 (OpenAI 클라이언트 준비 포함, 가짜 OpenAI 서버 사용)
+# 매번 빈 임시 디렉터리에서 실행하므로 첫 실행과 같은 조건(새 DB)입니다.
+#
+# 실행 (backend 디렉터리에서):
+#   python -m bench.coldstart --runs 5
+#   python -m bench.coldstart --compare HEAD~1 --importtime
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from bench.load import BACKEND_DIR, free_port, spawn, wait_ready
+
+
+IMPORT_SNIPPET = "import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)"
+POLL_INTERVAL = 0.005
+
+
+def checkout(ref: str) -> str:
+    """ref 시점의 backend 디렉터리를 임시 디렉터리에 풀어 놓고 경로를 돌려줍니다."""
+    root = subprocess.run(["git", "rev-parse", "--show-toplevel"], cwd=BACKEND_DIR,
+                          capture_output=True, text=True, check=True).stdout.strip()
+    prefix = os.path.relpath(BACKEND_DIR, root)
+    target = tempfile.mkdtemp(prefix="prompe-coldstart-src-")
+    archive = subprocess.run(["git", "archive", f"{ref}:{prefix}"], cwd=root, capture_output=True, check=True)
+    subprocess.run(["tar", "-x", "-C", target], input=archive.stdout, check=True)
+    return target
+
+
+def measure_import(app_dir: str, workdir: str, env: Dict[str, str]) -> float:
+    output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=workdir, env={**env, "PYTHONPATH": app_dir},
+                            capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def heaviest_imports(app_dir: str, workdir: str, env: Dict[str, str], top: int) -> List[Tuple[str, float]]:
+    """-X importtime 출력에서 main 이 직접 불러오는 패키지를 누적 시간순으로 돌려줍니다."""
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=workdir,
+                            env={**env, "PYTHONPATH": app_dir}, capture_output=True, text=True, check=True).stderr
+    totals: Dict[str, float] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # 한 단계 들여쓴 줄이 main 이 직접 불러온 모듈입니다 (그 아래 import 는 누적 시간에 포함됩니다).
+        if name.startswith("   ") and not name.startswith("    "):
+            package = name.strip().split(".")[0]
+            totals[package] = totals.get(package, 0.0) + int(cumulative) / 1_000_000
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)[:top]
+
+
+async def measure_start(app_dir: str, workdir: str, env: Dict[str, str], verbose: bool) -> Dict[str, float]:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    app = spawn([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", app_dir,
+                 "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                workdir, {**env, "PYTHONPATH": app_dir}, quiet=not verbose)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=30) as client:
+            while True:
+                if app.poll() is not None:
+                    raise RuntimeError(f"앱 프로세스가 종료되었습니다 (exit {app.returncode}).")
+                try:
+                    if (await client.get("/")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(POLL_INTERVAL)
+            ttfr = time.perf_counter() - started
+            request_started = time.perf_counter()
+            response = await client.get("/api/posts/feed/", params={"limit": 30})
+            response.raise_for_status()
+            first_db = time.perf_counter() - request_started
+            request_started = time.perf_counter()
+            response = await client.post("/api/chat/", json={"messages": [{"role": "user", "content": "안녕"}]})
+            response.raise_for_status()
+            first_llm = time.perf_counter() - request_started
+    finally:
+        app.terminate()
+        try:
+            app.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            app.kill()
+    return {"ttfr_s": ttfr, "first_db_ms": first_db * 1000, "first_llm_ms": first_llm * 1000}
+
+
+async def run_target(label: str, app_dir: str, base_env: Dict[str, str], args) -> Dict:
+    samples: Dict[str, List[float]] = {"import_s": [], "ttfr_s": [], "first_db_ms": [], "first_llm_ms": []}
+    heaviest: Optional[List[Tuple[str, float]]] = None
+    for _ in range(args.runs):
+        workdir = tempfile.mkdtemp(prefix="prompe-coldstart-")
+        env = {**base_env, "CONTENT_POOL_DIR": os.path.join(workdir, "content_pool")}
+        try:
+            samples["import_s"].append(measure_import(app_dir, workdir, env))
+            for key, value in (await measure_start(app_dir, workdir, env, args.verbose)).items():
+                samples[key].append(value)
+            if args.importtime and heaviest is None:
+                heaviest = heaviest_imports(app_dir, workdir, env, args.importtime_top)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    result = {"target": label, "runs": args.runs}
+    for key, values in samples.items():
+        digits = 3 if key.endswith("_s") else 1
+        result[key] = round(statistics.median(values), digits)
+        result[f"{key}_max"] = round(max(values), digits)
+    if heaviest is not None:
+        result["heaviest_imports"] = [{"module": name, "cumulative_s": round(seconds, 3)} for name, seconds in heaviest]
+    return result
+
+
+def print_table(results: List[Dict]):
+    columns = ["target", "runs", "import_s", "ttfr_s", "ttfr_s_max", "first_db_ms", "first_llm_ms", "first_llm_ms_max"]
+    print("  ".join(f"{column:>16}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>16}" for column in columns))
+    for result in results:
+        if "heaviest_imports" in result:
+            print(f"\n{result['target']} - import main 에서 오래 걸린 패키지:")
+            for entry in result["heaviest_imports"]:
+                print(f"  {entry['module']:<24} {entry['cumulative_s']:.3f}s")
+
+
+async def amain(args):
+    fake_port = free_port()
+    base_env = {
+        **os.environ,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        # 콘텐츠 풀 보충이 첫 요청과 섞이지 않게 끕니다.
+        "CONTENT_POOL_SIZE": "0",
+    }
+    targets = [("current", BACKEND_DIR)]
+    if args.compare:
+        targets.insert(0, (args.compare, checkout(args.compare)))
+    fake = spawn([sys.executable, "-m", "bench.fake_openai", "--port", str(fake_port), "--latency-ms", "0", "--jitter-ms", "0"],
+                 BACKEND_DIR, {**base_env, "PYTHONPATH": BACKEND_DIR}, quiet=True)
+    try:
+        await wait_ready(f"http://127.0.0.1:{fake_port}/stats", fake)
+        results = [await run_target(label, app_dir, base_env, args) for label, app_dir in targets]
+        async with httpx.AsyncClient() as client:
+            upstream = (await client.get(f"http://127.0.0.1:{fake_port}/stats")).json()
+        if not upstream["chat"]:
+            raise RuntimeError("요청이 가짜 OpenAI 서버에 도달하지 않습니다. .env 의 OPENAI_BASE_URL 을 확인하세요.")
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+        for label, app_dir in targets:
+            if app_dir != BACKEND_DIR:
+                shutil.rmtree(app_dir, ignore_errors=True)
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="콜드 스타트 벤치마크")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--compare", help="함께 잴 git ref (예: HEAD~1). 그 시점의 backend 를 임시 디렉터리에 풀어 실행합니다.")
+    parser.add_argument("--importtime", action="store_true", help="-X importtime 으로 오래 걸린 패키지를 함께 출력")
+    parser.add_argument("--importtime-top", type=int, default=8)
+    parser.add_argument("--json")
+    parser.add_argument("--verbose", action="store_true")
+    asyncio.run(amain(parser.parse_args()))
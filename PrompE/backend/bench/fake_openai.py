@@ -0,0 +1,301 @@
+# --- 로컬 가짜 OpenAI 서버 ---
+# 비용 없이 백엔드 처리량을 재기 위한 OpenAI 호환 서버입니다.
+# chat.completions(일반/JSON 모드/스트리밍)와 images.generate/edit 를 흉내 내고,
+# 생성된 이미지는 이 서버의 /files/ 에서 내려주므로 httpx 다운로드 경로까지 그대로 지나갑니다.
+# 지연 시간, 지터, 오류 비율(500/429), 어긋난 JSON 비율(--malformed-rate)을 조절할 수 있습니다.
+# 빠른 티어 모델(*-mini, dall-e-2, quality=low)은 지연을 --fast-speedup 배만큼 줄여 라우팅 티어 차이를 흉내 냅니다.
+#
+# 단독 실행 (backend 디렉터리에서):
+#   python -m bench.fake_openai --port 8900 --latency-ms 800
+#   OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=bench uvicorn main:app
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from PIL import Image
+
+
+WORDS = ["반짝이는", "용감한", "작은", "신비로운", "행복한", "푸른", "조용한", "커다란"]
+EMOJIS = ["🐶", "🐱", "🏃", "🌳", "🚀", "🌙", "🍎", "🏫", "🌊", "🎈", "🚲", "⭐"]
+LIST_KEYS = ("adjectives", "verbs", "locations", "styles", "moods")
+IMAGE_PART_CHARS = 765 * 3
+
+
+@dataclass
+class FakeOpenAIConfig:
+    latency_ms: float = 800
+    jitter_ms: float = 200
+    image_latency_ms: float = 6000
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    stream_chunks: int = 20
+    image_side: int = 1024
+    malformed_rate: float = 0.0
+    fast_speedup: float = 3.0
+
+
+def _base_png(side: int) -> bytes:
+    # 실제 DALL-E 결과처럼 잘 압축되지 않는 1~2MB 크기의 PNG를 한 번만 만듭니다.
+    image = Image.merge("RGB", [Image.effect_noise((side, side), 40 + 10 * band) for band in range(3)])
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def _batch_size(user: Any) -> int:
+    if isinstance(user, str) and user.startswith("["):
+        try:
+            return len(json.loads(user))
+        except ValueError:
+            return 0
+    if isinstance(user, list):
+        return sum(1 for part in user if part.get("type") == "text" and re.match(r"Item \d+ \|", part.get("text", "")))
+    return 0
+
+
+def _word_lists(system: str) -> Dict[str, List[str]]:
+    return {key: random.sample(WORDS, 6) for key in LIST_KEYS if f'"{key}"' in system}
+
+
+def _puzzle_level(theme: str, index: int) -> Dict:
+    subject, action, location = f"{theme}친구{index}", f"춤추는{index}", f"{theme}마을{index}"
+    return {
+        "theme": theme,
+        "prompt_kr": f"{location}에서 {action} {subject}",
+        "correctBlocks": [subject, action, location],
+        "slots": ["주어 (Subject)", "행동 (Action)", "장소 (Location)"],
+        "availableBlocks": [
+            {"text": subject, "type": "subject"}, {"text": f"다른친구{index}", "type": "subject"},
+            {"text": action, "type": "action"}, {"text": f"자는{index}", "type": "action"},
+            {"text": location, "type": "location"}, {"text": f"다른마을{index}", "type": "location"},
+        ],
+    }
+
+
+def fake_json(system: str, user: Any) -> Dict:
+    """시스템 프롬프트가 요구하는 키를 보고 그럴듯한 JSON 응답을 만듭니다."""
+    if '"results"' in system:
+        return {"results": [{"id": index, **_word_lists(system)} for index in range(_batch_size(user))]}
+    if '"questions"' in system:
+        return {"questions": [
+            {"emojis": " ".join(random.sample(EMOJIS, 3)), "options": ["강아지가 공원에서 달려요", "고양이가 자요", "새가 노래해요", "물고기가 헤엄쳐요"],
+             "correctIndex": 0, "explanation": "강아지와 달리기, 나무 이모지가 있어요. 그래서 공원에서 달리는 강아지예요."}
+            for _ in range(int((re.search(r"Create (\d+)", user if isinstance(user, str) else "") or [None, 3])[1]))
+        ]}
+    if '"levels"' in system:
+        count = int((re.search(r"Exactly (\d+) levels", system) or [None, 2])[1])
+        themes_match = re.search(r"one per level: ([^.]+)\.", user if isinstance(user, str) else "")
+        themes = themes_match.group(1).split(", ") if themes_match else ["동물", "우주", "도시", "바다", "학교"]
+        return {"levels": [_puzzle_level(themes[index % len(themes)], random.randrange(10**6)) for index in range(count)]}
+    if '"dalle_prompt"' in system:
+        return {"dalle_prompt": "A cute children's book illustration of a friendly dragon", "korean_description": "친근한 용이 있는 그림이에요."}
+    if '"prompt"' in system:
+        return {"prompt": f"A simple, clean, cute children's book illustration of scene {random.randrange(10**6)}"}
+    return _word_lists(system)
+
+
+def malform(data: Dict) -> Dict:
+    """스키마 모양은 지키되 개수나 값이 어긋난 응답을 만듭니다 (백엔드의 로컬 수리/다시 묻기 경로 확인용)."""
+    for question in data.get("questions", []):
+        choice = random.randrange(3)
+        if choice == 0:
+            # 정답을 마지막 보기로 옮기고 1부터 센 번호를 씁니다 (범위를 벗어나 다시 묻게 됩니다).
+            question["options"].append(question["options"].pop(question["correctIndex"]))
+            question["correctIndex"] = len(question["options"])
+        elif choice == 1:
+            question["options"] += ["남는 보기", question["options"][-1]]
+    if data.get("questions"):
+        data["questions"] += [dict(data["questions"][0]), *data["questions"][:1]]
+    for level in data.get("levels", []):
+        choice = random.randrange(3)
+        if choice == 0:
+            level["correctBlocks"] = ["subject", "action", "location"]
+        elif choice == 1:
+            level["correctBlocks"] = []
+        level["availableBlocks"].append({"text": "남는블록", "type": "action"})
+    if data.get("levels") and random.random() < 0.3:
+        data["levels"].pop()
+    for item in [data, *data.get("results", [])]:
+        for key in LIST_KEYS:
+            if key in item:
+                item[key] = random.choice([item[key] + WORDS + ["", item[key][0]], item[key][:2]])
+    return data
+
+
+def is_fast_model(model: Any, quality: Any = None) -> bool:
+    return str(model or "").endswith("-mini") or model == "dall-e-2" or quality == "low"
+
+
+def _prompt_text(messages: List[Dict]) -> str:
+    # 이미지 파트는 base64 길이와 상관없이 OpenAI처럼 장당 고정 토큰으로 셉니다.
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        for part in content if isinstance(content, list) else [{"type": "text", "text": content or ""}]:
+            parts.append(part.get("text", "") if part.get("type") == "text" else "#" * IMAGE_PART_CHARS)
+    return "\n".join(parts)
+
+
+def _usage(prompt: str, completion: str) -> Dict[str, int]:
+    prompt_tokens, completion_tokens = max(1, len(prompt) // 3), max(1, len(completion) // 3)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+def create_fake_openai(config: FakeOpenAIConfig) -> FastAPI:
+    app = FastAPI()
+    app.state.config = config
+    app.state.calls = {"chat": 0, "chat_stream": 0, "image": 0, "file": 0, "errors": 0}
+    app.state.files = {}
+    base_png = _base_png(config.image_side)
+    ids = itertools.count(1)
+
+    async def delay(base_ms: float):
+        await asyncio.sleep(max(0.0, base_ms + random.uniform(-config.jitter_ms, config.jitter_ms)) / 1000)
+
+    def maybe_fail():
+        roll = random.random()
+        if roll < config.rate_limit_rate:
+            app.state.calls["errors"] += 1
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "rate_limit"}}, status_code=429, headers={"retry-after": "1"})
+        if roll < config.rate_limit_rate + config.error_rate:
+            app.state.calls["errors"] += 1
+            return JSONResponse({"error": {"message": "The server had an error", "type": "server_error"}}, status_code=500)
+        return None
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        system = next((m["content"] for m in messages if m.get("role") == "system" and isinstance(m.get("content"), str)), "")
+        user = messages[-1].get("content") if messages else ""
+        response_format = body.get("response_format") or {}
+        json_mode = response_format.get("type") in ("json_object", "json_schema")
+        data = fake_json(system, user) if json_mode else None
+        if response_format.get("type") == "json_schema":
+            # strict 스키마처럼 스키마에 없는 최상위 키는 내보내지 않습니다.
+            properties = response_format["json_schema"]["schema"].get("properties", {})
+            data = {key: value for key, value in data.items() if key in properties}
+        if data is not None and random.random() < config.malformed_rate:
+            data = malform(data)
+        content = json.dumps(data, ensure_ascii=False) if json_mode else "프롬프트는 AI에게 주는 그림 주문서야! 자세히 쓸수록 원하는 그림이 나와."
+        usage = _usage(_prompt_text(messages), content)
+        created, completion_id = int(time.time()), f"chatcmpl-fake{next(ids)}"
+        latency_ms = config.latency_ms / (config.fast_speedup if is_fast_model(body.get("model")) else 1)
+        failure = maybe_fail()
+        if body.get("stream"):
+            app.state.calls["chat_stream"] += 1
+            if failure is not None:
+                await delay(latency_ms / 4)
+                return failure
+
+            async def chunks():
+                # 첫 토큰까지 지연의 1/4, 나머지는 토큰 사이에 나눠서 흘려보냅니다.
+                await delay(latency_ms / 4)
+                step = max(1, -(-len(content) // config.stream_chunks))
+                for piece in (content[i:i + step] for i in range(0, len(content), step)):
+                    chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                             "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                    await asyncio.sleep(latency_ms * 0.75 / config.stream_chunks / 1000)
+                final = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                         "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+                yield f"data: {json.dumps(final)}\n\n"
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    yield f"data: {json.dumps({**final, 'choices': [], 'usage': usage})}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(chunks(), media_type="text/event-stream")
+        app.state.calls["chat"] += 1
+        await delay(latency_ms)
+        if failure is not None:
+            return failure
+        return {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    @app.post("/v1/images/generations")
+    async def images_generations(request: Request):
+        body = await request.json()
+        app.state.calls["image"] += 1
+        await delay(config.image_latency_ms / (config.fast_speedup if is_fast_model(body.get("model"), body.get("quality")) else 1))
+        failure = maybe_fail()
+        if failure is not None:
+            return failure
+        data = []
+        for _ in range(body.get("n", 1)):
+            file_id = next(ids)
+            # 이미지마다 내용이 달라야 다이제스트 중복 제거가 벤치마크를 왜곡하지 않습니다. IEND 뒤 바이트는 무시됩니다.
+            content = base_png + file_id.to_bytes(8, "big")
+            if body.get("response_format") == "b64_json":
+                data.append({"b64_json": base64.b64encode(content).decode("ascii"), "revised_prompt": body.get("prompt")})
+                continue
+            app.state.files[file_id] = content
+            data.append({"url": f"{str(request.base_url).rstrip('/')}/files/{file_id}.png", "revised_prompt": body.get("prompt")})
+        return {"created": int(time.time()), "data": data}
+
+    @app.post("/v1/images/edits")
+    async def images_edits(request: Request):
+        form = await request.form()
+        app.state.calls["image"] += 1
+        await delay(config.image_latency_ms / (config.fast_speedup if is_fast_model(form.get("model"), form.get("quality")) else 1))
+        failure = maybe_fail()
+        if failure is not None:
+            return failure
+        # gpt-image-1 은 URL 대신 b64_json 으로만 돌려줍니다.
+        data = [{"b64_json": base64.b64encode(base_png + next(ids).to_bytes(8, "big")).decode("ascii")}
+                for _ in range(int(form.get("n") or 1))]
+        return {"created": int(time.time()), "data": data}
+
+    @app.get("/files/{file_id}.png")
+    async def read_file(file_id: int):
+        app.state.calls["file"] += 1
+        content = app.state.files.get(file_id)
+        if content is None:
+            raise HTTPException(status_code=404, detail="expired")
+        return Response(content, media_type="image/png")
+
+    @app.get("/stats")
+    async def read_stats():
+        return app.state.calls
+
+    return app
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency-ms", type=float, default=FakeOpenAIConfig.latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=FakeOpenAIConfig.jitter_ms)
+    parser.add_argument("--image-latency-ms", type=float, default=FakeOpenAIConfig.image_latency_ms)
+    parser.add_argument("--error-rate", type=float, default=FakeOpenAIConfig.error_rate, help="500 응답 비율 (0~1)")
+    parser.add_argument("--rate-limit-rate", type=float, default=FakeOpenAIConfig.rate_limit_rate, help="429 응답 비율 (0~1)")
+    parser.add_argument("--malformed-rate", type=float, default=FakeOpenAIConfig.malformed_rate, help="개수/값이 어긋난 JSON 응답 비율 (0~1)")
+    parser.add_argument("--fast-speedup", type=float, default=FakeOpenAIConfig.fast_speedup, help="빠른 티어 모델의 지연을 몇 배 줄일지")
+
+
+def config_from_args(args) -> FakeOpenAIConfig:
+    return FakeOpenAIConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, image_latency_ms=args.image_latency_ms,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, malformed_rate=args.malformed_rate,
+        fast_speedup=args.fast_speedup,
+    )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="로컬 가짜 OpenAI 서버")
+    parser.add_argument("--port", type=int, default=8900)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_fake_openai(config_from_args(args)), host="127.0.0.1", port=args.port, log_level="warning")
@@ -0,0 +1,372 @@
+# --- 교실 혼합 부하 벤치마크 ---
+# 로컬 가짜 OpenAI 서버(bench.fake_openai)와 main:app 을 각각 별도 프로세스로 띄우고,
+# 한 반의 학생들이 채팅/키워드/그림 추천/이미지 생성·저장/갤러리/퀴즈 등을 섞어 쓰는 상황을 흉내 냅니다.
+# 엔드포인트별 p50/p95/p99 지연, 전체 RPS, 앱 프로세스 메모리(RSS)를 출력하므로
+# 이벤트 루프 블로킹이나 캐시 회귀가 숫자로 드러납니다. OpenAI 비용은 들지 않습니다.
+#
+# 실행 (backend 디렉터리에서):
+#   python -m bench.load --students 30 --duration 60
+#   python -m bench.load --students 60 --latency-ms 1200 --error-rate 0.02 --json result.json
+# 앱은 임시 디렉터리에서 실행되므로 prompe.db, uploads/ 는 건드리지 않습니다.
+# ROUTING_RECORD_PATH=/tmp/records.jsonl 을 함께 주면 bench.routing_eval 에서 다시 보낼 호출 기록이 남습니다.
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+from PIL import Image, ImageDraw
+
+from bench.fake_openai import add_config_arguments
+
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SUBJECTS = ["고양이", "공룡", "로봇", "우주비행사", "토끼", "용", "강아지", "펭귄"]
+SENTENCES = ["숲속에서 잠자는 커다란 빨간 용", "바다에서 헤엄치는 작은 펭귄", "우주를 나는 용감한 고양이", "학교에서 춤추는 로봇"]
+SEARCH_TERMS = ["고양이", "용감한", "illustration", "바다"]
+
+# 한 학생이 한 번 행동할 때 고르는 작업과 비중입니다.
+WORKLOAD = {
+    "chat": 8,
+    "chat_stream": 8,
+    "suggest_keywords": 14,
+    "generate_hints": 10,
+    "suggest_adjectives": 8,
+    "suggest_mood_style": 6,
+    "compose_prompt": 4,
+    "generate_and_share": 6,
+    "gallery": 16,
+    "search": 6,
+    "emoji_quiz": 5,
+    "prompt_puzzle": 5,
+    "merch_mockup": 2,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def drawing_data_url(seed: int) -> str:
+    """캔버스에서 보내는 것과 비슷한 투명 배경 PNG data URL."""
+    rng = random.Random(seed)
+    image = Image.new("RGBA", (800, 600), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(700), rng.randrange(500)
+        draw.ellipse((x, y, x + rng.randrange(20, 200), y + rng.randrange(20, 200)),
+                     outline=tuple(rng.randrange(256) for _ in range(3)) + (255,), width=6)
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} 프로세스가 종료되었습니다 (exit {process.returncode}).")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} 이(가) {timeout}초 안에 뜨지 않았습니다.")
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.ttfb: Dict[str, List[float]] = defaultdict(list)
+
+    async def call(self, name: str, client: httpx.AsyncClient, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[name] += 1
+            self.latencies[name].append(time.perf_counter() - started)
+            return None
+        self.latencies[name].append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            self.errors[name] += 1
+            return None
+        return response
+
+    async def stream(self, name: str, client: httpx.AsyncClient, url: str, payload: Dict):
+        started = time.perf_counter()
+        first = None
+        failed = False
+        try:
+            async with client.stream("POST", url, json=payload) as response:
+                failed = response.status_code >= 400
+                async for line in response.aiter_lines():
+                    if first is None and line.startswith("data: {\"delta\""):
+                        first = time.perf_counter() - started
+                    if line.startswith("event: error"):
+                        failed = True
+        except httpx.HTTPError:
+            failed = True
+        self.latencies[name].append(time.perf_counter() - started)
+        if first is not None:
+            self.ttfb[name].append(first)
+        if failed:
+            self.errors[name] += 1
+
+
+class Student:
+    def __init__(self, index: int, client: httpx.AsyncClient, recorder: Recorder):
+        self.index = index
+        self.client = client
+        self.recorder = recorder
+        self.session_id = f"bench-student-{index}"
+        self.drawing = drawing_data_url(index)
+
+    async def chat(self):
+        await self.recorder.call("chat", self.client, "POST", "/api/chat/",
+                                 json={"messages": [{"role": "user", "content": "프롬프트가 뭐야?"}]})
+
+    async def chat_stream(self):
+        await self.recorder.stream("chat_stream", self.client, "/api/chat/stream/",
+                                   {"messages": [{"role": "user", "content": "그림을 잘 그리려면 어떻게 말해야 해?"}]})
+
+    async def suggest_keywords(self):
+        await self.recorder.call("suggest_keywords", self.client, "POST", "/api/suggest-keywords/",
+                                 json={"subject": random.choice(SUBJECTS)})
+
+    async def generate_hints(self):
+        await self.recorder.call("generate_hints", self.client, "POST", "/api/generate-hints/",
+                                 json={"prompt": random.choice(SENTENCES)})
+
+    async def suggest_adjectives(self):
+        await self.recorder.call("suggest_adjectives", self.client, "POST", "/api/suggest-adjectives/",
+                                 json={"object_name": random.choice(SUBJECTS), "image_data": self.drawing})
+
+    async def suggest_mood_style(self):
+        await self.recorder.call("suggest_mood_style", self.client, "POST", "/api/suggest-mood-style/",
+                                 json={"prompt": random.choice(SENTENCES), "image_data": self.drawing})
+
+    async def compose_prompt(self):
+        await self.recorder.call("compose_prompt", self.client, "POST", "/api/compose-prompt/", json={"layers": [
+            {"name": "배경", "type": "text", "data": random.choice(SENTENCES)},
+            {"name": "그림", "type": "image", "data": self.drawing},
+        ]})
+
+    async def generate_and_share(self):
+        # 이미지 생성 → 임시 URL 저장(다운로드 경로) → 갤러리 공유까지 한 흐름으로 잽니다.
+        prompt = random.choice(SENTENCES)
+        generated = await self.recorder.call("generate_image", self.client, "POST", "/api/generate-image/",
+                                             json={"prompt": prompt, "user_image": random.choice(["none", self.drawing])},
+                                             headers={"X-Session-Id": self.session_id})
+        if generated is None:
+            return
+        saved = await self.recorder.call("save_image", self.client, "POST", "/api/save-image/",
+                                         json={"temp_url": generated.json()["image_url"]})
+        if saved is None:
+            return
+        await self.recorder.call("share_post", self.client, "POST", "/api/posts/",
+                                 json={"prompt": prompt, "image_url": saved.json()["saved_url"]})
+
+    async def gallery(self):
+        feed = await self.recorder.call("feed", self.client, "GET", "/api/posts/feed/", params={"limit": 30})
+        if feed is None:
+            return
+        for item in feed.json()["items"][:3]:
+            if item.get("thumb_url"):
+                await self.recorder.call("thumbnail", self.client, "GET", item["thumb_url"])
+
+    async def search(self):
+        await self.recorder.call("search", self.client, "GET", "/api/posts/search/", params={"q": random.choice(SEARCH_TERMS)})
+
+    async def emoji_quiz(self):
+        await self.recorder.call("emoji_quiz", self.client, "POST", "/api/emoji-quiz/", json={},
+                                 headers={"X-Session-Id": self.session_id})
+
+    async def prompt_puzzle(self):
+        puzzle = await self.recorder.call("prompt_puzzle", self.client, "POST", "/api/prompt-puzzle/",
+                                          json={"level_count": 2}, headers={"X-Session-Id": self.session_id})
+        if puzzle is None:
+            return
+        level = puzzle.json()["levels"][0]
+        subject, action, location = level["correctBlocks"]
+        await self.recorder.call("prompt_puzzle_image", self.client, "POST", "/api/prompt-puzzle-image/", json={
+            "prompt_kr": level["prompt_kr"], "subject": subject, "action": action, "location": location,
+        }, headers={"X-Session-Id": self.session_id})
+
+    async def merch_mockup(self):
+        await self.recorder.call("merch_mockup", self.client, "POST", "/api/generate-merch-mockup/",
+                                 json={"design_url": self.drawing, "product": random.choice(["tshirt", "mug"])},
+                                 headers={"X-Session-Id": self.session_id})
+
+    async def run(self, deadline: float, think_ms: float):
+        names, weights = list(WORKLOAD), list(WORKLOAD.values())
+        # 학생들이 동시에 몰려 시작하지 않도록 처음 한 번은 흩어 놓습니다.
+        await asyncio.sleep(random.uniform(0, think_ms / 1000))
+        while time.monotonic() < deadline:
+            await getattr(self, random.choices(names, weights)[0])()
+            await asyncio.sleep(random.uniform(0.5, 1.5) * think_ms / 1000)
+
+
+async def sample_memory(pid: int, samples: List[int], stop: asyncio.Event):
+    while not stop.is_set():
+        value = rss_bytes(pid)
+        if value is not None:
+            samples.append(value)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+def report(args, recorder: Recorder, elapsed: float, memory: List[int], server_stats: Dict) -> Dict:
+    rows = {}
+    for name in sorted(recorder.latencies):
+        values = recorder.latencies[name]
+        rows[name] = {
+            "count": len(values),
+            "errors": recorder.errors.get(name, 0),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+            "max_ms": round(max(values) * 1000, 1),
+        }
+        if recorder.ttfb.get(name):
+            rows[name]["ttfb_p50_ms"] = round(percentile(recorder.ttfb[name], 50) * 1000, 1)
+            rows[name]["ttfb_p95_ms"] = round(percentile(recorder.ttfb[name], 95) * 1000, 1)
+    total = sum(row["count"] for row in rows.values())
+    summary = {
+        "students": args.students,
+        "duration_s": round(elapsed, 1),
+        "requests": total,
+        "errors": sum(row["errors"] for row in rows.values()),
+        "rps": round(total / elapsed, 1) if elapsed else 0,
+        "app_rss_mb": {
+            "start": round(memory[0] / 2**20, 1) if memory else None,
+            "peak": round(max(memory) / 2**20, 1) if memory else None,
+            "end": round(memory[-1] / 2**20, 1) if memory else None,
+        },
+        "endpoints": rows,
+        **server_stats,
+    }
+    print(f"students={args.students} duration={summary['duration_s']}s requests={total} "
+          f"errors={summary['errors']} rps={summary['rps']} upstream_latency={args.latency_ms}ms")
+    print(f"app RSS MB: {summary['app_rss_mb']}")
+    print(f"{'endpoint':<22}{'count':>7}{'err':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, row in rows.items():
+        print(f"{name:<22}{row['count']:>7}{row['errors']:>6}{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}"
+              + (f"   ttfb p50={row['ttfb_p50_ms']} p95={row['ttfb_p95_ms']}" if "ttfb_p50_ms" in row else ""))
+    for key, value in server_stats.items():
+        print(f"{key}: {value}")
+    return summary
+
+
+def spawn(command: List[str], cwd: str, env: Dict[str, str], quiet: bool) -> subprocess.Popen:
+    output = subprocess.DEVNULL if quiet else None
+    return subprocess.Popen(command, cwd=cwd, env=env, stdout=output, stderr=output)
+
+
+async def amain(args):
+    fake_port, app_port = free_port(), free_port()
+    workdir = tempfile.mkdtemp(prefix="prompe-bench-")
+    env = {
+        **os.environ,
+        "PYTHONPATH": BACKEND_DIR,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "CONTENT_POOL_DIR": os.path.join(workdir, "content_pool"),
+        "LLM_BATCHING": "1" if args.batching else os.environ.get("LLM_BATCHING", "0"),
+        # 가짜 서버에는 한도가 없으므로, 따로 지정하지 않으면 앱 자체의 처리량을 재도록 버킷을 넉넉히 둡니다.
+        "OPENAI_RPM": os.environ.get("OPENAI_RPM", "100000"),
+        "OPENAI_TPM": os.environ.get("OPENAI_TPM", "100000000"),
+        "OPENAI_IMAGE_RPM": os.environ.get("OPENAI_IMAGE_RPM", "10000"),
+    }
+    fake = spawn([sys.executable, "-m", "bench.fake_openai", "--port", str(fake_port),
+                  "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+                  "--image-latency-ms", str(args.image_latency_ms), "--error-rate", str(args.error_rate),
+                  "--rate-limit-rate", str(args.rate_limit_rate), "--malformed-rate", str(args.malformed_rate),
+                  "--fast-speedup", str(args.fast_speedup)],
+                 BACKEND_DIR, env, quiet=True)
+    app = spawn([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+                 "--host", "127.0.0.1", "--port", str(app_port), "--log-level", "warning"], workdir, env, quiet=not args.verbose)
+    fake_url, app_url = f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{app_port}"
+    try:
+        await wait_ready(f"{fake_url}/stats", fake)
+        await wait_ready(f"{app_url}/", app)
+        limits = httpx.Limits(max_connections=args.students * 2, max_keepalive_connections=args.students * 2)
+        async with httpx.AsyncClient(base_url=app_url, limits=limits, timeout=httpx.Timeout(300.0)) as client:
+            # .env 의 OPENAI_BASE_URL 이 덮어써서 실제 OpenAI로 나가는 일이 없도록 먼저 확인합니다.
+            await client.post("/api/chat/", json={"messages": [{"role": "user", "content": "ping"}]})
+            upstream = (await client.get(f"{fake_url}/stats")).json()
+            if not upstream["chat"]:
+                raise RuntimeError("요청이 가짜 OpenAI 서버에 도달하지 않습니다. .env 의 OPENAI_BASE_URL 을 확인하세요.")
+
+            recorder = Recorder()
+            students = [Student(index, client, recorder) for index in range(args.students)]
+            memory: List[int] = []
+            stop = asyncio.Event()
+            sampler = asyncio.create_task(sample_memory(app.pid, memory, stop))
+            started = time.monotonic()
+            await asyncio.gather(*(student.run(started + args.duration, args.think_ms) for student in students))
+            elapsed = time.monotonic() - started
+            stop.set()
+            await sampler
+
+            server_stats = {"fake_openai_calls": (await client.get(f"{fake_url}/stats")).json()}
+            for name in ("llm-stats", "cache-stats", "batch-stats", "structured-output-stats", "routing-stats"):
+                response = await client.get(f"/api/{name}/")
+                if response.status_code == 200:
+                    server_stats[name] = response.json()
+        summary = report(args, recorder, elapsed, memory, server_stats)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as output:
+                json.dump(summary, output, ensure_ascii=False, indent=2)
+    finally:
+        for process in (app, fake):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="교실 혼합 부하 벤치마크 (가짜 OpenAI 서버 사용)")
+    parser.add_argument("--students", type=int, default=30)
+    parser.add_argument("--duration", type=float, default=60, help="측정 시간(초)")
+    parser.add_argument("--think-ms", type=float, default=1500, help="학생별 행동 사이 평균 대기 시간")
+    parser.add_argument("--batching", action="store_true", help="LLM_BATCHING=1 로 앱을 띄웁니다")
+    parser.add_argument("--json", help="결과를 JSON 파일로도 저장합니다 (회귀 비교용)")
+    parser.add_argument("--verbose", action="store_true", help="앱 로그를 그대로 출력합니다")
+    add_config_arguments(parser)
+    asyncio.run(amain(parser.parse_args()))
@@ -0,0 +1,215 @@
+# --- 모델 라우팅 티어 오프라인 평가 ---
+# ROUTING_RECORD_PATH 로 남긴 호출 기록(JSONL)을 route 의 티어(fast/quality)마다 다시 보내
+# 지연(p50/p95), 토큰, 출력 유효율을 비교하고, SLO(p95 <= slo_ms)와 유효율 기준을 함께 만족하는 가장 싼 티어를 추천합니다.
+# 출력 유효율은 앱이 그 응답을 다시 묻지 않고 쓸 수 있었는지로 봅니다.
+#   - json_schema: 스키마에 맞고, 엔드포인트의 로컬 수리(structured.StructuredOutput.repair)로 남는 문제가 없을 때
+#   - json_object: 비어 있지 않은 JSON 객체일 때 / 일반 텍스트: 비어 있지 않을 때 / 이미지: 결과 이미지가 있을 때
+# 티어 설정(MODEL_ROUTES)과 한도(OPENAI_RPM/TPM)는 앱과 같은 환경 변수를 읽습니다.
+#
+# 실행 (backend 디렉터리에서):
+#   ROUTING_RECORD_PATH=/tmp/records.jsonl uvicorn main:app          # 실제 사용을 기록하거나
+#   ROUTING_RECORD_PATH=/tmp/records.jsonl python -m bench.load --students 10 --duration 30
+#   OPENAI_API_KEY=... python -m bench.routing_eval /tmp/records.jsonl --repeat 3 --limit 20
+#   python -m bench.routing_eval /tmp/records.jsonl --fake           # 가짜 서버로 도구만 확인 (비용 없음)
+import argparse
+import asyncio
+import copy
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from bench.fake_openai import add_config_arguments
+from bench.load import BACKEND_DIR, free_port, percentile, spawn, wait_ready
+
+
+def load_records(path: str, routes: Optional[List[str]], limit: int) -> List[Dict[str, Any]]:
+    per_route: Dict[str, int] = defaultdict(int)
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if routes and record["route"] not in routes:
+                continue
+            if limit and per_route[record["route"]] >= limit:
+                continue
+            per_route[record["route"]] += 1
+            records.append(record)
+    return records
+
+
+def is_valid_chat(record: Dict[str, Any], content: Optional[str], outputs: Dict[str, Any]) -> bool:
+    from structured import matches_schema
+
+    response_format = record["kwargs"].get("response_format") or {}
+    if response_format.get("type") not in ("json_object", "json_schema"):
+        return bool(content and content.strip())
+    try:
+        data = json.loads(content or "")
+    except ValueError:
+        return False
+    if not isinstance(data, dict) or not data:
+        return False
+    if response_format["type"] == "json_object":
+        return True
+    json_schema = response_format["json_schema"]
+    if not matches_schema(data, json_schema["schema"]):
+        return False
+    output = outputs.get(record["route"])
+    if output is None:
+        return True
+    if json_schema["name"] == output.model.__name__:
+        items = [data]
+    elif json_schema["name"] == f"{output.model.__name__}Batch":
+        items = data["results"]
+    else:
+        # 일부만 다시 묻는 호출(partial re-ask)은 스키마만 봅니다.
+        return True
+    return all(not output.repair(copy.deepcopy(item)) for item in items)
+
+
+async def replay(gateway, record: Dict[str, Any], tier: str, outputs: Dict[str, Any]) -> Dict[str, Any]:
+    from llm import total_tokens
+
+    kwargs = {**record["kwargs"], **gateway.router.options(record["route"], tier)}
+    started = time.perf_counter()
+    try:
+        if record["kind"] == "image":
+            result = await gateway.generate_image(**kwargs)
+            valid = bool(result.data)
+        else:
+            result = await gateway.chat(**kwargs)
+            valid = is_valid_chat(record, result.choices[0].message.content, outputs)
+    except Exception as e:
+        return {"ok": False, "error": type(e).__name__}
+    return {"ok": True, "seconds": time.perf_counter() - started, "tokens": total_tokens(result) or 0, "valid": valid}
+
+
+def summarize(router, results: Dict[tuple, List[Dict[str, Any]]], min_validity: float) -> Dict[str, Any]:
+    from routing import TIERS
+
+    report: Dict[str, Any] = {}
+    for name in sorted({name for name, _ in results}):
+        route = router.routes[name]
+        tiers = {}
+        for tier in TIERS:
+            runs = results.get((name, tier))
+            if not runs:
+                continue
+            latencies = [run["seconds"] for run in runs if run["ok"]]
+            tiers[tier] = {
+                "model": route.tiers[tier].model,
+                "runs": len(runs),
+                "errors": sum(not run["ok"] for run in runs),
+                "valid_rate": round(sum(run.get("valid", False) for run in runs) / len(runs), 3),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+                "p95_ms": round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+                "avg_tokens": round(sum(run.get("tokens", 0) for run in runs) / len(runs), 1),
+            }
+        # TIERS 는 싼 티어부터이므로 기준을 만족하는 첫 티어가 추천입니다.
+        recommended = next((tier for tier, row in tiers.items()
+                            if row["p95_ms"] is not None and row["p95_ms"] <= route.slo_ms and row["valid_rate"] >= min_validity), None)
+        report[name] = {"slo_ms": route.slo_ms, "configured": route.tier, "recommended": recommended, "tiers": tiers}
+    return report
+
+
+async def evaluate(args, base_url: Optional[str], api_key: str) -> Dict[str, Any]:
+    # 앱 모듈은 환경 변수(한도, 데이터 디렉터리)를 정한 뒤에 불러옵니다.
+    os.environ.setdefault("PROMPE_DATA_DIR", tempfile.mkdtemp(prefix="prompe-eval-"))
+    sys.path.insert(0, BACKEND_DIR)
+    from llm import LLMGateway
+    from routing import ModelRouter
+    import main
+
+    outputs = {output.name: output for output in (main.keyword_output, main.hint_output, main.emoji_quiz_output, main.puzzle_output)}
+    router = ModelRouter(record_path="")
+    gateway = LLMGateway(api_key, base_url=base_url, router=router)
+    records = load_records(args.records, args.routes, args.limit)
+    results: Dict[tuple, List[Dict[str, Any]]] = defaultdict(list)
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def run(record: Dict[str, Any]):
+        async with slots:
+            # 같은 호출을 동시에 보내면 게이트웨이가 하나로 합치므로 티어와 반복은 차례로 보냅니다.
+            for tier in router.routes[record["route"]].tiers:
+                for _ in range(args.repeat):
+                    results[(record["route"], tier)].append(await replay(gateway, record, tier, outputs))
+
+    try:
+        await asyncio.gather(*(run(record) for record in records))
+    finally:
+        await gateway.aclose()
+    return {"records": len(records), "routes": summarize(router, results, args.min_validity)}
+
+
+def print_report(summary: Dict[str, Any]):
+    print(f"records={summary['records']}")
+    columns = ["route", "tier", "model", "runs", "errors", "valid_rate", "p50_ms", "p95_ms", "avg_tokens", "slo_ms"]
+    print("  ".join(f"{column:>14}" for column in columns))
+    changes = {}
+    for name, route in summary["routes"].items():
+        for tier, row in route["tiers"].items():
+            values = {"route": name, "tier": tier + ("*" if tier == route["recommended"] else ""), "slo_ms": route["slo_ms"], **row}
+            print("  ".join(f"{str(values[column]):>14}" for column in columns))
+        if route["recommended"] is None:
+            print(f"  {name}: SLO 와 유효율 기준을 만족하는 티어가 없습니다.")
+        elif route["recommended"] != route["configured"]:
+            changes[name] = {"tier": route["recommended"]}
+    print("* = 추천 티어 (SLO 와 유효율 기준을 만족하는 가장 싼 티어)")
+    if changes:
+        print(f"MODEL_ROUTES='{json.dumps(changes)}'")
+
+
+async def amain(args):
+    fake = None
+    base_url = os.getenv("OPENAI_BASE_URL")
+    api_key = os.getenv("OPENAI_API_KEY", "")
+    if args.fake:
+        port = free_port()
+        base_url, api_key = f"http://127.0.0.1:{port}/v1", "bench"
+        # 가짜 서버에는 한도가 없으므로 버킷을 넉넉히 둡니다.
+        os.environ.setdefault("OPENAI_RPM", "100000")
+        os.environ.setdefault("OPENAI_TPM", "100000000")
+        os.environ.setdefault("OPENAI_IMAGE_RPM", "10000")
+        fake = spawn([sys.executable, "-m", "bench.fake_openai", "--port", str(port),
+                      "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+                      "--image-latency-ms", str(args.image_latency_ms), "--error-rate", str(args.error_rate),
+                      "--rate-limit-rate", str(args.rate_limit_rate), "--malformed-rate", str(args.malformed_rate),
+                      "--fast-speedup", str(args.fast_speedup)], BACKEND_DIR, {**os.environ, "PYTHONPATH": BACKEND_DIR}, quiet=True)
+    elif not api_key:
+        raise SystemExit("OPENAI_API_KEY 가 없습니다. 가짜 서버로 확인하려면 --fake 를 주세요.")
+    try:
+        if fake is not None:
+            await wait_ready(f"{base_url.rsplit('/v1', 1)[0]}/stats", fake)
+        summary = await evaluate(args, base_url, api_key)
+    finally:
+        if fake is not None:
+            fake.terminate()
+            try:
+                fake.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                fake.kill()
+    print_report(summary)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(summary, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="기록한 호출을 티어마다 다시 보내 지연/토큰/유효율을 비교합니다")
+    parser.add_argument("records", help="ROUTING_RECORD_PATH 로 남긴 JSONL 파일")
+    parser.add_argument("--routes", type=lambda value: value.split(","), help="평가할 route (쉼표로 구분)")
+    parser.add_argument("--limit", type=int, default=20, help="route 마다 다시 보낼 기록 수 (0 은 전부)")
+    parser.add_argument("--repeat", type=int, default=1, help="기록마다 티어별로 보낼 횟수")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--min-validity", type=float, default=0.95, help="추천할 티어의 최소 출력 유효율")
+    parser.add_argument("--fake", action="store_true", help="가짜 OpenAI 서버를 띄워 평가합니다")
+    parser.add_argument("--json")
+    add_config_arguments(parser)
+    asyncio.run(amain(parser.parse_args()))
@@ -0,0 +1,153 @@
+# --- 동시 공유(게시) 벤치마크 ---
+# 한 반이 작품을 거의 동시에 공유하는 상황을 흉내 냅니다. 앱을 임시 디렉터리에서 띄우고,
+# 미리 uploads/ 에 넣어 둔 이미지로 POST /api/posts/ 를 동시에 보내면서 갤러리 피드도 함께 읽습니다.
+# 이미지는 이미 저장되어 있으므로 측정되는 것은 DB 쓰기 경로뿐입니다 (OpenAI 호출 없음).
+#
+# 프로필:
+#   baseline  예전 설정과 같은 rollback journal + synchronous=FULL + 요청마다 커밋
+#   wal       WAL + synchronous=NORMAL + 요청마다 커밋 (현재 기본값)
+#   group     WAL + synchronous=NORMAL + group commit (DB_GROUP_COMMIT=1)
+#
+# 실행 (backend 디렉터리에서):
+#   python -m bench.shares --clients 40 --shares 20
+#   python -m bench.shares --profiles wal group --json shares.json
+import argparse
+import asyncio
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+from PIL import Image
+
+from bench.load import BACKEND_DIR, free_port, percentile, spawn, wait_ready
+from storage import ImageIngestor
+
+
+PROFILES = {
+    "baseline": {"SQLITE_JOURNAL_MODE": "DELETE", "SQLITE_SYNCHRONOUS": "FULL", "DB_GROUP_COMMIT": "0"},
+    "wal": {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL", "DB_GROUP_COMMIT": "0"},
+    "group": {"SQLITE_JOURNAL_MODE": "WAL", "SQLITE_SYNCHRONOUS": "NORMAL", "DB_GROUP_COMMIT": "1"},
+}
+
+
+async def seed_images(upload_dir: str, count: int) -> List[str]:
+    ingestor = ImageIngestor(upload_dir)
+    urls = []
+    for index in range(count):
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), (index % 256, index * 7 % 256, index * 13 % 256)).save(buffer, "PNG")
+        urls.append(f"/uploads/{(await ingestor.store_bytes(buffer.getvalue())).filename}")
+    await ingestor.aclose()
+    return urls
+
+
+async def run_profile(name: str, args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix=f"prompe-shares-{name}-")
+    port = free_port()
+    env = {
+        **os.environ, **PROFILES[name],
+        "PYTHONPATH": BACKEND_DIR,
+        "OPENAI_API_KEY": "bench",
+        # 공유만 재므로 콘텐츠 풀이 OpenAI를 부르지 않게 합니다.
+        "CONTENT_POOL_SIZE": "0",
+        "CONTENT_POOL_DIR": os.path.join(workdir, "content_pool"),
+    }
+    images = await seed_images(os.path.join(workdir, "uploads"), args.images)
+    app = spawn([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+                 "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"], workdir, env, quiet=not args.verbose)
+    base_url = f"http://127.0.0.1:{port}"
+    share_latencies: List[float] = []
+    feed_latencies: List[float] = []
+    errors = 0
+    try:
+        await wait_ready(base_url + "/", app)
+        limits = httpx.Limits(max_connections=args.clients + args.readers + 4)
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+            done = asyncio.Event()
+
+            async def sharer(index: int):
+                nonlocal errors
+                for count in range(args.shares):
+                    started = time.perf_counter()
+                    try:
+                        response = await client.post("/api/posts/", json={
+                            "prompt": f"학생 {index}의 {count}번째 그림: 숲속에서 잠자는 커다란 빨간 용",
+                            "image_url": images[(index + count) % len(images)],
+                        })
+                    except httpx.HTTPError:
+                        errors += 1
+                        continue
+                    share_latencies.append(time.perf_counter() - started)
+                    errors += response.status_code != 200
+
+            async def reader():
+                while not done.is_set():
+                    started = time.perf_counter()
+                    response = await client.get("/api/posts/feed/", params={"limit": 30})
+                    feed_latencies.append(time.perf_counter() - started)
+                    if response.status_code != 200:
+                        break
+
+            readers = [asyncio.create_task(reader()) for _ in range(args.readers)]
+            started = time.perf_counter()
+            await asyncio.gather(*(sharer(index) for index in range(args.clients)))
+            elapsed = time.perf_counter() - started
+            done.set()
+            await asyncio.gather(*readers)
+            db_stats = (await client.get("/metrics")).text
+    finally:
+        app.terminate()
+        try:
+            app.wait(timeout=10)
+        except Exception:
+            app.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    commits = next((float(line.split()[-1]) for line in db_stats.splitlines() if line.startswith('prompe_db_writes{key="commits"}')), None)
+    shares = len(share_latencies)
+    return {
+        "profile": name,
+        "shares": shares,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "shares_per_s": round(shares / elapsed, 1),
+        "share_p50_ms": round(percentile(share_latencies, 50) * 1000, 1),
+        "share_p95_ms": round(percentile(share_latencies, 95) * 1000, 1),
+        "share_p99_ms": round(percentile(share_latencies, 99) * 1000, 1),
+        "feed_reads": len(feed_latencies),
+        "feed_p95_ms": round(percentile(feed_latencies, 95) * 1000, 1) if feed_latencies else None,
+        "commits": commits,
+    }
+
+
+def print_table(results: List[Dict]):
+    columns = ["profile", "shares", "errors", "shares_per_s", "share_p50_ms", "share_p95_ms", "share_p99_ms",
+               "feed_reads", "feed_p95_ms", "commits"]
+    print("  ".join(f"{column:>13}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>13}" for column in columns))
+
+
+async def amain(args):
+    results = [await run_profile(name, args) for name in args.profiles]
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="동시 공유 벤치마크")
+    parser.add_argument("--clients", type=int, default=40, help="동시에 공유하는 학생 수")
+    parser.add_argument("--shares", type=int, default=20, help="학생 한 명이 공유하는 횟수")
+    parser.add_argument("--readers", type=int, default=4, help="공유하는 동안 피드를 계속 읽는 클라이언트 수")
+    parser.add_argument("--images", type=int, default=16)
+    parser.add_argument("--profiles", nargs="+", choices=list(PROFILES), default=list(PROFILES))
+    parser.add_argument("--json")
+    parser.add_argument("--verbose", action="store_true")
+    asyncio.run(amain(parser.parse_args()))
@@ -0,0 +1,162 @@
+# --- 워커 수 확장 벤치마크 ---
+# 같은 부하를 uvicorn 워커 1/2/4개로 차례로 돌려 처리량(RPS)이 워커 수에 따라 늘어나는지 봅니다.
+# 요청은 CPU를 쓰는 것 위주로 고릅니다: 매번 다른 그림의 data URL(base64 디코딩 + 이미지 정규화 + 큰 JSON),
+# 그림 바이너리 업로드(해시, 저장), 서버 세션 채팅(공유 상태 읽기/쓰기), 갤러리 피드(DB).
+# 워커가 여럿이면 WEB_CONCURRENCY 로 띄우므로 공유 상태(SQLite 파일)와 한 번만 하는 마이그레이션도 함께 거칩니다.
+# OpenAI 는 가짜 서버(bench.fake_openai)를 쓰고 지연은 0 으로 둡니다. 코어 수보다 많은 워커는 의미가 없으니
+# 결과를 볼 때 함께 출력되는 cpu_count 를 확인하세요 (가짜 서버와 부하 생성기도 같은 CPU를 씁니다).
+#
+# 실행 (backend 디렉터리에서):
+#   python -m bench.workers --workers 1,2,4 --concurrency 32 --duration 20
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+from bench.load import BACKEND_DIR, drawing_data_url, free_port, percentile, spawn, wait_ready
+
+
+WORKLOAD = {"vision": 4, "drawing_upload": 2, "chat": 2, "feed": 2}
+DRAWING_VARIANTS = 96
+
+
+class Client:
+    def __init__(self, client: httpx.AsyncClient, drawings: List[str], rng: random.Random):
+        self.client = client
+        self.drawings = drawings
+        self.rng = rng
+        self.conversation_id = None
+
+    async def vision(self):
+        # 그림마다 내용이 달라 워커의 정규화 메모가 맞지 않으므로 매번 디코딩/리사이즈합니다.
+        return await self.client.post("/api/suggest-adjectives/", json={
+            "object_name": "고양이", "image_data": self.rng.choice(self.drawings), "detail": "low",
+        })
+
+    async def drawing_upload(self):
+        data = base64.b64decode(self.rng.choice(self.drawings).split(",", 1)[1])
+        return await self.client.post("/api/drawings/", files={"file": ("drawing.png", data, "image/png")})
+
+    async def chat(self):
+        response = await self.client.post("/api/chat/", json={"message": "그림 주문서가 뭐야?", "conversation_id": self.conversation_id})
+        if response.status_code == 200:
+            # 다음 턴은 다른 워커로 갈 수 있으므로 대화가 공유 상태로 이어지는지도 함께 확인됩니다.
+            self.conversation_id = response.json()["conversation_id"]
+        return response
+
+    async def feed(self):
+        return await self.client.get("/api/posts/feed/", params={"limit": 30})
+
+    async def run(self, deadline: float, latencies: Dict[str, List[float]], errors: Dict[str, int]):
+        kinds, weights = list(WORKLOAD), list(WORKLOAD.values())
+        while time.monotonic() < deadline:
+            kind = self.rng.choices(kinds, weights)[0]
+            started = time.perf_counter()
+            try:
+                response = await getattr(self, kind)()
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies[kind].append(time.perf_counter() - started)
+            else:
+                errors[kind] += 1
+
+
+async def measure(workers: int, drawings: List[str], base_env: Dict[str, str], args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="prompe-workers-")
+    port = free_port()
+    env = {**base_env, "PROMPE_DATA_DIR": workdir, "WEB_CONCURRENCY": str(workers)}
+    app = spawn([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR, "--workers", str(workers),
+                 "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                workdir, env, quiet=not args.verbose)
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    try:
+        await wait_ready(f"http://127.0.0.1:{port}/", app, timeout=60)
+        limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            # 모든 워커가 준비되고 OpenAI 클라이언트를 만들 때까지 잠깐 데웁니다.
+            warm_deadline = time.monotonic() + args.warmup
+            await asyncio.gather(*(Client(client, drawings, random.Random(index)).run(warm_deadline, defaultdict(list), defaultdict(int))
+                                   for index in range(args.concurrency)))
+            started = time.monotonic()
+            await asyncio.gather(*(Client(client, drawings, random.Random(1000 + index)).run(started + args.duration, latencies, errors)
+                                   for index in range(args.concurrency)))
+            elapsed = time.monotonic() - started
+    finally:
+        app.terminate()
+        try:
+            app.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            app.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+    everything = [value for values in latencies.values() for value in values]
+    result = {
+        "workers": workers,
+        "requests": len(everything),
+        "errors": sum(errors.values()),
+        "rps": round(len(everything) / elapsed, 1),
+        "p50_ms": round(percentile(everything, 50) * 1000, 1) if everything else None,
+        "p95_ms": round(percentile(everything, 95) * 1000, 1) if everything else None,
+    }
+    for kind, values in sorted(latencies.items()):
+        result[f"{kind}_p50_ms"] = round(percentile(values, 50) * 1000, 1)
+    return result
+
+
+async def amain(args):
+    fake_port = free_port()
+    base_env = {
+        **os.environ,
+        "PYTHONPATH": BACKEND_DIR,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "CONTENT_POOL_SIZE": "0",
+        # 앱의 처리량을 재도록 한도 버킷은 넉넉히 둡니다 (공유 버킷을 거치는 비용은 그대로 포함됩니다).
+        "OPENAI_RPM": os.environ.get("OPENAI_RPM", "1000000"),
+        "OPENAI_TPM": os.environ.get("OPENAI_TPM", "1000000000"),
+    }
+    drawings = [drawing_data_url(seed) for seed in range(DRAWING_VARIANTS)]
+    fake = spawn([sys.executable, "-m", "bench.fake_openai", "--port", str(fake_port), "--latency-ms", "0", "--jitter-ms", "0"],
+                 BACKEND_DIR, base_env, quiet=True)
+    try:
+        await wait_ready(f"http://127.0.0.1:{fake_port}/stats", fake)
+        results = [await measure(workers, drawings, base_env, args) for workers in args.workers]
+    finally:
+        fake.terminate()
+        fake.wait(timeout=10)
+    baseline = results[0]["rps"] or 1.0
+    print(f"cpu_count={os.cpu_count()}  concurrency={args.concurrency}  duration={args.duration}s")
+    columns = ["workers", "requests", "errors", "rps", "speedup", "p50_ms", "p95_ms"]
+    print("  ".join(f"{column:>10}" for column in columns))
+    for result in results:
+        result["speedup"] = round(result["rps"] / baseline, 2)
+        print("  ".join(f"{str(result[column]):>10}" for column in columns))
+    if args.workers and max(args.workers) > (os.cpu_count() or 1):
+        print(f"주의: 워커 수가 CPU 수({os.cpu_count()})보다 많으면 처리량이 늘지 않습니다.")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="워커 수에 따른 처리량 벤치마크 (가짜 OpenAI 서버 사용)")
+    parser.add_argument("--workers", type=lambda value: [int(n) for n in value.split(",")], default=[1, 2, 4])
+    parser.add_argument("--concurrency", type=int, default=32, help="동시에 요청을 보내는 클라이언트 수")
+    parser.add_argument("--duration", type=float, default=20, help="워커 수마다 잴 시간(초)")
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--json")
+    parser.add_argument("--verbose", action="store_true")
+    asyncio.run(amain(parser.parse_args()))
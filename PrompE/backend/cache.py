@@ -0,0 +1,144 @@
+# --- 결정적 응답 캐시 ---
+# 키워드/힌트처럼 같은 입력에 같은 답을 주면 되는 엔드포인트의 LLM 결과를 저장합니다.
+# 1단계: 프로세스 내부 LRU (TTL + 바이트 크기 제한)
+# 2단계: 워커 간 공유 상태 (shared_state.py, 워커가 여럿일 때) - 한 워커가 만든 답을 다른 워커도 씁니다
+# 3단계: 선택적 SQLite 디스크 캐시 (RESPONSE_CACHE_DB 설정 시, 재시작 후에도 유지)
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from paths import resolve_data_path
+from shared_state import SharedState
+
+
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(6 * 60 * 60)))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+RESPONSE_CACHE_DB = resolve_data_path(os.getenv("RESPONSE_CACHE_DB")) if os.getenv("RESPONSE_CACHE_DB") else ""
+
+
+def normalize_text(text: str) -> str:
+    # 유니코드 정규화 + 공백 정리 + 소문자화로 "고양이 " 와 "고양이" 를 같은 키로 봅니다.
+    text = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def make_cache_key(endpoint: str, model: str, system_prompt: str, user_input: Any) -> str:
+    if isinstance(user_input, str):
+        user_input = normalize_text(user_input)
+    payload = json.dumps(
+        {"endpoint": endpoint, "model": model, "system": system_prompt, "input": user_input},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _DiskTier:
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[1] < time.time():
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return row
+
+    def set(self, key: str, value: str, expires_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, expires_at),
+            )
+            self._conn.commit()
+
+
+class ResponseCache:
+    def __init__(self, ttl: float = RESPONSE_CACHE_TTL, max_bytes: int = RESPONSE_CACHE_MAX_BYTES, db_path: str = RESPONSE_CACHE_DB,
+                 state: Optional[SharedState] = None):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+        self._disk = _DiskTier(db_path) if db_path else None
+        self._shared = state if state is not None and state.shared else None
+        self.hits = 0
+        self.shared_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remember(self, key: str, value: str, expires_at: float):
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key)[0])
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, expires_at)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[Dict]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] >= time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[0])
+            self._bytes -= len(self._entries.pop(key)[0])
+        if self._shared is not None:
+            value = await self._shared.get(f"cache:{key}")
+            if value is not None:
+                # 만료 시각은 공유 상태가 관리하므로, 이 워커는 TTL 동안만 L1 에 둡니다.
+                self._remember(key, value, time.time() + self.ttl)
+                self.shared_hits += 1
+                return json.loads(value)
+        if self._disk is not None:
+            row = await asyncio.to_thread(self._disk.get, key)
+            if row is not None:
+                self._remember(key, row[0], row[1])
+                self.disk_hits += 1
+                return json.loads(row[0])
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Dict):
+        encoded = json.dumps(value, ensure_ascii=False)
+        expires_at = time.time() + self.ttl
+        self._remember(key, encoded, expires_at)
+        if self._shared is not None:
+            await self._shared.set(f"cache:{key}", encoded, self.ttl)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.set, key, encoded, expires_at)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
@@ -0,0 +1,202 @@
+# --- 서버 쪽 대화 세션 ---
+# /api/chat/ 의 대화 기록을 대화 id 별로 서버가 들고 있어서, 브라우저는 매 턴 새 메시지 하나만 보냅니다.
+# 기록이 토큰 예산(CHAT_HISTORY_TOKEN_BUDGET)을 넘으면 최근 몇 개를 뺀 오래된 턴을 요약 한 개로 접어
+# 대화가 길어져도 요청 크기가 일정하게 유지됩니다. 요약은 답을 돌려준 뒤 백그라운드에서 만듭니다.
+# 보내는 메시지는 항상 [고정 시스템 프롬프트, (요약), 지난 턴..., 새 메시지] 순서이고 턴은 뒤에만 붙으므로,
+# 다음 압축 전까지는 앞부분이 매번 같아 OpenAI 프롬프트 캐싱이 적용됩니다.
+# 워커가 여럿이면 대화는 공유 상태에 "chat:<id>" 로 저장하고, 턴마다 다시 읽어 다음 턴이 다른 워커로 가도 이어집니다.
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from llm import estimate_message_tokens
+from shared_state import SharedState
+
+
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", str(2 * 60 * 60)))
+CHAT_MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "5000"))
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "1500"))
+# 압축할 때 요약하지 않고 그대로 남기는 최근 메시지 수 (사용자/AI 메시지 각각 하나로 셉니다)
+CHAT_KEEP_RECENT_MESSAGES = int(os.getenv("CHAT_KEEP_RECENT_MESSAGES", "6"))
+CHAT_ROLES = ("user", "assistant")
+
+logger = logging.getLogger("uvicorn.error")
+
+# summarize(이전 요약, 접을 메시지들) -> 새 요약
+Summarizer = Callable[[Optional[str], List[Dict[str, str]]], Awaitable[str]]
+
+
+class ConversationNotFoundError(Exception):
+    pass
+
+
+class ChatSession:
+    def __init__(self, conversation_id: str, messages: Optional[List[Dict[str, str]]] = None):
+        self.id = conversation_id
+        self.summary: Optional[str] = None
+        self.messages: List[Dict[str, str]] = list(messages or [])
+        # 한 대화의 턴과 압축은 한 번에 하나씩만 진행합니다.
+        self.lock = asyncio.Lock()
+        self.touched = time.monotonic()
+
+    def prompt(self, system_prompt: str, message: str) -> List[Dict[str, str]]:
+        prefix = [{"role": "system", "content": system_prompt}]
+        if self.summary:
+            prefix.append({"role": "system", "content": f"지금까지의 대화 요약: {self.summary}"})
+        return [*prefix, *self.messages, {"role": "user", "content": message}]
+
+    def history_tokens(self) -> int:
+        summary = [{"role": "system", "content": self.summary}] if self.summary else []
+        return estimate_message_tokens([*summary, *self.messages])
+
+
+class ChatSessionStore:
+    def __init__(self, summarize: Summarizer, ttl: float = CHAT_SESSION_TTL, max_sessions: int = CHAT_MAX_SESSIONS,
+                 token_budget: int = CHAT_HISTORY_TOKEN_BUDGET, keep_recent: int = CHAT_KEEP_RECENT_MESSAGES,
+                 state: Optional[SharedState] = None):
+        self.summarize = summarize
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._compacting: Dict[str, asyncio.Task] = {}
+        self._state = state if state is not None and state.shared else None
+        self.turns = 0
+        self.compactions = 0
+        self.compaction_failures = 0
+        self.trimmed_messages = 0
+        self.expired = 0
+
+    @staticmethod
+    def clean_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        # 브라우저가 보낸 기록에서는 사용자/AI 메시지만 받습니다 (system 메시지를 끼워 넣지 못하게).
+        return [
+            {"role": message["role"], "content": message["content"]}
+            for message in messages
+            if message.get("role") in CHAT_ROLES and isinstance(message.get("content"), str)
+        ]
+
+    async def get(self, conversation_id: str) -> ChatSession:
+        session = self._sessions.get(conversation_id)
+        if session is not None and time.monotonic() - session.touched > self.ttl:
+            self._sessions.pop(conversation_id)
+            self.expired += 1
+            session = None
+        if self._state is not None:
+            # 지난 턴을 다른 워커가 처리했을 수 있으므로 공유 상태의 기록이 기준입니다.
+            session = session or ChatSession(conversation_id)
+            if not await self._load(session):
+                self._sessions.pop(conversation_id, None)
+                session = None
+        if session is None:
+            raise ConversationNotFoundError(conversation_id)
+        self._remember(session)
+        return session
+
+    async def create(self, conversation_id: Optional[str] = None,
+                     messages: Optional[List[Dict[str, Any]]] = None) -> ChatSession:
+        """새 대화를 시작합니다. 서버가 잃어버린 대화를 브라우저가 가진 기록으로 다시 채울 때도 씁니다."""
+        session = ChatSession(conversation_id or uuid.uuid4().hex, self.clean_messages(messages or []))
+        self._remember(session)
+        await self._save(session)
+        self._schedule_compaction(session)
+        return session
+
+    async def record_turn(self, session: ChatSession, message: str, reply: str):
+        """답을 받은 턴을 기록에 붙이고, 예산을 넘었으면 백그라운드에서 압축합니다. session.lock 안에서 부릅니다."""
+        session.messages.append({"role": "user", "content": message})
+        session.messages.append({"role": "assistant", "content": reply})
+        session.touched = time.monotonic()
+        self.turns += 1
+        await self._save(session)
+        self._schedule_compaction(session)
+
+    def _remember(self, session: ChatSession):
+        self._sessions[session.id] = session
+        self._sessions.move_to_end(session.id)
+        session.touched = time.monotonic()
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    # --- 공유 상태 저장/복원 ---
+    async def _load(self, session: ChatSession) -> bool:
+        stored = await self._state.get(f"chat:{session.id}")
+        if stored is None:
+            return False
+        data = json.loads(stored)
+        session.summary = data["summary"]
+        session.messages = data["messages"]
+        return True
+
+    async def _save(self, session: ChatSession):
+        if self._state is not None:
+            data = json.dumps({"summary": session.summary, "messages": session.messages}, ensure_ascii=False)
+            await self._state.set(f"chat:{session.id}", data, self.ttl)
+
+    def _schedule_compaction(self, session: ChatSession):
+        if session.history_tokens() <= self.token_budget or len(session.messages) <= self.keep_recent:
+            return
+        task = self._compacting.get(session.id)
+        if task is None or task.done():
+            self._compacting[session.id] = asyncio.create_task(self._compact(session))
+
+    async def _compact(self, session: ChatSession):
+        try:
+            async with session.lock:
+                if session.history_tokens() <= self.token_budget:
+                    return
+                cut = len(session.messages) - self.keep_recent
+                # AI 답으로 끝나는 지점에서 자르면 남는 기록이 항상 사용자 메시지로 시작합니다.
+                if cut > 0 and session.messages[cut - 1]["role"] != "assistant":
+                    cut -= 1
+                if cut <= 0:
+                    return
+                compacted = session.messages[:cut]
+                try:
+                    summary = await self.summarize(session.summary, compacted)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.compaction_failures += 1
+                    logger.exception("Chat history compaction failed for %s", session.id)
+                    self._trim(session)
+                    await self._save(session)
+                    return
+                if self._state is not None:
+                    # 요약하는 동안 다른 워커가 턴을 붙였을 수 있으니 다시 읽고, 요약한 앞부분이 그대로일 때만 바꿉니다.
+                    if not await self._load(session) or session.messages[:cut] != compacted:
+                        return
+                session.summary = summary
+                session.messages = session.messages[cut:]
+                await self._save(session)
+                self.compactions += 1
+        finally:
+            self._compacting.pop(session.id, None)
+
+    def _trim(self, session: ChatSession):
+        # 요약을 만들 수 없을 때도 요청이 끝없이 커지지 않도록 예산의 두 배를 넘는 만큼 오래된 턴을 버립니다.
+        while session.history_tokens() > self.token_budget * 2 and len(session.messages) > self.keep_recent:
+            del session.messages[:2]
+            self.trimmed_messages += 2
+
+    async def aclose(self):
+        for task in list(self._compacting.values()):
+            task.cancel()
+        await asyncio.gather(*self._compacting.values(), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "turns": self.turns,
+            "compacting": len(self._compacting),
+            "compactions": self.compactions,
+            "compaction_failures": self.compaction_failures,
+            "trimmed_messages": self.trimmed_messages,
+            "expired": self.expired,
+        }
@@ -0,0 +1,143 @@
+# --- 그림 업로드 핸들 ---
+# Stage3 는 같은 캔버스 그림을 여러 단계(형용사 추천, 무드/스타일 추천, 이미지 생성, 프롬프트 조합)에 다시 보냅니다.
+# 그림을 POST /api/drawings/ 로 바이너리 그대로 한 번만 올리고, 이후 요청에는 "drawing:<sha256>" 핸들만 보냅니다.
+# 파일은 내용 해시 이름으로 DRAWING_DIR 에 한 번만 저장되고, 마지막으로 쓰인 뒤 DRAWING_TTL 이 지나면 지워집니다.
+# 디스크에 두므로 같은 디렉터리를 보는 다른 워커도 같은 핸들을 읽을 수 있습니다.
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+import time
+from typing import Any, Dict, NamedTuple
+
+from paths import data_path
+from vision import InvalidImageError
+
+
+DRAWING_DIR = data_path("DRAWING_DIR", "drawings")
+DRAWING_TTL = float(os.getenv("DRAWING_TTL", str(2 * 60 * 60)))
+DRAWING_MAX_BYTES = int(os.getenv("DRAWING_MAX_BYTES", str(10 * 1024 * 1024)))
+DRAWING_SWEEP_INTERVAL = 300.0
+HANDLE_PREFIX = "drawing:"
+HANDLE_PATTERN = re.compile(r"drawing:([0-9a-f]{64})")
+
+# 파일 앞부분으로 형식만 확인합니다. 실제 디코딩은 쓰는 쪽(비전 정규화, 이미지 편집 API)에서 합니다.
+IMAGE_SIGNATURES = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a")
+
+
+class DrawingNotFoundError(Exception):
+    pass
+
+
+class Drawing(NamedTuple):
+    digest: str
+    data: bytes
+
+
+def is_image_bytes(data: bytes) -> bool:
+    return data.startswith(IMAGE_SIGNATURES) or (data[:4] == b"RIFF" and data[8:12] == b"WEBP")
+
+
+class DrawingStore:
+    def __init__(self, directory: str = DRAWING_DIR, ttl: float = DRAWING_TTL, max_bytes: int = DRAWING_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._last_sweep = 0.0
+        self.uploads = 0
+        self.duplicate_uploads = 0
+        self.reads = 0
+        self.missing = 0
+        self.swept = 0
+
+    @staticmethod
+    def is_handle(value: str) -> bool:
+        return value.startswith(HANDLE_PREFIX)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    async def put(self, data: bytes) -> str:
+        """그림 바이트를 저장하고 핸들을 돌려줍니다. 같은 그림을 다시 올리면 만료 시각만 늦춥니다."""
+        if len(data) > self.max_bytes:
+            raise InvalidImageError(f"그림이 너무 큽니다 ({len(data)} bytes, 최대 {self.max_bytes} bytes).")
+        if not is_image_bytes(data):
+            raise InvalidImageError("PNG/JPEG/GIF/WebP 이미지가 아닙니다.")
+
+        def write() -> bool:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(digest)
+            if os.path.exists(path):
+                os.utime(path)
+                return False
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as buffer:
+                    buffer.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            return True
+
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest())
+        if await asyncio.to_thread(write):
+            self.uploads += 1
+        else:
+            self.duplicate_uploads += 1
+        if time.time() - self._last_sweep > DRAWING_SWEEP_INTERVAL:
+            self._last_sweep = time.time()
+            self.swept += await asyncio.to_thread(self._sweep)
+        return HANDLE_PREFIX + digest
+
+    async def get(self, handle: str) -> Drawing:
+        match = HANDLE_PATTERN.fullmatch(handle)
+        if match is None:
+            raise DrawingNotFoundError(f"올바른 그림 핸들이 아닙니다: {handle[:80]}")
+        digest = match.group(1)
+
+        def read() -> bytes:
+            path = self._path(digest)
+            # 읽을 때마다 만료 시각을 늦춰, 단계를 오가는 동안에는 지워지지 않게 합니다.
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+            return data
+
+        try:
+            data = await asyncio.to_thread(read)
+        except FileNotFoundError:
+            self.missing += 1
+            raise DrawingNotFoundError(f"그림이 없거나 만료되었습니다: {handle}") from None
+        self.reads += 1
+        return Drawing(digest, data)
+
+    def _sweep(self) -> int:
+        removed = 0
+        expires_before = time.time() - self.ttl
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < expires_before:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "uploads": self.uploads,
+            "duplicate_uploads": self.duplicate_uploads,
+            "reads": self.reads,
+            "missing": self.missing,
+            "swept": self.swept,
+        }
@@ -0,0 +1,349 @@
+# --- 이미지 생성 작업 큐 ---
+# 이미지 생성은 한 번에 10~30초가 걸리고 OpenAI 용량 대부분을 차지합니다.
+# 한 아이가 "생성" 버튼을 연달아 눌러도 반 전체가 밀리지 않도록, 작업을 반(classroom) → 세션 순서로
+# 돌아가며(round robin) 하나씩 꺼내 실행하고, 동시에 실행하는 작업 수는 전체적으로 제한합니다.
+# 세션별 개수 제한은 클라이언트가 보낸 세션 id 에만 겁니다. 세션 id 가 없는 작업은 각자 따로 줄을 서고 반 안에서 돌아가며 실행됩니다.
+# 작업은 id로 상태를 조회하거나 취소할 수 있고, 기다리던 클라이언트가 끊기면 취소됩니다.
+# 워커가 여럿이면 작업은 받은 워커에서 실행되고, 상태는 공유 상태에 "job:<큐>:<id>" 로 올려 두어
+# 다른 워커로 간 조회도 답할 수 있습니다. 다른 워커의 작업 취소는 표시만 남기고, 실행 중인 워커가 확인해 취소합니다.
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, Optional
+
+from shared_state import SharedState
+
+
+IMAGE_JOB_CONCURRENCY = int(os.getenv("IMAGE_JOB_CONCURRENCY", "4"))
+IMAGE_JOB_MAX_PER_SESSION = int(os.getenv("IMAGE_JOB_MAX_PER_SESSION", "3"))
+IMAGE_JOB_RESULT_TTL = float(os.getenv("IMAGE_JOB_RESULT_TTL", "600"))
+# 결과를 조회하러 오지 않는 비동기 작업은 이 시간이 지나면 실행하지 않고 버립니다.
+IMAGE_JOB_ABANDON_SECONDS = float(os.getenv("IMAGE_JOB_ABANDON_SECONDS", "120"))
+DEFAULT_CLASSROOM = "default"
+# 다른 워커가 남긴 취소 표시를 확인하는 간격
+JOB_CANCEL_POLL_INTERVAL = 1.0
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+class Job:
+    QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+    FINISHED = (DONE, FAILED, CANCELLED)
+
+    def __init__(self, kind: str, run: Callable[[], Awaitable[Any]], session: str, classroom: str, detached: bool):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.run = run
+        self.session = session
+        self.classroom = classroom
+        self.detached = detached
+        self.status = self.QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.last_seen = self.created_at
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        # 아무도 결과를 받아 가지 않은 실패 작업이 "never retrieved" 경고를 남기지 않게 합니다.
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.changed = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in self.FINISHED
+
+    def _finish(self, status: str, result: Any = None, exception: Optional[BaseException] = None):
+        self.status = status
+        self.result = result
+        self.error = str(exception) if exception is not None else None
+        self.finished_at = time.monotonic()
+        if status == self.DONE:
+            self.future.set_result(result)
+        elif status == self.CANCELLED:
+            self.future.cancel()
+        else:
+            # 원래 예외를 그대로 넘겨야 엔드포인트가 400/503 등을 구분할 수 있습니다.
+            self.future.set_exception(exception)
+        self._notify()
+
+    def _notify(self):
+        # 상태가 바뀔 때마다 새 Event 로 갈아 끼워, 여러 구독자가 매 변화를 한 번씩 받을 수 있게 합니다.
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+
+class FairJobQueue:
+    def __init__(self, name: str, concurrency: int = IMAGE_JOB_CONCURRENCY, max_per_session: int = IMAGE_JOB_MAX_PER_SESSION,
+                 result_ttl: float = IMAGE_JOB_RESULT_TTL, abandon_after: float = IMAGE_JOB_ABANDON_SECONDS,
+                 state: Optional[SharedState] = None, encode_result: Callable[[Any], Any] = lambda result: result):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_per_session = max_per_session
+        self.result_ttl = result_ttl
+        self.abandon_after = abandon_after
+        # classroom -> session -> 대기 중인 작업. OrderedDict 의 순서가 곧 다음 차례입니다.
+        self._queues: "OrderedDict[str, OrderedDict[str, Deque[Job]]]" = OrderedDict()
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._active: Dict[str, int] = {}
+        # 공유 상태에 올릴 작업 상태. 같은 작업은 마지막 상태만 남기고 한 태스크가 순서대로 씁니다.
+        self._state = state if state is not None and state.shared else None
+        self.encode_result = encode_result
+        self._outbox: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._publisher: Optional[asyncio.Task] = None
+        self._cancel_watcher: Optional[asyncio.Task] = None
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    # --- 제출/조회/취소 ---
+    def submit(self, kind: str, run: Callable[[], Awaitable[Any]], session: Optional[str],
+               classroom: Optional[str] = None, detached: bool = False) -> Job:
+        classroom = classroom or DEFAULT_CLASSROOM
+        self._expire()
+        if session and self._active.get(session, 0) >= self.max_per_session:
+            self.rejected += 1
+            raise JobQueueFullError(f"이미 진행 중인 이미지 작업이 {self.max_per_session}개 있습니다.")
+        job = Job(kind, run, session or "", classroom, detached)
+        if not session:
+            # 세션을 알 수 없으면 작업 하나를 한 세션으로 봅니다 (NAT 뒤의 한 반 전체가 한 세션으로 묶이지 않게).
+            job.session = session = f"anonymous:{job.id}"
+        self._jobs[job.id] = job
+        self._active[session] = self._active.get(session, 0) + 1
+        self._queues.setdefault(classroom, OrderedDict()).setdefault(session, deque()).append(job)
+        self._dispatch()
+        self._publish(job)
+        if self._state is not None and (self._cancel_watcher is None or self._cancel_watcher.done()):
+            self._cancel_watcher = asyncio.create_task(self._watch_cancellations())
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._expire()
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.last_seen = time.monotonic()
+        return job
+
+    def cancel(self, job: Job):
+        if job.finished:
+            return
+        if job.status == Job.QUEUED:
+            self._unqueue(job)
+            self._settle(job, Job.CANCELLED)
+            self._dispatch()
+        elif job._task is not None:
+            # 실행 중인 작업은 태스크를 취소하고, 정리는 _execute 의 finally 가 맡습니다.
+            job._task.cancel()
+
+    async def lookup(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """다른 워커가 받은 작업의 마지막 상태 (describe 와 같은 모양). 워커가 하나면 항상 None 입니다."""
+        if self._state is None:
+            return None
+        snapshot = await self._state.get(f"job:{self.name}:{job_id}")
+        return json.loads(snapshot) if snapshot else None
+
+    async def request_cancel(self, job_id: str):
+        """다른 워커에서 실행 중인 작업의 취소를 요청합니다."""
+        if self._state is not None:
+            await self._state.set(f"job-cancel:{self.name}:{job_id}", "1", self.result_ttl)
+
+    async def wait(self, job: Job, is_disconnected: Callable[[], Awaitable[bool]], poll_interval: float = 1.0) -> Any:
+        """작업이 끝날 때까지 기다립니다. 그 사이 클라이언트가 끊기면 작업을 취소합니다."""
+        try:
+            while not job.future.done():
+                await asyncio.wait({job.future}, timeout=poll_interval)
+                if not job.future.done() and await is_disconnected():
+                    self.cancel(job)
+                    # 실행 중이던 작업은 태스크가 정리된 뒤에 상태가 확정됩니다.
+                    await asyncio.wait({job.future})
+        except asyncio.CancelledError:
+            self.cancel(job)
+            raise
+        if job.future.cancelled():
+            raise JobCancelledError("이미지 작업이 취소되었습니다.")
+        return job.future.result()
+
+    def position(self, job: Job) -> Optional[int]:
+        """지금 순서대로 꺼낸다면 이 작업 앞에 몇 개가 있는지 (대기 중일 때만)."""
+        if job.status != Job.QUEUED:
+            return None
+        for index, queued in enumerate(self._dispatch_order()):
+            if queued is job:
+                return index
+        return None
+
+    def describe(self, job: Job, result: Any = None) -> Dict[str, Any]:
+        return {
+            "job_id": job.id,
+            "kind": job.kind,
+            "status": job.status,
+            "position": self.position(job),
+            "result": result if job.status == Job.DONE else None,
+            "error": job.error,
+        }
+
+    # --- 공정 순서 ---
+    def _dispatch_order(self) -> Iterator[Job]:
+        # 실제로 꺼내는 순서(반 → 세션 round robin)를 상태를 바꾸지 않고 흉내 냅니다.
+        classrooms = [(classroom, [list(queue) for queue in sessions.values()]) for classroom, sessions in self._queues.items()]
+        while classrooms:
+            next_round = []
+            for classroom, sessions in classrooms:
+                yield sessions[0].pop(0)
+                sessions = [queue for queue in sessions[1:] + sessions[:1] if queue]
+                if sessions:
+                    next_round.append((classroom, sessions))
+            classrooms = next_round
+
+    def _pop_next(self) -> Optional[Job]:
+        while self._queues:
+            classroom, sessions = next(iter(self._queues.items()))
+            session, queue = next(iter(sessions.items()))
+            job = queue.popleft()
+            # 꺼낸 세션과 반은 줄의 맨 뒤로 보내 다음 차례를 다른 아이/반에게 넘깁니다.
+            if queue:
+                sessions.move_to_end(session)
+            else:
+                del sessions[session]
+            if sessions:
+                self._queues.move_to_end(classroom)
+            else:
+                del self._queues[classroom]
+            if job.detached and time.monotonic() - job.last_seen > self.abandon_after:
+                self._settle(job, Job.CANCELLED)
+                continue
+            return job
+        return None
+
+    def _unqueue(self, job: Job):
+        sessions = self._queues.get(job.classroom)
+        queue = sessions.get(job.session) if sessions else None
+        if queue is None or job not in queue:
+            return
+        queue.remove(job)
+        if not queue:
+            del sessions[job.session]
+            if not sessions:
+                del self._queues[job.classroom]
+
+    def _dispatch(self):
+        started = False
+        while self.running < self.concurrency:
+            job = self._pop_next()
+            if job is None:
+                break
+            self.running += 1
+            job.status = Job.RUNNING
+            job._notify()
+            self._publish(job)
+            job._task = asyncio.create_task(self._execute(job))
+            started = True
+        if started and self._state is not None:
+            # 대기 순번이 바뀌었으니 다른 워커에서 조회해도 맞는 순번이 보이게 다시 올립니다.
+            for queued in list(self._dispatch_order()):
+                self._publish(queued)
+
+    async def _execute(self, job: Job):
+        try:
+            result = await job.run()
+        except asyncio.CancelledError:
+            self._settle(job, Job.CANCELLED)
+        except Exception as e:
+            logger.warning("Image job %s (%s) failed: %s", job.id, job.kind, e)
+            self._settle(job, Job.FAILED, exception=e)
+        else:
+            self._settle(job, Job.DONE, result=result)
+        finally:
+            self.running -= 1
+            self._dispatch()
+
+    def _settle(self, job: Job, status: str, result: Any = None, exception: Optional[BaseException] = None):
+        if job.finished:
+            return
+        self._active[job.session] -= 1
+        if not self._active[job.session]:
+            del self._active[job.session]
+        if status == Job.DONE:
+            self.completed += 1
+        elif status == Job.CANCELLED:
+            self.cancelled += 1
+        else:
+            self.failed += 1
+        job._finish(status, result, exception)
+        self._publish(job)
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if not job.finished or now - job.finished_at < self.result_ttl:
+                break
+            self._jobs.popitem(last=False)
+
+    # --- 워커 간 상태 공유 ---
+    def _publish(self, job: Job):
+        if self._state is None:
+            return
+        self._outbox[job.id] = self.describe(job, self.encode_result(job.result) if job.status == Job.DONE else None)
+        self._outbox.move_to_end(job.id)
+        if self._publisher is None or self._publisher.done():
+            self._publisher = asyncio.create_task(self._drain_outbox())
+
+    async def _drain_outbox(self):
+        while self._outbox:
+            job_id, snapshot = self._outbox.popitem(last=False)
+            try:
+                await self._state.set(f"job:{self.name}:{job_id}", json.dumps(snapshot, ensure_ascii=False), self.result_ttl)
+            except Exception:
+                logger.exception("Failed to publish image job %s", job_id)
+
+    async def _watch_cancellations(self):
+        while True:
+            pending = [job for job in self._jobs.values() if not job.finished]
+            if not pending:
+                return
+            for job in pending:
+                try:
+                    requested = await self._state.get(f"job-cancel:{self.name}:{job.id}")
+                except Exception:
+                    logger.exception("Failed to check cancellation of image job %s", job.id)
+                    requested = None
+                if requested:
+                    self.cancel(job)
+            await asyncio.sleep(JOB_CANCEL_POLL_INTERVAL)
+
+    async def aclose(self):
+        """종료할 때 실행 중인 작업을 취소하고 아직 올리지 못한 상태를 마저 씁니다. 공유 상태를 닫기 전에 부릅니다."""
+        running = [job._task for job in self._jobs.values() if job._task is not None and not job._task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        if self._cancel_watcher is not None:
+            self._cancel_watcher.cancel()
+        if self._publisher is not None:
+            await asyncio.gather(self._publisher, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": sum(len(queue) for sessions in self._queues.values() for queue in sessions.values()),
+            "running": self.running,
+            "classrooms": len(self._queues),
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,276 @@
+# --- OpenAI 비동기 게이트웨이 ---
+# 모든 엔드포인트가 공유하는 AsyncOpenAI 클라이언트입니다.
+# 하나의 커넥션 풀을 재사용하고, 호출별 타임아웃과 동시 호출 수 제한을 둡니다.
+# 동시에 들어온 똑같은 호출(모델, 메시지, response_format 등이 모두 같은 경우)은 한 번만 보내고 결과를 나눠 씁니다.
+# 속도 제한, 재시도, 서킷 브레이커는 resilience.UpstreamGuard 가 맡습니다.
+# route 이름을 넘기면 routing.ModelRouter 가 고른 티어의 모델/max_tokens/size/quality 를 채우고 지연과 토큰을 기록합니다.
+# openai 패키지는 불러오는 데만 0.5초가량 걸리므로 클라이언트는 처음 쓸 때(또는 warm_up 에서) 만듭니다.
+import asyncio
+import hashlib
+import importlib
+import json
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+import metrics
+from resilience import OPENAI_IMAGE_RPM, OPENAI_RPM, OPENAI_TPM, UpstreamGuard
+from routing import ModelRouter
+from shared_state import SharedState
+
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+IMAGE_MAX_CONCURRENCY = int(os.getenv("IMAGE_MAX_CONCURRENCY", "8"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", "120"))
+DEFAULT_COMPLETION_TOKENS = 512
+# gpt-4o 이미지 입력 한 장의 최대 토큰 수 (high detail 기준)
+IMAGE_INPUT_TOKENS = 765
+
+
+def estimate_message_tokens(messages: List[Dict[str, Any]]) -> int:
+    """메시지들의 대략적인 입력 토큰 수 (한글 기준 2글자에 1토큰, 이미지는 장당 IMAGE_INPUT_TOKENS)."""
+    text_chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            text_chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    text_chars += len(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    images += 1
+    return text_chars // 2 + images * IMAGE_INPUT_TOKENS
+
+
+def estimate_tokens(kwargs: Dict[str, Any]) -> int:
+    """TPM 버킷에서 미리 뺄 토큰 수. 응답을 받으면 usage 로 맞춥니다."""
+    return estimate_message_tokens(kwargs.get("messages", [])) + (kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+def total_tokens(completion) -> Optional[int]:
+    usage = getattr(completion, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+class LLMGateway:
+    def __init__(self, api_key: Optional[str], base_url: Optional[str] = None, state: Optional[SharedState] = None,
+                 router: Optional[ModelRouter] = None):
+        self.api_key = api_key
+        self.base_url = base_url or os.getenv("OPENAI_BASE_URL") or None
+        self._client = None
+        self._chat_slots = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+        self._image_slots = asyncio.Semaphore(IMAGE_MAX_CONCURRENCY)
+        self.chat_guard = UpstreamGuard("chat", OPENAI_RPM, OPENAI_TPM, state)
+        self.image_guard = UpstreamGuard("image", OPENAI_IMAGE_RPM, state=state)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._waiters: Dict[str, int] = {}
+        self.router = router or ModelRouter()
+        self._active = {"chat": 0, "image": 0}
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI(
+                api_key=self.api_key or "missing",
+                base_url=self.base_url,
+                # 채팅과 이미지 호출이 같은 keep-alive 커넥션 풀을 공유합니다.
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONCURRENCY + IMAGE_MAX_CONCURRENCY,
+                        max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                    ),
+                    timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0),
+                ),
+                # 재시도는 UpstreamGuard 가 Retry-After 와 버킷을 보면서 직접 합니다.
+                max_retries=0,
+            )
+        return self._client
+
+    async def warm_up(self):
+        """openai 패키지를 워커 스레드에서 미리 불러와, 첫 요청이 import 를 기다리지 않게 합니다."""
+        await asyncio.to_thread(importlib.import_module, "openai")
+        self.client
+
+    @staticmethod
+    def request_key(kind: str, kwargs: Dict[str, Any]) -> str:
+        canonical = json.dumps({"kind": kind, **kwargs}, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    async def _single_flight(self, kind: str, kwargs: Dict[str, Any], call: Callable[[], Awaitable[Any]]):
+        key = self.request_key(kind, kwargs)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced_calls += 1
+        else:
+            self.upstream_calls += 1
+            inflight = asyncio.ensure_future(call())
+            self._inflight[key] = inflight
+            self._waiters[key] = 0
+            inflight.add_done_callback(lambda f: (self._inflight.pop(key, None), self._waiters.pop(key, None), f.cancelled() or f.exception()))
+        self._waiters[key] += 1
+        try:
+            # 먼저 온 요청이 끊겨도 함께 기다리는 요청들은 결과를 받을 수 있도록 shield 합니다.
+            return await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            # 기다리는 요청이 모두 취소되면 (예: 이미지 작업 취소) 업스트림 호출도 멈춰 용량을 돌려줍니다.
+            if key in self._waiters:
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    inflight.cancel()
+            raise
+
+    def load(self, kind: str) -> float:
+        """동시 호출 슬롯과 한도 버킷 대기열이 얼마나 찼는지 (0~1 이상). 라우터가 강등을 정할 때 봅니다."""
+        slots, guard = (LLM_MAX_CONCURRENCY, self.chat_guard) if kind == "chat" else (IMAGE_MAX_CONCURRENCY, self.image_guard)
+        return (self._active[kind] + guard.requests.waiting) / slots
+
+    async def _routed(self, kind: str, route: Optional[str], kwargs: Dict[str, Any], call: Callable[[Dict[str, Any]], Awaitable[Any]],
+                      record: bool = True):
+        if route is None:
+            return await call(kwargs)
+        if record and self.router.recorder is not None:
+            await asyncio.to_thread(self.router.recorder.record, route, kind, kwargs)
+        tier = self.router.select(route, self.load(kind))
+        started = time.perf_counter()
+        try:
+            result = await call({**kwargs, **self.router.options(route, tier)})
+        except Exception:
+            self.router.observe(route, tier, time.perf_counter() - started, ok=False)
+            raise
+        self.router.observe(route, tier, time.perf_counter() - started, tokens=total_tokens(result),
+                            images=len(getattr(result, "data", None) or []))
+        return result
+
+    async def _create_chat(self, timeout: Optional[float], kwargs: Dict[str, Any]):
+        return await self.chat_guard.run(
+            lambda: self._send_chat(timeout, kwargs), tokens=estimate_tokens(kwargs), used_tokens=total_tokens
+        )
+
+    async def _send_chat(self, timeout: Optional[float], kwargs: Dict[str, Any]):
+        async with self._chat_slots:
+            started = time.perf_counter()
+            self._active["chat"] += 1
+            try:
+                completion = await self.client.chat.completions.create(timeout=timeout or LLM_TIMEOUT, **kwargs)
+            except Exception as e:
+                metrics.record_upstream("chat", kwargs.get("model"), time.perf_counter() - started, error=e)
+                raise
+            finally:
+                self._active["chat"] -= 1
+            metrics.record_upstream("chat", kwargs.get("model"), time.perf_counter() - started, usage=completion.usage)
+            return completion
+
+    async def _create_image(self, timeout: Optional[float], kwargs: Dict[str, Any]):
+        return await self.image_guard.run(lambda: self._send_image(self.client.images.generate, timeout, kwargs))
+
+    async def _send_image(self, create, timeout: Optional[float], kwargs: Dict[str, Any]):
+        async with self._image_slots:
+            started = time.perf_counter()
+            self._active["image"] += 1
+            try:
+                image_response = await create(timeout=timeout or IMAGE_TIMEOUT, **kwargs)
+            except Exception as e:
+                metrics.record_upstream("image", kwargs.get("model"), time.perf_counter() - started, error=e)
+                raise
+            finally:
+                self._active["image"] -= 1
+            metrics.record_upstream(
+                "image", kwargs.get("model"), time.perf_counter() - started,
+                usage=getattr(image_response, "usage", None), images=len(image_response.data or []),
+            )
+            return image_response
+
+    async def chat(self, timeout: Optional[float] = None, route: Optional[str] = None, **kwargs):
+        return await self._routed("chat", route, kwargs, lambda options: self._single_flight(
+            "chat", options, lambda: self._create_chat(timeout, options)))
+
+    async def chat_stream(self, timeout: Optional[float] = None, route: Optional[str] = None, **kwargs):
+        tier = None
+        if route is not None:
+            # 스트림은 첫 토큰까지의 시간으로 SLO 를 잽니다.
+            if self.router.recorder is not None:
+                await asyncio.to_thread(self.router.recorder.record, route, "chat", kwargs)
+            tier = self.router.select(route, self.load("chat"))
+            kwargs = {**kwargs, **self.router.options(route, tier)}
+        started = time.perf_counter()
+        first_token_at = None
+        usage = None
+        stream = None
+        estimated = estimate_tokens(kwargs)
+        try:
+            # 재시도는 스트림을 여는 단계까지만 합니다. 토큰을 보내기 시작한 뒤의 오류는 그대로 전달합니다.
+            stream = await self.chat_guard.run(lambda: self._open_stream(timeout, kwargs), tokens=estimated)
+            async for chunk in stream:
+                if first_token_at is None and chunk.choices and chunk.choices[0].delta.content:
+                    first_token_at = time.perf_counter()
+                    metrics.openai_ttft_seconds.observe(first_token_at - started, model=kwargs.get("model"))
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                yield chunk
+        except Exception as e:
+            metrics.record_upstream("chat_stream", kwargs.get("model"), time.perf_counter() - started, error=e)
+            if tier is not None:
+                self.router.observe(route, tier, time.perf_counter() - started, ok=False)
+            raise
+        finally:
+            if stream is not None:
+                try:
+                    # 클라이언트가 끊어 생성기가 닫혀도 업스트림 생성을 멈추고 연결을 바로 돌려줍니다.
+                    await stream.close()
+                finally:
+                    self._release_chat_slot()
+        await self.chat_guard.settle(estimated, getattr(usage, "total_tokens", None))
+        metrics.record_upstream("chat_stream", kwargs.get("model"), time.perf_counter() - started, usage=usage)
+        if tier is not None:
+            self.router.observe(route, tier, (first_token_at or time.perf_counter()) - started,
+                                tokens=getattr(usage, "total_tokens", None))
+
+    async def _open_stream(self, timeout: Optional[float], kwargs: Dict[str, Any]):
+        # 슬롯은 버킷과 차단기를 통과한 뒤에 잡고, 스트림이 끝날 때(chat_stream 의 finally) 놓습니다.
+        await self._chat_slots.acquire()
+        self._active["chat"] += 1
+        try:
+            return await self.client.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, timeout=timeout or LLM_TIMEOUT, **kwargs
+            )
+        except BaseException:
+            self._release_chat_slot()
+            raise
+
+    def _release_chat_slot(self):
+        self._active["chat"] -= 1
+        self._chat_slots.release()
+
+    async def generate_image(self, timeout: Optional[float] = None, route: Optional[str] = None, **kwargs):
+        return await self._routed("image", route, kwargs, lambda options: self._single_flight(
+            "image", options, lambda: self._create_image(timeout, options)))
+
+    async def edit_image(self, timeout: Optional[float] = None, route: Optional[str] = None, **kwargs):
+        """아이 그림을 바탕으로 다시 그리는 호출(images.edit). 입력 이미지가 매번 달라 합치지 않고, 기록하지도 않습니다."""
+        async def send(options: Dict[str, Any]):
+            self.upstream_calls += 1
+            return await self.image_guard.run(lambda: self._send_image(self.client.images.edit, timeout, options))
+        return await self._routed("image", route, kwargs, send, record=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "upstream_calls": self.upstream_calls,
+            "coalesced_calls": self.coalesced_calls,
+            "inflight": len(self._inflight),
+            "chat": self.chat_guard.stats(),
+            "image": self.image_guard.stats(),
+            "load": {kind: round(self.load(kind), 3) for kind in self._active},
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
@@ -1,54 +1,149 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Header, Response, Query, Request, UploadFile, File
+from fastapi.encoders import jsonable_encoder
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.orm import sessionmaker, Session, declarative_base
-from pydantic import BaseModel, ConfigDict
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+from sqlalchemy import func, inspect, select, text, update, Column, Integer, String, DateTime
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from pydantic import BaseModel, ConfigDict, computed_field, field_validator
 import os
 import logging
 import random
 from pathlib import Path
-from typing import List, Dict, Optional
-from openai import OpenAI
+from typing import Any, List, Dict, Optional, Literal, Tuple
+from datetime import datetime, timezone
+import base64
+import re
+import hashlib
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import json
-import httpx
-import uuid
+import time
+import asyncio
+
+# --- .env 파일에서 환경 변수 로드 ---
+# 아래 모듈들이 불러올 때 환경 변수를 읽으므로 그보다 먼저 로드합니다.
+env_path = Path(__file__).resolve().parent / ".env"
+load_dotenv(dotenv_path=env_path, override=True)
+
+from llm import LLMGateway
+from routing import ModelRouter
+from chat_sessions import ChatSessionStore, ConversationNotFoundError
+from cache import ResponseCache, make_cache_key, normalize_text
+from pool import ContentPool
+from storage import ImageIngestor, ImageDownloadError, ImageTooLargeError, StoredBlob, UPLOAD_DIR, UPLOAD_URL_PREFIX
+from thumbnails import Thumbnailer, THUMBNAIL_WIDTHS, upload_stem
+from vision import VisionInputNormalizer, InvalidImageError, decode_data_url
+from drawings import DrawingStore, DrawingNotFoundError
+from pipeline import RenderPipeline
+from batching import MicroBatcher, split_batch_results
+from structured import StructuredOutput, as_index, batch_model, clean_strings, json_schema_format, repair_string_lists
+from resilience import UpstreamUnavailableError, is_request_rejected
+from database import DATABASE_URL, GroupCommitter, create_db_engine
+from jobs import FairJobQueue, Job, JobQueueFullError, JobCancelledError
+from shared_state import create_shared_state, detect_worker_count
+from metrics import MetricsMiddleware, registry as metrics_registry, flatten_stats, image_fallbacks_total
 
 
 
 # Force reload for new API Key
 
-# --- .env 파일에서 환경 변수 로드 ---
-env_path = Path(__file__).resolve().parent / ".env"
-load_dotenv(dotenv_path=env_path, override=True)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+PUZZLE_IMAGE_PREFETCH = os.getenv("PUZZLE_IMAGE_PREFETCH", "1") == "1"
+# 생성된 이미지를 b64_json 으로 받아 곧바로 uploads/ 에 저장하고 로컬 URL을 돌려줍니다. 0이면 예전처럼 임시 URL을 돌려줍니다.
+IMAGE_EAGER_PERSIST = os.getenv("IMAGE_EAGER_PERSIST", "1") == "1"
+# 워커가 여럿일 때(WEB_CONCURRENCY>1 또는 SHARED_STATE_URL) 캐시, OpenAI 한도 버킷, 작업 상태, 대화를 워커끼리 나눕니다.
+shared_state = create_shared_state()
+model_routes = ModelRouter()
+llm = LLMGateway(OPENAI_API_KEY, state=shared_state, router=model_routes)
+response_cache = ResponseCache(state=shared_state)
+image_ingestor = ImageIngestor()
+thumbnailer = Thumbnailer()
+vision_inputs = VisionInputNormalizer()
+drawings = DrawingStore()
+image_jobs = FairJobQueue("image", state=shared_state, encode_result=jsonable_encoder)
 logger = logging.getLogger("uvicorn.error")
 
 # --- 1. 데이터베이스 설정 ---
-DATABASE_URL = "sqlite:///./prompe.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_db_engine(DATABASE_URL)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+# 공유/저장 같은 쓰기는 모두 여기로 보냅니다. DB_GROUP_COMMIT=1 이면 잠깐 모았다가 한 번에 커밋합니다.
+db_writes = GroupCommitter(SessionLocal)
 Base = declarative_base()
 
 # --- 2. SQLAlchemy 모델 ---
 class Post(Base):
     __tablename__ = "posts"
     id = Column(Integer, primary_key=True, index=True)
-    prompt = Column(String, index=True)
+    prompt = Column(String)
     image_url = Column(String)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+# 업로드 파일 색인: 내용 다이제스트별로 한 번만 저장하고 참조 횟수를 셉니다.
+class StoredImage(Base):
+    __tablename__ = "stored_images"
+    digest = Column(String, primary_key=True)
+    filename = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+
+# 원본 URL → 다이제스트. 같은 임시 URL을 다시 저장하면 내려받지 않고 색인만 갱신합니다.
+class ImageSource(Base):
+    __tablename__ = "image_sources"
+    url = Column(String, primary_key=True)
+    digest = Column(String, nullable=False, index=True)
 
 # --- 3. Pydantic 모델 ---
+THUMBNAIL_URL_PREFIX = "/api/thumbs"
+THUMBNAIL_DEFAULT_WIDTH = 480
+
 class PostRead(BaseModel):
     id: int; prompt: str; image_url: str
+    created_at: Optional[datetime] = None
     model_config = ConfigDict(from_attributes=True)
 
+    # SQLite 는 시간대를 저장하지 않아 읽어 온 값은 naive 입니다. 저장한 값은 UTC 이므로 UTC 로 붙여 돌려줍니다.
+    @field_validator("created_at")
+    @classmethod
+    def as_utc(cls, value: Optional[datetime]) -> Optional[datetime]:
+        if value is None:
+            return None
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+    @computed_field
+    @property
+    def thumb_url(self) -> Optional[str]:
+        stem = upload_stem(self.image_url)
+        return f"{THUMBNAIL_URL_PREFIX}/{stem}_{THUMBNAIL_DEFAULT_WIDTH}.webp" if stem else None
+
+    @computed_field
+    @property
+    def srcset(self) -> Optional[str]:
+        stem = upload_stem(self.image_url)
+        if not stem:
+            return None
+        return ", ".join(f"{THUMBNAIL_URL_PREFIX}/{stem}_{width}.webp {width}w" for width in THUMBNAIL_WIDTHS)
+
+class PostFeedResponse(BaseModel):
+    items: List[PostRead]
+    next_cursor: Optional[str] = None
+
+class PostSearchResponse(BaseModel):
+    items: List[PostRead]
+    next_offset: Optional[int] = None
+
 class ChatRequest(BaseModel):
-    messages: List[Dict[str, str]]
+    # 새 메시지 하나만 보냅니다. conversation_id 가 없으면 새 대화를 시작합니다.
+    message: Optional[str] = None
+    conversation_id: Optional[str] = None
+    # 전체 대화 기록(마지막이 새 사용자 메시지). conversation_id 와 함께 보내면 서버가 잃어버린 대화를 이 기록으로 다시 채우고,
+    # conversation_id 없이 보내면 예전처럼 서버에 기록을 남기지 않습니다.
+    messages: Optional[List[Dict[str, str]]] = None
 
 class ChatResponse(BaseModel):
     reply: str
+    conversation_id: Optional[str] = None
 
 class SuggestionRequest(BaseModel):
     subject: str
@@ -56,9 +151,11 @@ class SuggestionRequest(BaseModel):
 class SuggestionResponse(BaseModel):
     adjectives: List[str]; verbs: List[str]; locations: List[str]
 
+# 그림을 받는 필드는 모두 data URL 또는 /api/drawings/ 가 돌려준 핸들("drawing:<sha256>")을 받습니다.
 class ImageAdjectiveRequest(BaseModel):
     object_name: str
     image_data: str
+    detail: Literal["low", "high"] = "low"
 
 class ImageAdjectiveResponse(BaseModel):
     adjectives: List[str]
@@ -66,13 +163,14 @@ class ImageAdjectiveResponse(BaseModel):
 class MoodStyleRequest(BaseModel):
     prompt: str
     image_data: str
+    detail: Literal["low", "high"] = "low"
 
 class MoodStyleResponse(BaseModel):
     moods: List[str]
     styles: List[str]
 class ImageGenerationRequest(BaseModel):
     prompt: str
-    user_image: str
+    user_image: str  # "none", data URL 또는 그림 핸들
 
 class ImageGenerationResponse(BaseModel):
     image_url: str
@@ -90,10 +188,11 @@ class ShareRequest(BaseModel):
 class LayerData(BaseModel):
     name: str
     type: str
-    data: str
+    data: str  # 텍스트 레이어는 문장, 이미지 레이어는 data URL 또는 그림 핸들
 
 class ComposePromptRequest(BaseModel):
     layers: List[LayerData]
+    detail: Literal["low", "high"] = "high"
 
 class ComposePromptResponse(BaseModel):
     dalle_prompt: str
@@ -102,6 +201,7 @@ class ComposePromptResponse(BaseModel):
 class MerchMockupRequest(BaseModel):
     design_url: str
     product: str = "tshirt"
+    detail: Literal["low", "high"] = "high"
 
 class MerchMockupResponse(BaseModel):
     image_url: str
@@ -136,6 +236,17 @@ class PromptPuzzleRequest(BaseModel):
 class PromptPuzzleResponse(BaseModel):
     levels: List[PromptPuzzleLevel]
 
+# LLM 이 만드는 퍼즐 레벨. 풀의 키로 쓰는 theme 이 더 있고, 블록 종류는 셋 중 하나로 묶습니다.
+class GeneratedPuzzleBlock(PromptPuzzleBlock):
+    type: Literal["subject", "action", "location"]
+
+class GeneratedPuzzleLevel(PromptPuzzleLevel):
+    theme: str
+    availableBlocks: List[GeneratedPuzzleBlock]
+
+class GeneratedPuzzleLevels(BaseModel):
+    levels: List[GeneratedPuzzleLevel]
+
 # --- 3-2. Prompt Puzzle Image Models ---
 class PromptPuzzleImageRequest(BaseModel):
     prompt_kr: str
@@ -155,51 +266,351 @@ class SaveImageRequest(BaseModel):
 class SaveImageResponse(BaseModel):
     saved_url: str
 
+class DrawingUploadResponse(BaseModel):
+    handle: str
+    size: int
+    expires_in: int
+
 
 # --- 4. FastAPI 앱 및 미들웨어 설정 ---
-app = FastAPI()
+# 시작 단계에서는 첫 요청에 꼭 필요한 일(스키마 확인, 디스크의 콘텐츠 풀 읽기)만 동시에 끝내고,
+# openai 패키지 로드와 콘텐츠 풀 보충은 서버가 요청을 받기 시작한 뒤 백그라운드에서 합니다.
+startup_stats = {"startup_seconds": 0.0, "warm_up_seconds": 0.0, "schema_migrated": 0}
+
+async def warm_up():
+    started = time.perf_counter()
+    try:
+        await llm.warm_up()
+    except Exception:
+        logger.exception("LLM client warm-up failed")
+    startup_stats["warm_up_seconds"] = round(time.perf_counter() - started, 4)
+    # 풀 보충은 첫 요청들과 OpenAI 클라이언트를 다투지 않도록 워밍업이 끝난 뒤 시작합니다.
+    if OPENAI_API_KEY:
+        for pool in (emoji_quiz_pool, prompt_puzzle_pool):
+            if pool.size:
+                pool.start()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    workers = detect_worker_count()
+    if workers > 1 and not shared_state.shared:
+        # uvicorn --workers 만 주면 워커마다 OpenAI 한도 버킷을 따로 가져 조직 한도의 N배까지 보내게 됩니다.
+        logger.warning("Running %d workers with in-process shared state; each worker has its own OpenAI RPM/TPM bucket. "
+                       "Set WEB_CONCURRENCY or SHARED_STATE_URL to share state between workers.", workers)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    # 디스크에 저장된 풀을 먼저 읽어 콜드 워커도 곧바로 응답할 수 있게 합니다.
+    await asyncio.gather(
+        init_database(),
+        *(asyncio.to_thread(pool.load) for pool in (emoji_quiz_pool, prompt_puzzle_pool)),
+    )
+    startup_stats["startup_seconds"] = round(time.perf_counter() - started, 4)
+    warm_up_task = asyncio.create_task(warm_up())
+    try:
+        yield
+    finally:
+        warm_up_task.cancel()
+        for pool in (emoji_quiz_pool, prompt_puzzle_pool):
+            await pool.stop()
+        await chat_sessions.aclose()
+        await image_jobs.aclose()
+        await llm.aclose()
+        await image_ingestor.aclose()
+        thumbnailer.shutdown()
+        vision_inputs.shutdown()
+        await engine.dispose()
+        await shared_state.aclose()
+
+app = FastAPI(lifespan=lifespan)
 origins = ["http://localhost:5173", "http://localhost:5174", "http://localhost:5175", "https://promp-e.vercel.app"]
 app.add_middleware(CORSMiddleware, allow_origins=origins, allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-os.makedirs("uploads", exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-Base.metadata.create_all(bind=engine)
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(UpstreamUnavailableError)
+async def upstream_unavailable_handler(request, exc: UpstreamUnavailableError):
+    # 한도 초과/장애로 OpenAI를 부를 수 없을 때는 500 대신 503과 Retry-After 로 알려 줍니다.
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"AI 서버가 잠시 바쁩니다. 잠시 후 다시 시도해주세요. ({exc})"},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+# UPLOAD_DIR 은 lifespan 에서 만듭니다.
+app.mount(UPLOAD_URL_PREFIX, StaticFiles(directory=UPLOAD_DIR, check_dir=False), name="uploads")
+
+# 스키마를 바꾸면 올립니다. SQLite 는 PRAGMA user_version 에 적어 두고, 같으면 시작할 때 검사를 건너뜁니다.
+SCHEMA_VERSION = 1
+
+def migrate_schema(conn) -> bool:
+    is_sqlite = conn.dialect.name == "sqlite"
+    if is_sqlite and conn.execute(text("PRAGMA user_version")).scalar() == SCHEMA_VERSION:
+        return False
+    Base.metadata.create_all(bind=conn)
+    # create_all은 기존 테이블을 바꾸지 않으므로, 예전 DB에 필요한 변경을 한 번씩 적용합니다.
+    inspector = inspect(conn)
+    post_columns = {column["name"] for column in inspector.get_columns("posts")}
+    post_indexes = {index["name"] for index in inspector.get_indexes("posts")}
+    if "created_at" not in post_columns:
+        conn.execute(text("ALTER TABLE posts ADD COLUMN created_at TIMESTAMP"))
+    # 긴 프롬프트 문자열에 걸린 btree 인덱스는 검색에 쓰이지 않고 쓰기만 느리게 합니다.
+    if "ix_posts_prompt" in post_indexes:
+        conn.execute(text("DROP INDEX ix_posts_prompt"))
+    if is_sqlite:
+        create_post_search_index(conn, inspector)
+        conn.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+    return True
+
+def create_post_search_index(conn, inspector):
+    # 프롬프트 전문 검색용 FTS5 테이블입니다. trigram 토크나이저는 띄어쓰기 없는 한글 부분 문자열도 찾습니다.
+    # 트리거가 posts 삽입/수정/삭제를 따라가므로 create_post 에서 별도로 갱신할 필요가 없습니다.
+    if "posts_fts" in inspector.get_table_names():
+        return
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE posts_fts USING fts5(prompt, content='posts', content_rowid='id', tokenize='trigram')"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER posts_fts_insert AFTER INSERT ON posts BEGIN "
+        "INSERT INTO posts_fts(rowid, prompt) VALUES (new.id, new.prompt); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER posts_fts_delete AFTER DELETE ON posts BEGIN "
+        "INSERT INTO posts_fts(posts_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER posts_fts_update AFTER UPDATE OF prompt ON posts BEGIN "
+        "INSERT INTO posts_fts(posts_fts, rowid, prompt) VALUES ('delete', old.id, old.prompt); "
+        "INSERT INTO posts_fts(rowid, prompt) VALUES (new.id, new.prompt); END"
+    ))
+    # 이미 있던 글도 색인에 넣습니다.
+    conn.execute(text("INSERT INTO posts_fts(posts_fts) VALUES ('rebuild')"))
+
+async def init_database():
+    # 워커들이 동시에 떠도 마이그레이션은 한 워커만 합니다. 뒤따른 워커는 잠금을 얻은 뒤 user_version 을 보고 건너뜁니다.
+    async with shared_state.lock("schema-migration", ttl=300):
+        async with engine.begin() as conn:
+            startup_stats["schema_migrated"] = int(await conn.run_sync(migrate_schema))
 
 # --- 5. 데이터베이스 의존성 ---
-def get_db():
-    db = SessionLocal()
-    try: yield db
-    finally: db.close()
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
 
 # --- 6. API 엔드포인트 구현 ---
 @app.get("/")
 def read_root():
     return {"message": "PrompE Backend is running!"}
 
-@app.post("/api/posts/", response_model=PostRead)
-async def create_post(request: ShareRequest, db: Session = Depends(get_db)):
-    image_url_to_download = request.image_url
-    prompt = request.prompt
+async def persist_remote_image(url: str, error_prefix: str) -> Tuple[StoredBlob, Optional[str]]:
+    """
+    이미지를 uploads/ 에 저장(또는 기존 파일 재사용)합니다. 새로 내려받았다면 원본 URL도 함께 돌려줍니다.
+    다운로드하는 동안 커넥션을 잡고 있지 않도록 색인 조회에만 잠깐 세션을 엽니다. 색인 갱신은 index_image 가 합니다.
+    """
+    blob = image_ingestor.local_blob(url)
+    if blob is None and url.startswith("data:"):
+        # gpt-image-1 결과처럼 data URL 로 받은 이미지는 내려받지 않고 바로 저장합니다.
+        try:
+            blob = await image_ingestor.store_bytes(decode_data_url(url))
+        except InvalidImageError as e:
+            raise HTTPException(status_code=400, detail=f"{error_prefix}: {e}")
+        except ImageTooLargeError as e:
+            raise HTTPException(status_code=413, detail=f"{error_prefix}: {e}")
+    if blob is not None:
+        return blob, None
+    async with SessionLocal() as db:
+        source = await db.get(ImageSource, url)
+        stored = await db.get(StoredImage, source.digest) if source is not None else None
+    if stored is not None:
+        blob = image_ingestor.local_blob(f"{UPLOAD_URL_PREFIX}/{stored.filename}")
+        if blob is not None:
+            return blob, None
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(image_url_to_download)
-            response.raise_for_status()
-            image_data = response.content
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"이미지를 다운로드할 수 없습니다: {e}")
-    unique_filename = f"{uuid.uuid4()}.png"
-    file_location = f"uploads/{unique_filename}"
-    with open(file_location, "wb") as buffer:
-        buffer.write(image_data)
-    db_image_url = f"/{file_location}"
-    db_post = Post(prompt=prompt, image_url=db_image_url)
-    db.add(db_post)
-    db.commit()
-    db.refresh(db_post)
+        return await image_ingestor.download(url), url
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=f"{error_prefix}: {e}")
+    except ImageDownloadError as e:
+        raise HTTPException(status_code=500, detail=f"{error_prefix}: {e}")
+
+async def index_image(db: AsyncSession, blob: StoredBlob, source_url: Optional[str]):
+    """업로드 색인의 참조 횟수를 늘립니다. GroupCommitter 안에서 실행되므로 커밋은 하지 않습니다."""
+    # 읽고 더하는 대신 UPDATE 한 번으로 늘려, 동시에 커밋하는 요청끼리 값을 덮어쓰지 않게 합니다.
+    # 트랜잭션의 첫 문장이 쓰기이므로 SQLite 에서는 쓰기 잠금을 먼저 잡은 뒤에 행을 봅니다.
+    updated = await db.execute(
+        update(StoredImage).where(StoredImage.digest == blob.digest).values(refcount=StoredImage.refcount + 1)
+    )
+    if updated.rowcount == 0:
+        db.add(StoredImage(digest=blob.digest, filename=blob.filename, size=blob.size, refcount=1))
+    if source_url is not None:
+        await db.merge(ImageSource(url=source_url, digest=blob.digest))
+
+def image_response_format() -> Dict[str, str]:
+    return {"response_format": "b64_json"} if IMAGE_EAGER_PERSIST else {}
+
+async def keep_generated_image(image) -> str:
+    """
+    이미지 생성 결과(data[0])를 응답에 넣을 URL로 바꿉니다.
+    b64_json 으로 받은 이미지는 바로 uploads/ 에 써서 /uploads/<sha256>.png 를 돌려주므로,
+    브라우저가 임시 URL을 save-image 로 되돌려 보내 서버가 같은 바이트를 다시 내려받을 일이 없습니다.
+    """
+    if not image.b64_json:
+        return image.url
+    if not IMAGE_EAGER_PERSIST:
+        return "data:image/png;base64," + image.b64_json
+    blob = await image_ingestor.store_bytes(base64.b64decode(image.b64_json))
+    return blob.url
+
+async def inline_local_image(url: str) -> str:
+    """uploads/ 의 이미지는 OpenAI가 내려받을 수 없으므로 비전 입력으로 보낼 때 data URL로 바꿉니다."""
+    blob = image_ingestor.local_blob(url)
+    if blob is None:
+        return url
+    return "data:image/png;base64," + base64.b64encode(await image_ingestor.read_bytes(blob)).decode("ascii")
+
+async def vision_image_part(value: str, detail: str) -> Dict:
+    """data URL, 그림 핸들, 일반 URL 어느 것이든 비전 입력 파트로 만듭니다."""
+    if drawings.is_handle(value):
+        drawing = await drawings.get(value)
+        return await vision_inputs.image_bytes_part(drawing.data, drawing.digest, detail)
+    return await vision_inputs.image_part(value, detail)
+
+async def drawing_bytes(value: str) -> bytes:
+    if drawings.is_handle(value):
+        return (await drawings.get(value)).data
+    return decode_data_url(value)
+
+@app.post("/api/posts/", response_model=PostRead)
+async def create_post(request: ShareRequest):
+    blob, source_url = await persist_remote_image(request.image_url, "이미지를 다운로드할 수 없습니다")
+
+    async def write(db: AsyncSession) -> Post:
+        await index_image(db, blob, source_url)
+        db_post = Post(prompt=request.prompt, image_url=blob.url)
+        db.add(db_post)
+        await db.flush()
+        return db_post
+
+    db_post = await db_writes.submit(write)
+    stem = upload_stem(blob.url)
+    if stem:
+        thumbnailer.schedule(stem)
     return db_post
 
 @app.get("/api/posts/", response_model=List[PostRead])
-async def read_posts(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return db.query(Post).offset(skip).limit(limit).all()
+async def read_posts(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
+    # 하위 호환용 목록입니다. 새 갤러리는 /api/posts/feed/ 를 사용합니다.
+    return (await db.scalars(select(Post).order_by(Post.id).offset(skip).limit(limit))).all()
+
+def encode_feed_cursor(post_id: int) -> str:
+    return base64.urlsafe_b64encode(f"p:{post_id}".encode()).decode().rstrip("=")
+
+def decode_feed_cursor(cursor: str) -> int:
+    try:
+        decoded = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, post_id = decoded.split(":", 1)
+        if prefix != "p":
+            raise ValueError(prefix)
+        return int(post_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="잘못된 cursor 값입니다.")
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match 는 쉼표로 나열된 여러 ETag 나 * 일 수 있고, 비교는 약한 비교(W/ 무시)로 합니다."""
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip() for candidate in if_none_match.split(",")}
+    if "*" in candidates:
+        return True
+    opaque = {candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates}
+    return (etag[2:] if etag.startswith("W/") else etag) in opaque
+
+@app.get("/api/posts/feed/", response_model=PostFeedResponse)
+async def read_post_feed(
+    response: Response,
+    cursor: Optional[str] = None,
+    after_id: Optional[int] = None,
+    limit: int = Query(30, ge=1, le=100),
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    최신 글부터 id 내림차순으로 가져오는 커서 기반 피드입니다.
+    다음 페이지는 응답의 next_cursor 를 cursor 로 넘기면 됩니다 (after_id 로 직접 지정도 가능).
+    """
+    if cursor is not None:
+        after_id = decode_feed_cursor(cursor)
+    if after_id is None:
+        # 첫 페이지는 최신 글 id가 바뀌기 전까지 같으므로 ETag로 재검증만 하게 합니다.
+        # 재검증이 페이지 조회를 건너뛰도록 최신 id 만 먼저 읽습니다.
+        etag = f'W/"posts-{await db.scalar(select(func.max(Post.id))) or 0}-{limit}"'
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "public, max-age=10"
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "public, max-age=10"})
+    query = select(Post)
+    if after_id is not None:
+        query = query.where(Post.id < after_id)
+    posts = (await db.scalars(query.order_by(Post.id.desc()).limit(limit + 1))).all()
+    has_more = len(posts) > limit
+    posts = posts[:limit]
+    next_cursor = encode_feed_cursor(posts[-1].id) if has_more else None
+    return PostFeedResponse(items=posts, next_cursor=next_cursor)
+
+@app.get(THUMBNAIL_URL_PREFIX + "/{name}")
+async def read_thumbnail(name: str):
+    """갤러리용 WebP 썸네일. 아직 없으면 처음 요청될 때 만들어 디스크에 저장합니다."""
+    match = re.fullmatch(r"([0-9A-Za-z-]+)_(\d+)\.webp", name)
+    if not match or int(match.group(2)) not in THUMBNAIL_WIDTHS:
+        raise HTTPException(status_code=404, detail="썸네일을 찾을 수 없습니다.")
+    stem, width = match.group(1), int(match.group(2))
+    try:
+        await thumbnailer.ensure(stem)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="원본 이미지를 찾을 수 없습니다.")
+    return FileResponse(
+        thumbnailer.thumb_path(stem, width),
+        media_type="image/webp",
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+TRIGRAM_MIN_CHARS = 3
+
+@app.get("/api/posts/search/", response_model=PostSearchResponse)
+async def search_posts(
+    q: str = Query(..., min_length=1, max_length=100),
+    limit: int = Query(30, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    프롬프트 내용으로 공유된 글을 검색합니다. offset/next_offset 으로 페이지를 넘깁니다.
+    모든 단어가 3글자 이상이면 FTS5 trigram 색인을 쓰고 관련도(bm25) 순으로 정렬합니다.
+    "공룡"처럼 짧은 단어가 있으면 LIKE 검색으로 대신하며, 이때는 관련도 없이 최신순으로 정렬합니다.
+    """
+    terms = [term for term in normalize_text(q).split(" ") if term]
+    if not terms:
+        return PostSearchResponse(items=[])
+    if engine.dialect.name == "sqlite" and all(len(term) >= TRIGRAM_MIN_CHARS for term in terms):
+        match = " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        rows = (await db.execute(
+            text(
+                "SELECT rowid FROM posts_fts WHERE posts_fts MATCH :match "
+                "ORDER BY bm25(posts_fts), rowid DESC LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "limit": limit + 1, "offset": offset},
+        )).fetchall()
+        ids = [row[0] for row in rows]
+        posts_by_id = {post.id: post for post in await db.scalars(select(Post).where(Post.id.in_(ids[:limit])))}
+        posts = [posts_by_id[post_id] for post_id in ids[:limit] if post_id in posts_by_id]
+        has_more = len(ids) > limit
+    else:
+        query = select(Post)
+        for term in terms:
+            # % 와 _ 가 와일드카드로 모든 글에 맞지 않도록 이스케이프합니다.
+            escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            query = query.where(Post.prompt.ilike(f"%{escaped}%", escape="\\"))
+        rows = (await db.scalars(query.order_by(Post.id.desc()).offset(offset).limit(limit + 1))).all()
+        posts = rows[:limit]
+        has_more = len(rows) > limit
+    return PostSearchResponse(items=posts, next_offset=offset + limit if has_more else None)
 
 # [추가됨] 404 에러 해결을 위해 누락된 /api/save-image/ 엔드포인트 구현
 @app.post("/api/save-image/", response_model=SaveImageResponse)
@@ -207,89 +618,384 @@ async def save_image_from_temp_url(request: SaveImageRequest):
     """
     DALL-E 등에서 생성된 임시 URL로부터 이미지를 다운로드하여 서버에 영구 저장하고,
     저장된 파일에 접근할 수 있는 새로운 URL을 반환합니다.
+    같은 이미지는 내용 다이제스트로 한 번만 저장됩니다. 예: /uploads/<sha256>.png
+    이미지 엔드포인트가 이미 저장해 둔 /uploads/ URL이면 내려받지 않고 색인만 갱신합니다.
     """
-    image_url_to_download = request.temp_url
+    blob, source_url = await persist_remote_image(request.temp_url, "임시 URL에서 이미지를 다운로드할 수 없습니다")
+    await db_writes.submit(lambda db: index_image(db, blob, source_url))
+    return SaveImageResponse(saved_url=blob.url)
+
+@app.post("/api/drawings/", response_model=DrawingUploadResponse)
+async def upload_drawing(file: UploadFile = File(...)):
+    """
+    캔버스 그림을 multipart 바이너리로 한 번 올리고 핸들을 받습니다.
+    이후 그림을 받는 요청(형용사/무드 추천, 이미지 생성, 프롬프트 조합)에는 data URL 대신 이 핸들을 보냅니다.
+    핸들은 마지막으로 쓰인 뒤 expires_in 초가 지나면 사라지며, 그때는 404가 오므로 다시 올리면 됩니다.
+    """
+    data = await file.read(drawings.max_bytes + 1)
     try:
-        # httpx를 사용하여 비동기적으로 이미지를 다운로드합니다.
-        async with httpx.AsyncClient() as client:
-            response = await client.get(image_url_to_download)
-            response.raise_for_status()  # 2xx 상태 코드가 아니면 에러 발생
-            image_data = response.content
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"임시 URL에서 이미지를 다운로드할 수 없습니다: {e}")
-    
-    # 충돌을 피하기 위해 UUID로 고유한 파일 이름을 생성합니다.
-    unique_filename = f"{uuid.uuid4()}.png"
-    file_location = f"uploads/{unique_filename}"
-    
-    # 다운로드한 이미지 데이터를 바이너리 쓰기 모드로 파일에 저장합니다.
-    with open(file_location, "wb") as buffer:
-        buffer.write(image_data)
-        
-    # 프론트엔드에서 사용할 수 있는 상대 경로를 생성합니다.
-    # 예: /uploads/xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx.png
-    saved_url = f"/{file_location}"
-    
-    return SaveImageResponse(saved_url=saved_url)
+        handle = await drawings.put(data)
+    except InvalidImageError as e:
+        raise HTTPException(status_code=413 if len(data) > drawings.max_bytes else 400, detail=f"그림 업로드 오류: {e}")
+    return DrawingUploadResponse(handle=handle, size=len(data), expires_in=int(drawings.ttl))
+
 
+CHAT_SYSTEM_PROMPT = "너는 AI와 프롬프트에 대해 아이들에게 가르쳐주는 친절하고 상냥한 AI 조수야. 아이들이 이해하기 쉽도록 항상 짧고 재미있게 대답해줘."
+CHAT_SUMMARY_PROMPT = "다음은 AI 조수와 아이가 나눈 대화야. 대화를 이어 가는 데 필요한 내용(아이의 이름이나 관심사, 물어본 것, 이미 설명해 준 것)만 한국어로 5문장 이내로 요약해줘. 이전 요약이 있으면 새 내용과 합쳐 하나의 요약으로 만들어줘."
+
+async def summarize_chat(summary: Optional[str], messages: List[Dict[str, str]]) -> str:
+    transcript = "\n".join(f"{'아이' if message['role'] == 'user' else 'AI'}: {message['content']}" for message in messages)
+    if summary:
+        transcript = f"이전 요약: {summary}\n\n{transcript}"
+    completion = await llm.chat(
+        route="chat-summary",
+        messages=[{"role": "system", "content": CHAT_SUMMARY_PROMPT}, {"role": "user", "content": transcript}],
+    )
+    return completion.choices[0].message.content.strip()
+
+chat_sessions = ChatSessionStore(summarize_chat, state=shared_state)
+
+async def open_chat_turn(request: ChatRequest):
+    """(세션, 새 메시지)를 돌려줍니다. 예전 방식(messages 만 보냄)이면 세션 없이 (None, 보낼 메시지 전체)를 돌려줍니다."""
+    if request.message is None and request.messages is None:
+        raise HTTPException(status_code=400, detail="message 또는 messages 가 필요합니다.")
+    if request.message is None and not request.conversation_id:
+        return None, [{"role": "system", "content": CHAT_SYSTEM_PROMPT}, *request.messages]
+    if request.message is not None:
+        if not request.conversation_id:
+            return await chat_sessions.create(), request.message
+        try:
+            return await chat_sessions.get(request.conversation_id), request.message
+        except ConversationNotFoundError:
+            # 서버가 재시작했거나 오래되어 지워진 대화입니다. 브라우저가 messages 로 다시 보내면 이어서 대화합니다.
+            raise HTTPException(status_code=404, detail="대화를 찾을 수 없습니다. 전체 대화 기록(messages)과 함께 다시 보내주세요.")
+    if not request.messages or request.messages[-1].get("role") != "user":
+        raise HTTPException(status_code=400, detail="messages 의 마지막은 사용자 메시지여야 합니다.")
+    message = request.messages[-1]["content"]
+    try:
+        # 서버에 살아 있는 대화라면 보내온 기록은 무시하고 마지막 메시지만 새 턴으로 씁니다 (기록을 덮어쓰지 못하게).
+        return await chat_sessions.get(request.conversation_id), message
+    except ConversationNotFoundError:
+        return await chat_sessions.create(request.conversation_id, request.messages[:-1]), message
 
 @app.post("/api/chat/", response_model=ChatResponse)
 async def chat_with_ai(request: ChatRequest):
     if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
+    session, message = await open_chat_turn(request)
     try:
-        messages_to_send = [{"role": "system", "content": "너는 AI와 프롬프트에 대해 아이들에게 가르쳐주는 친절하고 상냥한 AI 조수야. 아이들이 이해하기 쉽도록 항상 짧고 재미있게 대답해줘."}, *request.messages]
-        completion = client.chat.completions.create(model="gpt-4o", messages=messages_to_send)
-        return ChatResponse(reply=completion.choices[0].message.content)
+        if session is None:
+            completion = await llm.chat(route="chat", messages=message)
+            return ChatResponse(reply=completion.choices[0].message.content)
+        async with session.lock:
+            completion = await llm.chat(route="chat", messages=session.prompt(CHAT_SYSTEM_PROMPT, message))
+            reply = completion.choices[0].message.content
+            await chat_sessions.record_turn(session, message, reply)
+        return ChatResponse(reply=reply, conversation_id=session.id)
+    except UpstreamUnavailableError:
+        raise
     except Exception as e:
         logger.exception("Chat API failed")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/api/suggest-keywords/", response_model=SuggestionResponse)
-async def suggest_keywords_for_subject(request: SuggestionRequest):
+@app.post("/api/chat/stream/")
+async def chat_with_ai_stream(request: ChatRequest):
+    """
+    /api/chat/ 의 스트리밍 버전입니다. 토큰이 도착하는 대로 Server-Sent Events로 전달합니다.
+    각 이벤트의 data는 {"delta": "..."} 이며, 마지막에 done 이벤트(오류 시 error 이벤트)를 보냅니다.
+    서버 세션을 쓰는 대화라면 done 이벤트의 data 에 conversation_id 가 들어 있습니다.
+    """
     if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
-    try:
-        system_prompt = f"""당신은 어린이 그림 그리기 게임을 돕는 창의적인 AI 어시스턴트입니다. 사용자가 그리고 싶은 주인공으로 '{request.subject}'를(을) 선택했습니다. 당신의 임무는 주인공 '{request.subject}'와(과) 잘 어울리는 이야기를 만들 수 있는 연관 키워드를 추천하는 것입니다. '꾸며주는 말(형용사)' 8개, '하는 일(동사)' 8개, '장소' 8개를 각각 추천해주세요. 당신의 답변은 반드시 "adjectives", "verbs", "locations" 라는 세 개의 키를 가진 유효한 JSON 객체 형식이어야 합니다. 각 키의 값은 8개의 한국어 문자열을 담은 리스트(배열)여야 합니다."""
-        completion = client.chat.completions.create(
-            model="gpt-4o",
+    session, message = await open_chat_turn(request)
+    started = time.perf_counter()
+
+    async def stream_reply(messages_to_send: List[Dict[str, str]], parts: List[str]):
+        first_token_at = None
+        async for chunk in llm.chat_stream(route="chat", messages=messages_to_send):
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if not delta:
+                continue
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+                logger.info("Chat stream TTFB %.0fms", (first_token_at - started) * 1000)
+            parts.append(delta)
+            yield f"data: {json.dumps({'delta': delta}, ensure_ascii=False)}\n\n"
+
+    async def event_stream():
+        parts: List[str] = []
+        try:
+            if session is None:
+                async for event in stream_reply(message, parts):
+                    yield event
+                yield "event: done\ndata: {}\n\n"
+                return
+            # 답을 끝까지 받은 턴만 기록에 남깁니다. 중간에 끊기면 그 턴은 없던 일이 됩니다.
+            async with session.lock:
+                async for event in stream_reply(session.prompt(CHAT_SYSTEM_PROMPT, message), parts):
+                    yield event
+                await chat_sessions.record_turn(session, message, "".join(parts))
+            yield f"event: done\ndata: {json.dumps({'conversation_id': session.id})}\n\n"
+        except Exception as e:
+            logger.exception("Chat stream failed")
+            yield f"event: error\ndata: {json.dumps({'detail': str(e)}, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/cache-stats/")
+def read_cache_stats():
+    return response_cache.stats()
+
+@app.get("/api/llm-stats/")
+def read_llm_stats():
+    return llm.stats()
+
+# --- 짧은 추천 호출: 개별 호출과 (LLM_BATCHING=1 일 때) 묶음 호출 ---
+# 키워드/힌트는 응답 모델의 strict 스키마로 받습니다. 개수가 넘치면 잘라 쓰고, MIN 개보다 모자란 목록만 다시 받습니다.
+KEYWORD_COUNT, KEYWORD_MIN_COUNT = 8, 6
+HINT_COUNT, HINT_MIN_COUNT = 5, 3
+KEYWORD_KEYS = ("adjectives", "verbs", "locations")
+HINT_KEYS = ("adjectives", "verbs", "styles")
+
+keyword_output = StructuredOutput(
+    "suggest-keywords", SuggestionResponse,
+    lambda data: repair_string_lists(data, KEYWORD_KEYS, KEYWORD_COUNT, KEYWORD_MIN_COUNT),
+)
+hint_output = StructuredOutput(
+    "generate-hints", HintResponse,
+    lambda data: repair_string_lists(data, HINT_KEYS, HINT_COUNT, HINT_MIN_COUNT),
+)
+KEYWORD_BATCH_FORMAT = json_schema_format(batch_model(SuggestionResponse))
+HINT_BATCH_FORMAT = json_schema_format(batch_model(HintResponse))
+
+def word_list_reask(output: StructuredOutput, request_text: str, count: int):
+    """모자란 목록만 count 개씩 다시 받아 뒤에 붙이는 reask 를 만듭니다."""
+    async def reask(data: Dict, keys: List[str]):
+        existing = json.dumps({key: data.get(key, []) for key in keys}, ensure_ascii=False)
+        system_prompt = (
+            f"{request_text} JSON 객체의 {', '.join(json.dumps(key) for key in keys)} 키마다 한국어 문자열 {count}개를 담아주세요. "
+            f"이미 나온 말은 다시 쓰지 마세요: {existing}"
+        )
+        part = await output.ask_part(
+            lambda response_format: llm.chat(route=output.name, messages=[{"role": "system", "content": system_prompt}],
+                                             response_format=response_format),
+            keys,
+        )
+        for key in keys:
+            data[key] = [*data.get(key, []), *clean_strings(part.get(key))]
+    return reask
+
+def keep_repaired(output: StructuredOutput, results: List[Optional[Dict]]) -> List[Optional[Dict]]:
+    # 묶음 응답도 항목마다 같은 규칙으로 고칩니다. 고칠 수 없는 항목은 None 으로 두어 개별 호출로 다시 처리합니다.
+    return [result if result is not None and not output.repair_data(result) else None for result in results]
+
+
+def keyword_system_prompt(subject: str) -> str:
+    return f"""당신은 어린이 그림 그리기 게임을 돕는 창의적인 AI 어시스턴트입니다. 사용자가 그리고 싶은 주인공으로 '{subject}'를(을) 선택했습니다. 당신의 임무는 주인공 '{subject}'와(과) 잘 어울리는 이야기를 만들 수 있는 연관 키워드를 추천하는 것입니다. '꾸며주는 말(형용사)' 8개, '하는 일(동사)' 8개, '장소' 8개를 각각 추천해주세요. 당신의 답변은 반드시 "adjectives", "verbs", "locations" 라는 세 개의 키를 가진 유효한 JSON 객체 형식이어야 합니다. 각 키의 값은 8개의 한국어 문자열을 담은 리스트(배열)여야 합니다."""
+
+async def fetch_keywords(subject: str) -> Dict:
+    result = await keyword_output.generate(
+        lambda response_format: llm.chat(
+            route="suggest-keywords",
             messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Please generate keywords for the subject: '{request.subject}'"}
+                {"role": "system", "content": keyword_system_prompt(subject)},
+                {"role": "user", "content": f"Please generate keywords for the subject: '{subject}'"}
             ],
-            response_format={"type": "json_object"}
-        )
-        keyword_data = json.loads(completion.choices[0].message.content)
+            response_format=response_format
+        ),
+        word_list_reask(keyword_output, f"어린이 그림 그리기 게임에서 주인공 '{subject}'와(과) 어울리는 키워드를 더 추천해주세요.", KEYWORD_COUNT),
+    )
+    return result.model_dump()
+
+async def fetch_keywords_batch(subjects: List[str]) -> List[Optional[Dict]]:
+    system_prompt = """당신은 어린이 그림 그리기 게임을 돕는 창의적인 AI 어시스턴트입니다. 여러 아이가 고른 주인공 목록이 id와 함께 주어집니다. 각 주인공마다 잘 어울리는 이야기를 만들 수 있도록 '꾸며주는 말(형용사)' 8개, '하는 일(동사)' 8개, '장소' 8개를 한국어로 추천해주세요. 답변은 반드시 {"results": [{"id": 0, "adjectives": [...], "verbs": [...], "locations": [...]}, ...]} 형식의 유효한 JSON 객체여야 하며, 주어진 모든 id에 대해 하나씩 결과가 있어야 합니다."""
+    items = [{"id": index, "subject": subject} for index, subject in enumerate(subjects)]
+    completion = await llm.chat(
+        route="suggest-keywords",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": json.dumps(items, ensure_ascii=False)}
+        ],
+        response_format=KEYWORD_BATCH_FORMAT
+    )
+    return keep_repaired(keyword_output, split_batch_results(completion.choices[0].message.content, len(subjects)))
+
+def hint_system_prompt(prompt: str) -> str:
+    return f"""
+        You are an AI assistant that helps a child learn prompt engineering. The user will provide a sentence they have created: "{prompt}". Your task is to analyze this sentence and suggest alternative or additional keywords to inspire creativity.
+        **CRITICAL INSTRUCTIONS:**
+        1.  You **MUST** generate **exactly 5 keywords** for each category: "adjectives", "verbs" (actions), and "styles" or "moods".
+        2.  The keywords must be in Korean.
+        3.  The keywords should be creative and related to the user's prompt, but do not need to be strictly derived from it. Expand on the theme.
+        4.  Your response format **MUST** be a valid JSON object with three keys: "adjectives", "verbs", "styles". Each key's value must be a list containing exactly 5 strings.
+        Example User Prompt: "숲속에서 잠자는 커다란 빨간 용"
+        Your JSON Response (MUST contain 5 items per list): {{ "adjectives": ["신비로운", "고대의", "반짝이는", "거대한", "평화로운"], "verbs": ["꿈을 꾸는", "숨 쉬는", "둥지를 튼", "조용히 기다리는", "빛을 내는"], "styles": ["수채화 스타일", "애니메이션 느낌", "밤 배경", "아침 햇살 아래", "판타지 아트"] }}
+        """
+
+async def fetch_hints(prompt: str) -> Dict:
+    result = await hint_output.generate(
+        lambda response_format: llm.chat(route="generate-hints", messages=[{"role": "system", "content": hint_system_prompt(prompt)}, {"role": "user", "content": prompt}], response_format=response_format),
+        word_list_reask(hint_output, f"아이가 만든 문장 \"{prompt}\" 에 어울리는 키워드를 더 추천해주세요 (styles 는 스타일이나 분위기).", HINT_COUNT),
+    )
+    return result.model_dump()
+
+async def fetch_hints_batch(prompts: List[str]) -> List[Optional[Dict]]:
+    system_prompt = """
+        You are an AI assistant that helps children learn prompt engineering. You receive a JSON list of sentences written by different children, each with an "id".
+        For EACH sentence, suggest alternative or additional keywords to inspire creativity:
+        - exactly 5 Korean "adjectives", 5 Korean "verbs" (actions) and 5 Korean "styles" (styles or moods),
+        - creative and related to that child's sentence only.
+        Return ONLY a valid JSON object: { "results": [ { "id": 0, "adjectives": [...], "verbs": [...], "styles": [...] }, ... ] } with one result per id.
+        """
+    items = [{"id": index, "sentence": prompt} for index, prompt in enumerate(prompts)]
+    completion = await llm.chat(
+        route="generate-hints",
+        messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": json.dumps(items, ensure_ascii=False)}],
+        response_format=HINT_BATCH_FORMAT
+    )
+    return keep_repaired(hint_output, split_batch_results(completion.choices[0].message.content, len(prompts)))
+
+async def fetch_image_adjectives(item: Dict) -> Dict:
+    system_prompt = """
+    You suggest adjectives for a child's drawing.
+    Return ONLY a JSON object: { "adjectives": ["...", "..."] }
+    Rules:
+    - Exactly 8 Korean adjectives.
+    - Must describe the object in the image.
+    - Easy words for kids.
+    - No emojis.
+    """
+    completion = await llm.chat(
+        route="suggest-adjectives",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": f'Object name: "{item["object_name"]}"'},
+                item["image"]
+            ]}
+        ],
+        response_format={"type": "json_object"}
+    )
+    content = completion.choices[0].message.content
+    if not content:
+        raise ValueError("Empty response content.")
+    return json.loads(content)
+
+async def fetch_image_adjectives_batch(items: List[Dict]) -> List[Optional[Dict]]:
+    system_prompt = """
+    You suggest adjectives for several children's drawings. Each drawing is preceded by its item id and object name.
+    Return ONLY a JSON object: { "results": [ { "id": 0, "adjectives": ["...", "..."] }, ... ] } with one result per item.
+    Rules:
+    - Exactly 8 Korean adjectives per item.
+    - Must describe the object in that item's image.
+    - Easy words for kids.
+    - No emojis.
+    """
+    user_content = []
+    for index, item in enumerate(items):
+        user_content.append({"type": "text", "text": f'Item {index} | Object name: "{item["object_name"]}"'})
+        user_content.append(item["image"])
+    completion = await llm.chat(
+        route="suggest-adjectives",
+        messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}],
+        response_format={"type": "json_object"}
+    )
+    return split_batch_results(completion.choices[0].message.content, len(items))
+
+async def fetch_mood_styles(item: Dict) -> Dict:
+    system_prompt = """
+    You suggest mood and style words for a child's drawing.
+    Return ONLY a JSON object: { "moods": ["..."], "styles": ["..."] }
+    Rules:
+    - Exactly 6 Korean moods and 6 Korean styles.
+    - Must match the drawing and the prompt.
+    - Easy words for kids.
+    - No emojis.
+    """
+    completion = await llm.chat(
+        route="suggest-mood-style",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": f'Prompt: "{item["prompt"]}"'},
+                item["image"]
+            ]}
+        ],
+        response_format={"type": "json_object"}
+    )
+    content = completion.choices[0].message.content
+    if not content:
+        raise ValueError("Empty response content.")
+    return json.loads(content)
+
+async def fetch_mood_styles_batch(items: List[Dict]) -> List[Optional[Dict]]:
+    system_prompt = """
+    You suggest mood and style words for several children's drawings. Each drawing is preceded by its item id and prompt.
+    Return ONLY a JSON object: { "results": [ { "id": 0, "moods": ["..."], "styles": ["..."] }, ... ] } with one result per item.
+    Rules:
+    - Exactly 6 Korean moods and 6 Korean styles per item.
+    - Must match that item's drawing and prompt.
+    - Easy words for kids.
+    - No emojis.
+    """
+    user_content = []
+    for index, item in enumerate(items):
+        user_content.append({"type": "text", "text": f'Item {index} | Prompt: "{item["prompt"]}"'})
+        user_content.append(item["image"])
+    completion = await llm.chat(
+        route="suggest-mood-style",
+        messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}],
+        response_format={"type": "json_object"}
+    )
+    return split_batch_results(completion.choices[0].message.content, len(items))
+
+def has_lists(*keys: str):
+    return lambda result: all(isinstance(result.get(key), list) and result.get(key) for key in keys)
+
+keyword_batcher = MicroBatcher("suggest-keywords", fetch_keywords_batch, fetch_keywords, has_lists("adjectives", "verbs", "locations"))
+hint_batcher = MicroBatcher("generate-hints", fetch_hints_batch, fetch_hints, has_lists("adjectives", "verbs", "styles"))
+image_adjective_batcher = MicroBatcher("suggest-adjectives", fetch_image_adjectives_batch, fetch_image_adjectives, has_lists("adjectives"))
+mood_style_batcher = MicroBatcher("suggest-mood-style", fetch_mood_styles_batch, fetch_mood_styles, has_lists("moods", "styles"))
+
+@app.get("/api/batch-stats/")
+def read_batch_stats():
+    return {batcher.name: batcher.stats() for batcher in (keyword_batcher, hint_batcher, image_adjective_batcher, mood_style_batcher)}
+
+@app.post("/api/suggest-keywords/", response_model=SuggestionResponse)
+async def suggest_keywords_for_subject(request: SuggestionRequest, response: Response, x_cache_bypass: Optional[str] = Header(None)):
+    if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
+    try:
+        subject = normalize_text(request.subject)
+        # 같은 주인공(예: "고양이")에 대한 추천은 캐시에서 바로 돌려줍니다.
+        cache_key = make_cache_key("suggest-keywords", model_routes.model("suggest-keywords"), keyword_system_prompt(subject), subject)
+        keyword_data = None if x_cache_bypass else await response_cache.get(cache_key)
+        response.headers["X-Cache"] = "HIT" if keyword_data is not None else "MISS"
+        if keyword_data is None:
+            started = time.monotonic()
+            keyword_data = await keyword_batcher.submit(subject)
+            # 강등된 티어(fast)로 만든 결과는 설정된 모델의 키로 남기지 않습니다.
+            if all(keyword_data.get(k) for k in ("adjectives", "verbs", "locations")) and not model_routes.downgraded_since(started, "suggest-keywords"):
+                await response_cache.set(cache_key, keyword_data)
         return SuggestionResponse(adjectives=keyword_data.get("adjectives", []), verbs=keyword_data.get("verbs", []), locations=keyword_data.get("locations", []))
+    except UpstreamUnavailableError:
+        raise
     except Exception as e: raise HTTPException(status_code=500, detail=f"키워드 추천 중 오류가 발생했습니다: {e}")
 
 @app.post("/api/suggest-adjectives/", response_model=ImageAdjectiveResponse)
 async def suggest_adjectives_from_image(request: ImageAdjectiveRequest):
     if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
     try:
-        system_prompt = """
-        You suggest adjectives for a child's drawing.
-        Return ONLY a JSON object: { "adjectives": ["...", "..."] }
-        Rules:
-        - Exactly 8 Korean adjectives.
-        - Must describe the object in the image.
-        - Easy words for kids.
-        - No emojis.
-        """
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {"type": "text", "text": f'Object name: "{request.object_name}"'},
-                    {"type": "image_url", "image_url": {"url": request.image_data}}
-                ]}
-            ],
-            response_format={"type": "json_object"}
-        )
-        content = completion.choices[0].message.content
-        if not content:
-            raise ValueError("Empty response content.")
-        data = json.loads(content)
+        image = await vision_image_part(request.image_data, request.detail)
+        data = await image_adjective_batcher.submit({"object_name": request.object_name, "image": image})
         return ImageAdjectiveResponse(adjectives=data.get("adjectives", []))
+    except DrawingNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"그림 데이터 오류: {e}")
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=f"그림 데이터 오류: {e}")
+    except UpstreamUnavailableError:
+        raise
     except Exception as e:
         logger.exception("Suggest adjectives failed")
         raise HTTPException(status_code=500, detail=f"형용사 추천 오류: {e}")
@@ -298,77 +1004,180 @@ async def suggest_adjectives_from_image(request: ImageAdjectiveRequest):
 async def suggest_mood_style_from_image(request: MoodStyleRequest):
     if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
     try:
-        system_prompt = """
-        You suggest mood and style words for a child's drawing.
-        Return ONLY a JSON object: { "moods": ["..."], "styles": ["..."] }
-        Rules:
-        - Exactly 6 Korean moods and 6 Korean styles.
-        - Must match the drawing and the prompt.
-        - Easy words for kids.
-        - No emojis.
-        """
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {"type": "text", "text": f'Prompt: "{request.prompt}"'},
-                    {"type": "image_url", "image_url": {"url": request.image_data}}
-                ]}
-            ],
-            response_format={"type": "json_object"}
-        )
-        content = completion.choices[0].message.content
-        if not content:
-            raise ValueError("Empty response content.")
-        data = json.loads(content)
+        image = await vision_image_part(request.image_data, request.detail)
+        data = await mood_style_batcher.submit({"prompt": request.prompt, "image": image})
         return MoodStyleResponse(
             moods=data.get("moods", []),
             styles=data.get("styles", [])
         )
+    except DrawingNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"그림 데이터 오류: {e}")
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=f"그림 데이터 오류: {e}")
+    except UpstreamUnavailableError:
+        raise
     except Exception as e:
         logger.exception("Suggest mood/style failed")
         raise HTTPException(status_code=500, detail=f"무드/스타일 추천 오류: {e}")
 
-@app.post("/api/generate-image/", response_model=ImageGenerationResponse)
-async def generate_image_from_prompt(request: ImageGenerationRequest):
-    if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
+# --- 이미지 생성 작업 큐 ---
+# 이미지 엔드포인트는 작업을 큐에 넣고 차례가 오면 실행합니다. 기본은 결과가 나올 때까지 기다렸다가 돌려주고,
+# "Prefer: respond-async" 헤더를 보내면 202와 job_id 를 바로 돌려주므로 /api/image-jobs/{job_id} 로 조회하면 됩니다.
+# 같은 반(X-Classroom-Id) 안에서는 세션(X-Session-Id)별로, 반끼리도 돌아가며 실행합니다.
+async def run_image_job(http_request: Request, kind: str, render, session_id: Optional[str],
+                        classroom_id: Optional[str], prefer: Optional[str]):
+    respond_async = bool(prefer and "respond-async" in prefer.lower())
+    # 세션 id 가 없으면 IP 를 세션 대신 반으로 묶습니다. 세션별 개수 제한은 실제 세션 id 에만 겁니다.
+    if not session_id and not classroom_id and http_request.client:
+        classroom_id = f"ip:{http_request.client.host}"
+    try:
+        job = image_jobs.submit(kind, render, session_id, classroom_id, detached=respond_async)
+    except JobQueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    if respond_async:
+        return JSONResponse(
+            status_code=202,
+            content=describe_image_job(job),
+            headers={"Location": f"/api/image-jobs/{job.id}", "Preference-Applied": "respond-async"},
+        )
+    try:
+        return await image_jobs.wait(job, http_request.is_disconnected)
+    except JobCancelledError as e:
+        # 클라이언트가 끊겼거나 다른 요청이 작업을 취소한 경우입니다.
+        raise HTTPException(status_code=499, detail=str(e))
+
+def describe_image_job(job: Job) -> Dict:
+    return image_jobs.describe(job, jsonable_encoder(job.result))
+
+async def find_image_job(job_id: str) -> Tuple[Optional[Job], Dict]:
+    """(이 워커의 작업 또는 None, 상태)를 돌려줍니다. 다른 워커가 받은 작업이면 공유 상태에 올라온 마지막 상태를 씁니다."""
+    job = image_jobs.get(job_id)
+    if job is not None:
+        return job, describe_image_job(job)
+    snapshot = await image_jobs.lookup(job_id)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="이미지 작업을 찾을 수 없습니다.")
+    return None, snapshot
+
+@app.get("/api/image-jobs/{job_id}")
+async def read_image_job(job_id: str):
+    return (await find_image_job(job_id))[1]
+
+# 다른 워커가 실행 중인 작업을 SSE 로 따라갈 때 공유 상태를 다시 읽는 간격
+REMOTE_JOB_POLL_INTERVAL = 0.5
+
+@app.get("/api/image-jobs/{job_id}/events")
+async def stream_image_job(job_id: str, http_request: Request):
+    """작업 상태가 바뀔 때마다 SSE 로 보냅니다. 끝나기 전에 연결이 끊기면 작업을 취소합니다."""
+    job, snapshot = await find_image_job(job_id)
+
+    async def remote_event_stream():
+        nonlocal snapshot
+        last_sent, idle = None, 0.0
+        while True:
+            if snapshot != last_sent:
+                last_sent, idle = snapshot, 0.0
+                yield f"data: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+                if snapshot["status"] in Job.FINISHED:
+                    return
+            elif idle >= 15:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(REMOTE_JOB_POLL_INTERVAL)
+            idle += REMOTE_JOB_POLL_INTERVAL
+            if await http_request.is_disconnected():
+                await image_jobs.request_cancel(job_id)
+                return
+            snapshot = await image_jobs.lookup(job_id) or snapshot
+
+    async def event_stream():
+        while True:
+            changed = job.changed
+            yield f"data: {json.dumps(describe_image_job(job), ensure_ascii=False)}\n\n"
+            if job.finished:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=15)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+            if await http_request.is_disconnected():
+                image_jobs.cancel(job)
+                return
+
+    return StreamingResponse(
+        event_stream() if job is not None else remote_event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.delete("/api/image-jobs/{job_id}")
+async def cancel_image_job(job_id: str):
+    job, snapshot = await find_image_job(job_id)
+    if job is None:
+        # 실행 중인 워커가 곧 취소 표시를 보고 취소합니다. 돌려주는 상태는 취소 전 상태일 수 있습니다.
+        if snapshot["status"] not in Job.FINISHED:
+            await image_jobs.request_cancel(job_id)
+        return snapshot
+    image_jobs.cancel(job)
+    return describe_image_job(job)
+
+@app.get("/api/job-stats/")
+def read_job_stats():
+    return image_jobs.stats()
+
+async def create_generated_image(request: ImageGenerationRequest) -> ImageGenerationResponse:
     try:
         if request.user_image != "none":
+            # 아이 그림을 바탕으로 다시 그립니다. 모델을 쓸 수 없거나 요청이 거절된 경우(4xx)에만 그림 없이 생성하는 호출로 대신하고,
+            # 한도 초과/장애는 두 번 호출해 봐야 소용없으므로 그대로 503으로 돌려줍니다.
             try:
-                image_response = client.images.generate(
-                    model="gpt-image-1",
+                image_response = await llm.edit_image(
+                    route="generate-image-edit",
                     prompt=request.prompt,
-                    image=request.user_image,
-                    size="1024x1024",
-                    quality="standard",
+                    image=("drawing.png", await drawing_bytes(request.user_image), "image/png"),
                     n=1
                 )
-                return ImageGenerationResponse(image_url=image_response.data[0].url)
-            except Exception:
-                pass
+                return ImageGenerationResponse(image_url=await keep_generated_image(image_response.data[0]))
+            except Exception as e:
+                if not is_request_rejected(e):
+                    raise
+                logger.warning("Image edit rejected, falling back to image generation: %s", e)
+                image_fallbacks_total.inc(model=model_routes.model("generate-image-edit"), error=type(e).__name__)
         prompt_for_dalle = f"A simple, clean, cute children's book illustration style of: {request.prompt}"
-        image_response = client.images.generate(model="dall-e-3", prompt=prompt_for_dalle, size="1024x1024", quality="standard", n=1)
-        return ImageGenerationResponse(image_url=image_response.data[0].url)
+        image_response = await llm.generate_image(
+            route="generate-image", prompt=prompt_for_dalle, n=1, **image_response_format()
+        )
+        return ImageGenerationResponse(image_url=await keep_generated_image(image_response.data[0]))
+    except DrawingNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"그림 데이터 오류: {e}")
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=f"그림 데이터 오류: {e}")
+    except UpstreamUnavailableError:
+        raise
     except Exception as e: raise HTTPException(status_code=500, detail=f"이미지 생성 중 오류가 발생했습니다: {e}")
 
+@app.post("/api/generate-image/", response_model=ImageGenerationResponse)
+async def generate_image_from_prompt(request: ImageGenerationRequest, http_request: Request, x_session_id: Optional[str] = Header(None),
+                                     x_classroom_id: Optional[str] = Header(None), prefer: Optional[str] = Header(None)):
+    if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
+    return await run_image_job(http_request, "generate-image", lambda: create_generated_image(request), x_session_id, x_classroom_id, prefer)
+
 @app.post("/api/generate-hints/", response_model=HintResponse)
-async def generate_hints_from_prompt(request: HintRequest):
+async def generate_hints_from_prompt(request: HintRequest, response: Response, x_cache_bypass: Optional[str] = Header(None)):
     if not OPENAI_API_KEY: raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
     try:
-        system_prompt = f"""
-        You are an AI assistant that helps a child learn prompt engineering. The user will provide a sentence they have created: "{request.prompt}". Your task is to analyze this sentence and suggest alternative or additional keywords to inspire creativity.
-        **CRITICAL INSTRUCTIONS:**
-        1.  You **MUST** generate **exactly 5 keywords** for each category: "adjectives", "verbs" (actions), and "styles" or "moods".
-        2.  The keywords must be in Korean.
-        3.  The keywords should be creative and related to the user's prompt, but do not need to be strictly derived from it. Expand on the theme.
-        4.  Your response format **MUST** be a valid JSON object with three keys: "adjectives", "verbs", "styles". Each key's value must be a list containing exactly 5 strings.
-        Example User Prompt: "숲속에서 잠자는 커다란 빨간 용"
-        Your JSON Response (MUST contain 5 items per list): {{ "adjectives": ["신비로운", "고대의", "반짝이는", "거대한", "평화로운"], "verbs": ["꿈을 꾸는", "숨 쉬는", "둥지를 튼", "조용히 기다리는", "빛을 내는"], "styles": ["수채화 스타일", "애니메이션 느낌", "밤 배경", "아침 햇살 아래", "판타지 아트"] }}
-        """
-        completion = client.chat.completions.create(model="gpt-4o", messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": request.prompt}], response_format={"type": "json_object"})
-        hint_data = json.loads(completion.choices[0].message.content)
+        prompt = normalize_text(request.prompt)
+        cache_key = make_cache_key("generate-hints", model_routes.model("generate-hints"), hint_system_prompt(prompt), prompt)
+        hint_data = None if x_cache_bypass else await response_cache.get(cache_key)
+        response.headers["X-Cache"] = "HIT" if hint_data is not None else "MISS"
+        if hint_data is None:
+            started = time.monotonic()
+            hint_data = await hint_batcher.submit(prompt)
+            if all(hint_data.get(k) for k in ("adjectives", "verbs", "styles")) and not model_routes.downgraded_since(started, "generate-hints"):
+                await response_cache.set(cache_key, hint_data)
         return HintResponse(adjectives=hint_data.get("adjectives", []), verbs=hint_data.get("verbs", []), styles=hint_data.get("styles", []))
+    except UpstreamUnavailableError:
+        raise
     except Exception as e: raise HTTPException(status_code=500, detail=f"힌트 생성 중 오류가 발생했습니다: {e}")
 
 @app.post("/api/compose-prompt/", response_model=ComposePromptResponse)
@@ -388,14 +1197,13 @@ async def compose_prompt_from_layers(request: ComposePromptRequest):
                 user_content.append({"type": "text", "text": f"Layer '{layer.name}': {layer.data}"})
             elif layer.type == 'image' and layer.data:
                 user_content.append({"type": "text", "text": f"Layer '{layer.name}' (analyze image):"})
-                user_content.append({"type": "image_url", "image_url": {"url": layer.data}})
+                user_content.append(await vision_image_part(layer.data, request.detail))
         if not user_content:
             raise HTTPException(status_code=400, detail="No content provided.")
-        gpt_response = client.chat.completions.create(
-            model="gpt-4o",
+        gpt_response = await llm.chat(
+            route="compose-prompt",
             messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}],
             response_format={"type": "json_object"},
-            max_tokens=400
         )
         response_data = json.loads(gpt_response.choices[0].message.content)
         
@@ -403,225 +1211,442 @@ async def compose_prompt_from_layers(request: ComposePromptRequest):
             dalle_prompt=response_data.get("dalle_prompt", "Error: Failed to generate DALL-E prompt."),
             korean_description=response_data.get("korean_description", "오류: 한글 설명을 생성하지 못했습니다.")
         )
+    except DrawingNotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"레이어 이미지 오류: {e}")
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=f"레이어 이미지 오류: {e}")
+    except UpstreamUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"프롬프트 조합 오류: {e}")
 
+async def render_merch_mockup(design_url: str, product: str, detail: str) -> MerchMockupResponse:
+    system_prompt = """
+    You create a realistic product mockup prompt for DALL-E 3.
+    Return ONLY a JSON object: { "prompt": "..." }
+    Rules:
+    - English only.
+    - Describe a clean studio product photo.
+    - The design must appear printed on the product.
+    - Preserve the design exactly as provided (no changes, no additions).
+    - Keep the original product composition and angle as in standard catalog mockups.
+    - Print the design flat, centered, and undistorted.
+    - Avoid extra props or background elements.
+    """
+    product_desc = "a white t-shirt" if product == "tshirt" else "a plain white mug"
+    completion = await llm.chat(
+        route="merch-mockup-prompt",
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": [
+                {"type": "text", "text": f"Product: {product_desc}"},
+                await vision_inputs.image_part(await inline_local_image(design_url), detail),
+                {"type": "text", "text": "Use the design as the print artwork. Centered on the front."}
+            ]}
+        ],
+        response_format={"type": "json_object"},
+    )
+    content = completion.choices[0].message.content
+    if not content:
+        raise ValueError("Empty response content.")
+    data = json.loads(content)
+    prompt_used = data.get("prompt")
+    if not prompt_used:
+        raise ValueError("Prompt generation failed.")
+    image_response = await llm.generate_image(
+        route="merch-mockup",
+        prompt=prompt_used,
+        n=1,
+        **image_response_format()
+    )
+    return MerchMockupResponse(image_url=await keep_generated_image(image_response.data[0]), prompt_used=prompt_used)
+
+# 같은 디자인/상품 조합의 목업은 한 번만 만들고, 연달아 누른 요청은 진행 중인 작업을 함께 기다립니다.
+merch_mockups = RenderPipeline("merch_mockup", render_merch_mockup, cacheable=lambda started: not model_routes.downgraded_since(
+    started, "merch-mockup-prompt", "merch-mockup"))
+
+async def create_merch_mockup(request: MerchMockupRequest) -> MerchMockupResponse:
+    try:
+        product = request.product.lower()
+        design_key = hashlib.sha256(request.design_url.encode("utf-8")).hexdigest()
+        return await merch_mockups.get((design_key, product, request.detail), request.design_url, product, request.detail)
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=f"디자인 이미지 오류: {e}")
+    except UpstreamUnavailableError:
+        raise
+    except Exception as e:
+        logger.exception("Merch mockup failed")
+        raise HTTPException(status_code=500, detail=f"굿즈 목업 생성 오류: {e}")
+
 @app.post("/api/generate-merch-mockup/", response_model=MerchMockupResponse)
-async def generate_merch_mockup(request: MerchMockupRequest):
+async def generate_merch_mockup(request: MerchMockupRequest, http_request: Request, x_session_id: Optional[str] = Header(None),
+                                x_classroom_id: Optional[str] = Header(None), prefer: Optional[str] = Header(None)):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
-    try:
-        system_prompt = """
-        You create a realistic product mockup prompt for DALL-E 3.
-        Return ONLY a JSON object: { "prompt": "..." }
-        Rules:
-        - English only.
-        - Describe a clean studio product photo.
-        - The design must appear printed on the product.
-        - Preserve the design exactly as provided (no changes, no additions).
-        - Keep the original product composition and angle as in standard catalog mockups.
-        - Print the design flat, centered, and undistorted.
-        - Avoid extra props or background elements.
-        """
-        product = request.product.lower()
-        product_desc = "a white t-shirt" if product == "tshirt" else "a plain white mug"
-        completion = client.chat.completions.create(
-            model="gpt-4o",
+    return await run_image_job(http_request, "merch-mockup", lambda: create_merch_mockup(request), x_session_id, x_classroom_id, prefer)
+
+EMOJI_QUIZ_TOPICS = ["Fantasy", "Space", "Ocean", "Jungle", "City", "School", "Food"]
+PUZZLE_THEMES = ["동물", "우주", "도시", "바다", "학교", "숲", "음식"]
+
+# --- 이모지 퀴즈/프롬프트 퍼즐의 구조화 출력 ---
+# 스키마가 키와 타입은 맞춰 주므로, 여기서는 개수와 값의 범위만 로컬에서 고칩니다.
+# 남는 문제/보기/블록은 자르고, 빠지거나 라벨로 채운 correctBlocks 는 다시 묻지 않고 바로잡습니다.
+# 고칠 수 없는 항목(보기가 모자라거나 correctIndex 가 범위를 벗어난 문제, 블록 종류가 빠진 레벨)만 버리고,
+# 모자란 개수만큼만 다시 요청합니다. correctIndex 는 1부터 셌는지 알 수 없어 추측해 고치지 않습니다.
+EMOJI_QUIZ_QUESTIONS, EMOJI_QUIZ_OPTIONS = 3, 4
+PUZZLE_BLOCK_TYPES = ("subject", "action", "location")
+PUZZLE_SLOTS = ["주어 (Subject)", "행동 (Action)", "장소 (Location)"]
+
+
+def first_string(value: Any) -> str:
+    cleaned = clean_strings(value)
+    return cleaned[0] if cleaned else ""
+
+def repair_emoji_question(question: Any) -> Optional[Dict]:
+    if not isinstance(question, dict) or not isinstance(question.get("options"), list):
+        return None
+    options = question["options"]
+    index = as_index(question.get("correctIndex"))
+    if index is None or not 0 <= index < len(options):
+        return None
+    correct = first_string(options[index])
+    cleaned = clean_strings(options)
+    distractors = [option for option in cleaned if option != correct][:EMOJI_QUIZ_OPTIONS - 1]
+    emojis, explanation = first_string(question.get("emojis")), first_string(question.get("explanation"))
+    if not (correct and emojis and explanation) or len(distractors) < EMOJI_QUIZ_OPTIONS - 1:
+        return None
+    # 보기 순서는 그대로 두고 정답과 오답 3개만 남깁니다.
+    kept = [option for option in cleaned if option == correct or option in distractors]
+    return {"emojis": emojis, "options": kept, "correctIndex": kept.index(correct), "explanation": explanation}
+
+def repair_emoji_quiz(data: Dict) -> List[str]:
+    questions: List[Dict] = []
+    for question in data.get("questions") if isinstance(data.get("questions"), list) else []:
+        repaired = repair_emoji_question(question)
+        if repaired is not None and all(repaired["emojis"] != kept["emojis"] for kept in questions):
+            questions.append(repaired)
+    data["questions"] = questions[:EMOJI_QUIZ_QUESTIONS]
+    return ["questions"] if len(data["questions"]) < EMOJI_QUIZ_QUESTIONS else []
+
+def repair_puzzle_level(level: Any) -> Optional[Dict]:
+    if not isinstance(level, dict):
+        return None
+    prompt_kr, theme = first_string(level.get("prompt_kr")), first_string(level.get("theme"))
+    if not (prompt_kr and theme):
+        return None
+    blocks: List[Dict] = []
+    for block in level.get("availableBlocks") if isinstance(level.get("availableBlocks"), list) else []:
+        if isinstance(block, dict):
+            text, block_type = first_string(block.get("text")), first_string(block.get("type")).lower()
+            if text and block_type in PUZZLE_BLOCK_TYPES and all(text != kept["text"] for kept in blocks):
+                blocks.append({"text": text, "type": block_type})
+    chosen = clean_strings(level.get("correctBlocks"))
+    correct_blocks, kept_texts = [], set()
+    for block_type in PUZZLE_BLOCK_TYPES:
+        candidates = [block["text"] for block in blocks if block["type"] == block_type]
+        if len(candidates) < 2:
+            return None
+        # 모델이 고른 블록 문장 -> prompt_kr 에 들어 있는 블록 -> 첫 블록 순서로 정답을 고릅니다.
+        correct = (next((text for text in chosen if text in candidates), None)
+                   or next((text for text in candidates if text in prompt_kr), None)
+                   or candidates[0])
+        correct_blocks.append(correct)
+        kept_texts.update([correct, next(text for text in candidates if text != correct)])
+    slots = clean_strings(level.get("slots"))
+    return {
+        "theme": theme,
+        "prompt_kr": prompt_kr,
+        "correctBlocks": correct_blocks,
+        "slots": slots if len(slots) == len(PUZZLE_BLOCK_TYPES) else PUZZLE_SLOTS,
+        "availableBlocks": [block for block in blocks if block["text"] in kept_texts],
+    }
+
+def puzzle_levels_repair(level_count: Optional[int], themes: Optional[List[str]]):
+    """level_count 를 주지 않으면 고칠 수 있는 레벨을 모두 남기고, 하나도 없을 때만 문제로 봅니다."""
+    def repair(data: Dict) -> List[str]:
+        levels: List[Dict] = []
+        for level in data.get("levels") if isinstance(data.get("levels"), list) else []:
+            repaired = repair_puzzle_level(level)
+            if (repaired is not None and (not themes or repaired["theme"] in themes)
+                    and all(repaired["theme"] != kept["theme"] for kept in levels)):
+                levels.append(repaired)
+        data["levels"] = levels[:level_count]
+        return ["levels"] if len(data["levels"]) < (level_count or 1) else []
+    return repair
+
+emoji_quiz_output = StructuredOutput("emoji-quiz", EmojiQuizResponse, repair_emoji_quiz)
+puzzle_output = StructuredOutput("prompt-puzzle", GeneratedPuzzleLevels, puzzle_levels_repair(None, None))
+
+async def generate_emoji_quiz_set(topic: str) -> List[Dict]:
+    system_prompt = """
+    You create emoji translation quizzes for young kids.
+    Make them clear and unambiguous, using only the necessary emojis.
+    Return ONLY a valid JSON object with this shape:
+    {
+      "questions": [
+        {
+          "emojis": "🦁 👑 🌅",
+          "options": ["...", "...", "...", "..."],
+          "correctIndex": 1,
+          "explanation": "Korean explanation"
+        }
+      ]
+    }
+    Rules:
+    - Exactly 3 questions.
+    - options must be 4 Korean strings.
+    - correctIndex is 0-3.
+    - explanation in Korean, 2-3 sentences, friendly and detailed (middle school level).
+    - Do NOT include any emojis in options or explanations.
+    - Use everyday, kid-friendly words (초등학생 수준).
+    - Use only the minimum emojis needed for a clear, specific scene (no filler emojis).
+    - Each option should be short (10-20 characters) and clearly distinct.
+    - Avoid riddles, puns, or cultural references.
+    - The correct option must be fully inferable from the emojis alone.
+    - Do NOT add extra hints, names, or context outside the emojis.
+    - Do NOT use the Lion King example.
+    """
+    def ask(user_prompt: str):
+        return lambda response_format: llm.chat(
+            route="emoji-quiz",
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": [
-                    {"type": "text", "text": f"Product: {product_desc}"},
-                    {"type": "image_url", "image_url": {"url": request.design_url}},
-                    {"type": "text", "text": "Use the design as the print artwork. Centered on the front."}
-                ]}
+                {"role": "user", "content": user_prompt}
             ],
-            response_format={"type": "json_object"},
-            max_tokens=200
+            response_format=response_format
         )
-        content = completion.choices[0].message.content
-        if not content:
-            raise ValueError("Empty response content.")
-        data = json.loads(content)
-        prompt_used = data.get("prompt")
-        if not prompt_used:
-            raise ValueError("Prompt generation failed.")
-        image_response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt_used,
-            size="1024x1024",
-            quality="standard",
-            n=1
+
+    async def reask(data: Dict, problems: List[str]):
+        missing = EMOJI_QUIZ_QUESTIONS - len(data["questions"])
+        used = ", ".join(question["emojis"] for question in data["questions"]) or "none"
+        part = await emoji_quiz_output.ask_part(
+            ask(f'Create {missing} more emoji translation quizzes about "{topic}". Do not reuse these emojis: {used}.'),
+            problems,
         )
-        return MerchMockupResponse(image_url=image_response.data[0].url, prompt_used=prompt_used)
-    except Exception as e:
-        logger.exception("Merch mockup failed")
-        raise HTTPException(status_code=500, detail=f"굿즈 목업 생성 오류: {e}")
+        data["questions"] += part.get("questions") or []
 
-@app.post("/api/emoji-quiz/", response_model=EmojiQuizResponse)
-async def generate_emoji_quiz(request: EmojiQuizRequest):
-    if not OPENAI_API_KEY:
-        raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
-    try:
-        topics = ["Fantasy", "Space", "Ocean", "Jungle", "City", "School", "Food"]
-        topic = request.topic.strip() if request.topic else random.choice(topics)
-        system_prompt = """
-        You create emoji translation quizzes for young kids.
-        Make them clear and unambiguous, using only the necessary emojis.
-        Return ONLY a valid JSON object with this shape:
+    result = await emoji_quiz_output.generate(ask(f'Create 3 fun emoji translation quizzes about "{topic}".'), reask)
+    # 풀에 넣을 수 있는 순수 dict로 돌려줍니다.
+    return [question.model_dump() for question in result.questions]
+
+async def generate_puzzle_levels(level_count: int, themes: Optional[List[str]] = None) -> List[Dict]:
+    system_prompt = """
+    You design prompt puzzle levels for kids.
+    Return ONLY a valid JSON object with this shape but don't use this:
+    {
+      "levels": [
         {
-          "questions": [
-            {
-              "emojis": "🦁 👑 🌅",
-              "options": ["...", "...", "...", "..."],
-              "correctIndex": 1,
-              "explanation": "Korean explanation"
-            }
+          "theme": "동물",
+          "prompt_kr": "숲속에서 작은 토끼가 뛰고 있는 장면",
+          "correctBlocks": ["subject", "action", "location"],
+          "slots": ["주어 (Subject)", "행동 (Action)", "장소 (Location)"],
+          "availableBlocks": [
+            {"text": "...", "type": "subject"},
+            {"text": "...", "type": "subject"},
+            {"text": "...", "type": "action"},
+            {"text": "...", "type": "action"},
+            {"text": "...", "type": "location"},
+            {"text": "...", "type": "location"}
           ]
         }
-        Rules:
-        - Exactly 3 questions.
-        - options must be 4 Korean strings.
-        - correctIndex is 0-3.
-        - explanation in Korean, 2-3 sentences, friendly and detailed (middle school level).
-        - Do NOT include any emojis in options or explanations.
-        - Use everyday, kid-friendly words (초등학생 수준).
-        - Use only the minimum emojis needed for a clear, specific scene (no filler emojis).
-        - Each option should be short (10-20 characters) and clearly distinct.
-        - Avoid riddles, puns, or cultural references.
-        - The correct option must be fully inferable from the emojis alone.
-        - Do NOT add extra hints, names, or context outside the emojis.
-        - Do NOT use the Lion King example.
-        """
-        user_prompt = f'Create 3 fun emoji translation quizzes about "{topic}".'
-        completion = client.chat.completions.create(
-            model="gpt-4o",
+      ]
+    }
+    Rules:
+    - Exactly {{level_count}} levels.
+    - All text in Korean.
+    - Each level must have a different theme from this list: 동물, 우주, 도시, 바다, 학교, 숲, 음식.
+    - Include a "theme" field per level.
+    - Include a "prompt_kr" full sentence per level.
+    - availableBlocks must contain exactly 2 per type.
+    - correctBlocks must be the exact text strings from availableBlocks (not labels like "subject").
+    - correctBlocks must match one block from each type and must be extracted from prompt_kr.
+    - availableBlocks must include the correct blocks plus one distractor per type.
+    - Do not reuse the same block text across levels.
+    """
+    def ask(count: int, level_themes: Optional[List[str]], avoid: Optional[List[str]] = None):
+        user_prompt = f"Create {count} levels with different themes and unique blocks."
+        if level_themes:
+            user_prompt += f" Use exactly these themes, one per level: {', '.join(level_themes)}."
+        if avoid:
+            user_prompt += f" Do not use these themes: {', '.join(avoid)}."
+        return lambda response_format: llm.chat(
+            route="prompt-puzzle",
             messages=[
-                {"role": "system", "content": system_prompt},
+                {"role": "system", "content": system_prompt.replace("{{level_count}}", str(count))},
                 {"role": "user", "content": user_prompt}
             ],
-            response_format={"type": "json_object"}
+            response_format=response_format
         )
-        response_data = json.loads(completion.choices[0].message.content)
-        questions = response_data.get("questions", [])
-        if not questions:
-            raise ValueError("Empty emoji quiz response.")
+
+    async def reask(data: Dict, problems: List[str]):
+        done = [level["theme"] for level in data["levels"]]
+        missing = [theme for theme in themes if theme not in done] if themes else None
+        count = len(missing) if missing else level_count - len(done)
+        part = await puzzle_output.ask_part(ask(count, missing, done), problems)
+        data["levels"] += part.get("levels") or []
+
+    result = await puzzle_output.generate(ask(level_count, themes), reask, puzzle_levels_repair(level_count, themes))
+    return [level.model_dump() for level in result.levels]
+
+async def produce_emoji_quiz_sets(topics: List[str]) -> List[tuple]:
+    results = await asyncio.gather(*(generate_emoji_quiz_set(topic) for topic in topics), return_exceptions=True)
+    return [(topic, result) for topic, result in zip(topics, results) if not isinstance(result, Exception)]
+
+async def produce_puzzle_levels(themes: List[str]) -> List[tuple]:
+    levels = await generate_puzzle_levels(len(themes), themes)
+    return [(level["theme"], level) for level in levels]
+
+emoji_quiz_pool = ContentPool("emoji_quiz", EMOJI_QUIZ_TOPICS, produce_emoji_quiz_sets, state=shared_state)
+prompt_puzzle_pool = ContentPool("prompt_puzzle", PUZZLE_THEMES, produce_puzzle_levels, state=shared_state)
+
+@app.get("/api/pool-stats/")
+def read_pool_stats():
+    return {
+        "emoji_quiz": emoji_quiz_pool.stats(),
+        "prompt_puzzle": prompt_puzzle_pool.stats(),
+        "prompt_puzzle_image": puzzle_images.stats(),
+        "merch_mockup": merch_mockups.stats(),
+    }
+
+@app.get("/api/routing-stats/")
+def read_routing_stats():
+    return model_routes.stats()
+
+@app.get("/api/structured-output-stats/")
+def read_structured_output_stats():
+    return {output.name: output.stats() for output in (keyword_output, hint_output, emoji_quiz_output, puzzle_output)}
+
+@app.post("/api/emoji-quiz/", response_model=EmojiQuizResponse)
+async def generate_emoji_quiz(request: EmojiQuizRequest, x_session_id: Optional[str] = Header(None)):
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
+    try:
+        requested_topic = request.topic.strip() if request.topic else ""
+        pooled = emoji_quiz_pool.take([requested_topic] if requested_topic else EMOJI_QUIZ_TOPICS, x_session_id)
+        if pooled is not None:
+            return EmojiQuizResponse(questions=pooled[1])
+        topic = requested_topic or random.choice(EMOJI_QUIZ_TOPICS)
+        questions = await generate_emoji_quiz_set(topic)
+        emoji_quiz_pool.add(topic, questions, x_session_id)
         return EmojiQuizResponse(questions=questions)
+    except UpstreamUnavailableError:
+        # OpenAI가 불안정하면 이 아이가 이미 본 퀴즈라도 풀에서 다시 내어 줍니다.
+        pooled = emoji_quiz_pool.take(EMOJI_QUIZ_TOPICS)
+        if pooled is None:
+            raise
+        return EmojiQuizResponse(questions=pooled[1])
     except Exception as e:
         logger.exception("Emoji quiz failed")
         raise HTTPException(status_code=500, detail=f"이모지 퀴즈 생성 오류: {e}")
 
 @app.post("/api/prompt-puzzle/", response_model=PromptPuzzleResponse)
-async def generate_prompt_puzzle(request: PromptPuzzleRequest):
+async def generate_prompt_puzzle(request: PromptPuzzleRequest, x_session_id: Optional[str] = Header(None)):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
     try:
         level_count = max(2, min(request.level_count or 2, 5))
-        system_prompt = """
-        You design prompt puzzle levels for kids.
-        Return ONLY a valid JSON object with this shape but don't use this:
-        {
-          "levels": [
-            {
-              "theme": "동물",
-              "prompt_kr": "숲속에서 작은 토끼가 뛰고 있는 장면",
-              "correctBlocks": ["subject", "action", "location"],
-              "slots": ["주어 (Subject)", "행동 (Action)", "장소 (Location)"],
-              "availableBlocks": [
-                {"text": "...", "type": "subject"},
-                {"text": "...", "type": "subject"},
-                {"text": "...", "type": "action"},
-                {"text": "...", "type": "action"},
-                {"text": "...", "type": "location"},
-                {"text": "...", "type": "location"}
-              ]
-            }
-          ]
-        }
-        Rules:
-        - Exactly {{level_count}} levels.
-        - All text in Korean.
-        - Each level must have a different theme from this list: 동물, 우주, 도시, 바다, 학교, 숲, 음식.
-        - Include a "theme" field per level.
-        - Include a "prompt_kr" full sentence per level.
-        - availableBlocks must contain exactly 2 per type.
-        - correctBlocks must be the exact text strings from availableBlocks (not labels like "subject").
-        - correctBlocks must match one block from each type and must be extracted from prompt_kr.
-        - availableBlocks must include the correct blocks plus one distractor per type.
-        - Do not reuse the same block text across levels.
-        """
-        user_prompt = f"Create {level_count} levels with different themes and unique blocks."
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_prompt.replace("{{level_count}}", str(level_count))},
-                {"role": "user", "content": user_prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
-        response_data = json.loads(completion.choices[0].message.content)
-        levels = response_data.get("levels", [])
-        if not levels:
-            raise ValueError("Empty prompt puzzle response.")
-        for level in levels:
-            prompt_kr = level.get("prompt_kr", "")
-            available = level.get("availableBlocks", [])
-            def pick_block(block_type: str) -> str:
-                for block in available:
-                    if block.get("type") == block_type and block.get("text") and block["text"] in prompt_kr:
-                        return block["text"]
-                for block in available:
-                    if block.get("type") == block_type and block.get("text"):
-                        return block["text"]
-                return ""
-            subject = pick_block("subject")
-            action = pick_block("action")
-            location = pick_block("location")
-            if subject and action and location:
-                level["correctBlocks"] = [subject, action, location]
+        levels = prompt_puzzle_pool.take_distinct(level_count, x_session_id)
+        if len(levels) < level_count:
+            # 풀에 남은 레벨이 부족하면 모자란 만큼만 바로 생성합니다.
+            used_themes = {level["theme"] for level in levels}
+            missing_themes = [theme for theme in PUZZLE_THEMES if theme not in used_themes][: level_count - len(levels)]
+            fresh_levels = await generate_puzzle_levels(len(missing_themes), missing_themes)
+            for level in fresh_levels:
+                prompt_puzzle_pool.add(level["theme"], level, x_session_id)
+            levels += fresh_levels
+        levels = levels[:level_count]
+        prefetch_puzzle_images(levels)
         return PromptPuzzleResponse(levels=levels)
+    except UpstreamUnavailableError:
+        fallback_levels = prompt_puzzle_pool.take_distinct(level_count)
+        if not fallback_levels:
+            raise
+        return PromptPuzzleResponse(levels=fallback_levels)
     except Exception as e:
         logger.exception("Prompt puzzle failed")
         raise HTTPException(status_code=500, detail=f"프롬프트 탐정 생성 오류: {e}")
 
-@app.post("/api/prompt-puzzle-image/", response_model=PromptPuzzleImageResponse)
-async def generate_prompt_puzzle_image(request: PromptPuzzleImageRequest):
-    if not OPENAI_API_KEY:
-        raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
+async def render_puzzle_image(prompt_kr: str, subject: str, action: str, location: str) -> Dict[str, str]:
+    system_prompt = """
+    You create a strict DALL-E 3 prompt for a kids' illustration.
+    Only include the given subject, action, and location. Do NOT add extra objects or context.
+    Return ONLY a JSON object: { "prompt": "..." }
+    Rules:
+    - Must be English.
+    - Start with: "A simple, clean, cute children's book illustration of..."
+    - Include subject, action, and location explicitly.
+    - Plain white background unless location implies a simple setting.
+    - No extra characters, props, or scenery.
+    """
+    user_prompt = f'Korean prompt: "{prompt_kr}" | Subject: "{subject}" | Action: "{action}" | Location: "{location}"'
+    completion = await llm.chat(
+        route="prompt-puzzle-image-prompt",
+        messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
+        response_format={"type": "json_object"},
+    )
+    response_data = json.loads(completion.choices[0].message.content)
+    prompt_used = response_data.get("prompt")
+    if not prompt_used:
+        raise ValueError("Prompt refine failed.")
+    image_response = await llm.generate_image(
+        route="prompt-puzzle-image",
+        prompt=prompt_used,
+        n=1,
+        **image_response_format()
+    )
+    return {"image_url": await keep_generated_image(image_response.data[0]), "prompt_used": prompt_used}
+
+# (주어, 행동, 장소)별로 한 번만 렌더링합니다. 퍼즐 레벨을 내려줄 때 정답 조합을 미리 그려 둡니다.
+puzzle_images = RenderPipeline("prompt_puzzle_image", render_puzzle_image, cacheable=lambda started: not model_routes.downgraded_since(
+    started, "prompt-puzzle-image-prompt", "prompt-puzzle-image"))
+
+def prefetch_puzzle_images(levels: List[Dict]):
+    if not PUZZLE_IMAGE_PREFETCH:
+        return
+    for level in levels:
+        blocks = level.get("correctBlocks") or []
+        if len(blocks) == 3 and all(blocks):
+            subject, action, location = blocks
+            puzzle_images.prefetch((subject, action, location), level.get("prompt_kr", ""), subject, action, location)
+
+async def create_prompt_puzzle_image(request: PromptPuzzleImageRequest) -> PromptPuzzleImageResponse:
     try:
-        system_prompt = """
-        You create a strict DALL-E 3 prompt for a kids' illustration.
-        Only include the given subject, action, and location. Do NOT add extra objects or context.
-        Return ONLY a JSON object: { "prompt": "..." }
-        Rules:
-        - Must be English.
-        - Start with: "A simple, clean, cute children's book illustration of..."
-        - Include subject, action, and location explicitly.
-        - Plain white background unless location implies a simple setting.
-        - No extra characters, props, or scenery.
-        """
-        user_prompt = f'Korean prompt: "{request.prompt_kr}" | Subject: "{request.subject}" | Action: "{request.action}" | Location: "{request.location}"'
-        completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}],
-            response_format={"type": "json_object"},
-            max_tokens=120
-        )
-        response_data = json.loads(completion.choices[0].message.content)
-        prompt_used = response_data.get("prompt")
-        if not prompt_used:
-            raise ValueError("Prompt refine failed.")
-        image_response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt_used,
-            size="1024x1024",
-            quality="standard",
-            n=1
+        # 미리 시작된(또는 다른 요청이 진행 중인) 렌더링이 있으면 그 결과를 함께 받습니다.
+        result = await puzzle_images.get(
+            (request.subject, request.action, request.location),
+            request.prompt_kr, request.subject, request.action, request.location
         )
         return PromptPuzzleImageResponse(
-            image_url=image_response.data[0].url,
-            prompt_used=prompt_used,
+            image_url=result["image_url"],
+            prompt_used=result["prompt_used"],
             prompt_used_kr=request.prompt_kr
         )
+    except UpstreamUnavailableError:
+        raise
     except Exception as e:
         logger.exception("Prompt puzzle image failed")
         raise HTTPException(status_code=500, detail=f"프롬프트 탐정 이미지 오류: {e}")
+
+@app.post("/api/prompt-puzzle-image/", response_model=PromptPuzzleImageResponse)
+async def generate_prompt_puzzle_image(request: PromptPuzzleImageRequest, http_request: Request, x_session_id: Optional[str] = Header(None),
+                                       x_classroom_id: Optional[str] = Header(None), prefer: Optional[str] = Header(None)):
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=500, detail="OpenAI API 키가 설정되지 않았습니다.")
+    return await run_image_job(http_request, "prompt-puzzle-image", lambda: create_prompt_puzzle_image(request), x_session_id, x_classroom_id, prefer)
+
+# --- 지표: Prometheus 텍스트 형식 ---
+metrics_registry.gauge_collector("prompe_response_cache", "Response cache counters.", lambda: flatten_stats(response_cache.stats()))
+metrics_registry.gauge_collector("prompe_llm_gateway", "LLM gateway counters.", lambda: flatten_stats(llm.stats()))
+metrics_registry.gauge_collector("prompe_batchers", "Micro-batcher counters.", lambda: flatten_stats(read_batch_stats()))
+metrics_registry.gauge_collector("prompe_model_routes", "Model routing tiers, downgrades and per-tier latency.", lambda: flatten_stats(model_routes.stats()))
+metrics_registry.gauge_collector("prompe_structured_outputs", "Structured output repairs, re-asks and wasted tokens.", lambda: flatten_stats(read_structured_output_stats()))
+metrics_registry.gauge_collector("prompe_image_jobs", "Image job queue depth and outcomes.", lambda: flatten_stats(image_jobs.stats()))
+metrics_registry.gauge_collector("prompe_db_writes", "Group commit counters.", lambda: flatten_stats(db_writes.stats()))
+metrics_registry.gauge_collector("prompe_chat_sessions", "Server-side chat session counters.", lambda: flatten_stats(chat_sessions.stats()))
+metrics_registry.gauge_collector("prompe_drawings", "Drawing upload handle counters.", lambda: flatten_stats(drawings.stats()))
+metrics_registry.gauge_collector("prompe_startup", "Startup and warm-up timings.", lambda: flatten_stats(startup_stats))
+metrics_registry.gauge_collector("prompe_pools", "Content pool and render pipeline counters.", lambda: flatten_stats(read_pool_stats()))
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    return Response(metrics_registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
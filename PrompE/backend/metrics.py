@@ -0,0 +1,222 @@
+# --- 지표 수집 ---
+# 요청 지연 시간, 첫 바이트까지 걸린 시간(TTFB), OpenAI 호출 지연/토큰/이미지 수, 오류 종류 등을 모아
+# /metrics 에서 Prometheus 텍스트 형식으로 내보냅니다.
+# METRICS_TRACE_SAMPLE_RATE 를 0보다 크게 주면 그 비율만큼의 요청에 대해 요청별 추적 로그를 남깁니다.
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+METRICS_TRACE_SAMPLE_RATE = float(os.getenv("METRICS_TRACE_SAMPLE_RATE", "0"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+logger = logging.getLogger("uvicorn.error")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._series: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels(labels)
+        with self._lock:
+            # [버킷별 개수..., +Inf 개수, 합계]
+            series = self._series.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            series[bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(labels, [('le', repr(bound))])} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Tuple[str, str, Callable[[], Dict[str, float]]]] = []
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        metric = Counter(name, help_text)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge_collector(self, name: str, help_text: str, collect: Callable[[], Dict[str, float]]):
+        """스크레이프할 때 collect()를 불러 {라벨값: 값} 을 게이지로 내보냅니다 (라벨 이름은 "key")."""
+        self._collectors.append((name, help_text, collect))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help_text, collect in self._collectors:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            try:
+                values = collect()
+            except Exception:
+                logger.exception("Metrics collector %s failed", name)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)):
+                    lines.append(f"{name}{_format_labels((('key', str(key)),))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def flatten_stats(stats: Dict, prefix: str = "") -> Dict[str, float]:
+    """각 모듈의 stats() 딕셔너리를 "a.b" 키의 숫자 값으로 펼칩니다."""
+    flat: Dict[str, float] = {}
+    for key, value in stats.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten_stats(value, f"{name}."))
+        elif isinstance(value, (bool, int, float)):
+            flat[name] = float(value)
+    return flat
+
+
+registry = Registry()
+
+http_request_seconds = registry.histogram("prompe_http_request_duration_seconds", "HTTP request latency by route.")
+http_ttfb_seconds = registry.histogram("prompe_http_time_to_first_byte_seconds", "Time until the first response body byte was sent.")
+http_requests_total = registry.counter("prompe_http_requests_total", "HTTP requests by route and status.")
+openai_request_seconds = registry.histogram("prompe_openai_request_duration_seconds", "Upstream OpenAI call latency.")
+openai_ttft_seconds = registry.histogram("prompe_openai_time_to_first_token_seconds", "Streaming time to first token.")
+openai_tokens_total = registry.counter("prompe_openai_tokens_total", "Prompt/completion tokens reported by completion.usage.")
+openai_images_total = registry.counter("prompe_openai_images_total", "Generated images by model.")
+openai_errors_total = registry.counter("prompe_openai_errors_total", "Upstream OpenAI errors by class.")
+image_fallbacks_total = registry.counter("prompe_image_fallbacks_total", "Image requests that fell back to dall-e-3.")
+
+
+# --- 요청별 추적 (샘플링) ---
+_current_trace: contextvars.ContextVar[Optional[Dict]] = contextvars.ContextVar("prompe_trace", default=None)
+
+
+def record_upstream(kind: str, model: str, seconds: float, usage=None, error: Optional[BaseException] = None, images: int = 0):
+    labels = {"kind": kind, "model": model or "unknown"}
+    openai_request_seconds.observe(seconds, **labels)
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+    if prompt_tokens:
+        openai_tokens_total.inc(prompt_tokens, model=labels["model"], type="prompt")
+    if completion_tokens:
+        openai_tokens_total.inc(completion_tokens, model=labels["model"], type="completion")
+    if images:
+        openai_images_total.inc(images, model=labels["model"])
+    if error is not None:
+        openai_errors_total.inc(kind=kind, model=labels["model"], error=type(error).__name__)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace["upstream"].append({
+            "kind": kind,
+            "model": labels["model"],
+            "ms": round(seconds * 1000, 1),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "error": type(error).__name__ if error is not None else None,
+        })
+
+
+class MetricsMiddleware:
+    """순수 ASGI 미들웨어. 스트리밍 응답도 본문 첫 바이트 시점을 잴 수 있습니다."""
+
+    def __init__(self, app, sample_rate: float = METRICS_TRACE_SAMPLE_RATE):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        state = {"status": 500, "ttfb": None}
+        trace = {"upstream": []} if self.sample_rate and random.random() < self.sample_rate else None
+        token = _current_trace.set(trace)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+            elif message["type"] == "http.response.body" and state["ttfb"] is None and (message.get("body") or not message.get("more_body")):
+                # 스트리밍 응답은 헤더가 먼저 나가므로 본문 첫 바이트를 기준으로 잽니다.
+                state["ttfb"] = time.perf_counter() - started
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current_trace.reset(token)
+            elapsed = time.perf_counter() - started
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"
+            labels = {"method": scope["method"], "route": path}
+            http_request_seconds.observe(elapsed, **labels)
+            if state["ttfb"] is not None:
+                http_ttfb_seconds.observe(state["ttfb"], **labels)
+            http_requests_total.inc(status=str(state["status"]), **labels)
+            if trace is not None:
+                logger.info("trace %s", json.dumps({
+                    **labels,
+                    "status": state["status"],
+                    "ms": round(elapsed * 1000, 1),
+                    "ttfb_ms": round((state["ttfb"] or elapsed) * 1000, 1),
+                    "upstream": trace["upstream"],
+                }, ensure_ascii=False))
@@ -0,0 +1,17 @@
+# --- 저장 경로 ---
+# DB, uploads/, 그림 핸들, 콘텐츠 풀 등 파일을 두는 곳을 모두 PROMPE_DATA_DIR(기본: 시작한 작업 디렉터리) 아래의
+# 절대 경로로 정합니다. 여러 워커를 띄우거나 다른 디렉터리에서 실행해도 모두 같은 파일을 보게 됩니다.
+# 각 경로는 해당 환경 변수로 바꿀 수 있고, 상대 경로를 주면 PROMPE_DATA_DIR 기준으로 풉니다.
+import os
+
+
+DATA_DIR = os.path.abspath(os.path.expanduser(os.getenv("PROMPE_DATA_DIR", ".")))
+
+
+def resolve_data_path(path: str) -> str:
+    return os.path.normpath(os.path.join(DATA_DIR, os.path.expanduser(path)))
+
+
+def data_path(env_name: str, default: str) -> str:
+    """환경 변수 env_name 의 값(없으면 default)을 DATA_DIR 기준 절대 경로로 돌려줍니다."""
+    return resolve_data_path(os.getenv(env_name) or default)
@@ -0,0 +1,92 @@
+# --- 이미지 생성 파이프라인 ---
+# "gpt-4o 프롬프트 다듬기 → DALL-E 렌더링" 두 단계 작업을 키별로 한 번만 실행합니다.
+# - prefetch(): 결과가 필요해지기 전에 백그라운드에서 미리 시작합니다 (추측 실행).
+# - get(): 완료된 결과나 진행 중인 작업을 그대로 돌려받습니다. 같은 키의 동시 요청은 하나의 작업을 공유합니다.
+# 임시 URL을 돌려주는 경우(IMAGE_EAGER_PERSIST=0) DALL-E URL은 약 1시간 뒤 만료되므로 완료된 결과는 그보다 짧게만 보관합니다.
+# get() 으로 시작한 작업은 기다리는 요청이 모두 끊기면 (예: 이미지 작업 취소) 렌더링도 취소합니다. prefetch() 로 시작한 작업은
+# 아무도 기다리지 않아도 끝까지 그립니다.
+# cacheable(시작 시각)이 False 인 결과(예: 강등된 티어로 만든 것)는 함께 기다리던 요청에만 주고 보관하지 않습니다.
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, List
+
+
+RENDER_RESULT_TTL = float(os.getenv("RENDER_RESULT_TTL", str(50 * 60)))
+RENDER_MAX_ENTRIES = 512
+RENDER_PREFETCH_CONCURRENCY = int(os.getenv("RENDER_PREFETCH_CONCURRENCY", "4"))
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class RenderPipeline:
+    def __init__(self, name: str, render: Callable[..., Awaitable[Any]],
+                 ttl: float = RENDER_RESULT_TTL, prefetch_concurrency: int = RENDER_PREFETCH_CONCURRENCY,
+                 cacheable: Callable[[float], bool] = lambda started: True):
+        self.name = name
+        self.render = render
+        self.ttl = ttl
+        self.cacheable = cacheable
+        # 키 -> [작업, 시작 시각, 완료 후 보관할지, 기다리는 요청 수 (prefetch 는 1로 시작해 취소되지 않음)]
+        self._jobs: "OrderedDict[Hashable, List]" = OrderedDict()
+        self._prefetch_slots = asyncio.Semaphore(prefetch_concurrency)
+        self.started = 0
+        self.shared = 0
+        self.prefetched = 0
+
+    def _lookup(self, key: Hashable):
+        entry = self._jobs.get(key)
+        if entry is None:
+            return None
+        job, created_at, keep, _ = entry
+        if job.done() and (job.cancelled() or job.exception() is not None or not keep or time.monotonic() - created_at > self.ttl):
+            del self._jobs[key]
+            return None
+        self._jobs.move_to_end(key)
+        return entry
+
+    def _start(self, key: Hashable, coro, waiters: int = 0) -> List:
+        job = asyncio.ensure_future(coro)
+        # 아무도 기다리지 않는 추측 작업이 실패해도 "never retrieved" 경고가 남지 않게 합니다.
+        job.add_done_callback(lambda f: f.cancelled() or f.exception())
+        entry = [job, time.monotonic(), True, waiters]
+        job.add_done_callback(lambda f: entry.__setitem__(2, self.cacheable(entry[1])))
+        self._jobs[key] = entry
+        while len(self._jobs) > RENDER_MAX_ENTRIES:
+            self._jobs.popitem(last=False)
+        self.started += 1
+        return entry
+
+    async def _prefetch(self, *args):
+        async with self._prefetch_slots:
+            return await self.render(*args)
+
+    def prefetch(self, key: Hashable, *args):
+        if self._lookup(key) is None:
+            self.prefetched += 1
+            self._start(key, self._prefetch(*args), waiters=1)
+
+    async def get(self, key: Hashable, *args) -> Any:
+        entry = self._lookup(key)
+        if entry is None:
+            entry = self._start(key, self.render(*args))
+        else:
+            self.shared += 1
+        job = entry[0]
+        entry[3] += 1
+        try:
+            # 한 요청이 끊겨도 같은 작업을 기다리는 다른 요청은 계속 받을 수 있도록 shield 합니다.
+            return await asyncio.shield(job)
+        except asyncio.CancelledError:
+            entry[3] -= 1
+            if not entry[3] and not job.done():
+                # 취소 중인 작업을 새 요청이 이어받지 않도록 바로 뺍니다.
+                if self._jobs.get(key) is entry:
+                    del self._jobs[key]
+                job.cancel()
+            raise
+
+    def stats(self):
+        return {"started": self.started, "shared": self.shared, "prefetched": self.prefetched, "entries": len(self._jobs)}
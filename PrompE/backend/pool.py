@@ -0,0 +1,226 @@
+# --- 미리 생성해 두는 콘텐츠 풀 ---
+# 이모지 퀴즈/프롬프트 탐정처럼 주제(키)별로만 달라지는 콘텐츠를 키마다 K개씩 준비해 두고,
+# 요청이 오면 풀에서 바로 꺼내 줍니다. 개수가 low-water 아래로 떨어지면 백그라운드 작업이 다시 채웁니다.
+# 같은 세션(아이)에게는 이미 본 항목을 다시 주지 않습니다.
+# 워커가 여럿이면 공유 잠금으로 한 번에 한 워커만 보충하고, 나머지는 그 워커가 저장한 파일을 읽어 채웁니다.
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from paths import data_path
+from shared_state import SharedState
+
+
+CONTENT_POOL_SIZE = int(os.getenv("CONTENT_POOL_SIZE", "6"))
+CONTENT_POOL_LOW_WATER = int(os.getenv("CONTENT_POOL_LOW_WATER", "2"))
+CONTENT_POOL_MAX_USES = int(os.getenv("CONTENT_POOL_MAX_USES", "30"))
+CONTENT_POOL_DIR = data_path("CONTENT_POOL_DIR", "content_pool")
+MAX_TRACKED_SESSIONS = 5000
+REFILL_RETRY_DELAY = 30.0
+REFILL_LOCK_TTL = 300.0
+
+logger = logging.getLogger("uvicorn.error")
+
+# producer(keys) -> [(key, item), ...]
+Producer = Callable[[List[str]], Awaitable[List[Tuple[str, Any]]]]
+
+
+def _item_id(item: Any) -> str:
+    encoded = json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+class ContentPool:
+    def __init__(self, name: str, keys: Sequence[str], producer: Producer,
+                 size: int = CONTENT_POOL_SIZE, low_water: int = CONTENT_POOL_LOW_WATER,
+                 max_uses: int = CONTENT_POOL_MAX_USES, directory: str = CONTENT_POOL_DIR,
+                 state: Optional[SharedState] = None):
+        self.name = name
+        self.keys = list(keys)
+        self.producer = producer
+        self.size = size
+        self.low_water = low_water
+        self.max_uses = max_uses
+        self.path = os.path.join(directory, f"{name}.json")
+        self.state = state
+        self._entries: Dict[str, List[Dict[str, Any]]] = {key: [] for key in self.keys}
+        self._seen: "OrderedDict[str, Set[str]]" = OrderedDict()
+        self._filling: Set[str] = set()
+        self._retired: Set[str] = set()
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.served = 0
+        self.misses = 0
+
+    # --- 세션별 중복 방지 ---
+    def _seen_by(self, session_id: Optional[str]) -> Set[str]:
+        if not session_id:
+            return set()
+        seen = self._seen.get(session_id)
+        if seen is None:
+            seen = self._seen[session_id] = set()
+            while len(self._seen) > MAX_TRACKED_SESSIONS:
+                self._seen.popitem(last=False)
+        else:
+            self._seen.move_to_end(session_id)
+        return seen
+
+    def _pop_unseen(self, key: str, seen: Set[str]) -> Optional[Any]:
+        entries = self._entries.get(key, [])
+        for index, entry in enumerate(entries):
+            if entry["id"] in seen:
+                continue
+            entry["uses"] += 1
+            seen.add(entry["id"])
+            if entry["uses"] >= self.max_uses:
+                entries.pop(index)
+                self._retired.add(entry["id"])
+            if len(entries) < self.low_water:
+                self._filling.add(key)
+                self._wake.set()
+            return entry["item"]
+        return None
+
+    def take(self, keys: Sequence[str], session_id: Optional[str] = None) -> Optional[Tuple[str, Any]]:
+        """주어진 키들 중(무작위 순서) 이 세션이 아직 보지 않은 항목 하나를 꺼냅니다."""
+        seen = self._seen_by(session_id)
+        for key in random.sample(list(keys), len(keys)):
+            item = self._pop_unseen(key, seen)
+            if item is not None:
+                self.served += 1
+                return key, item
+        self.misses += 1
+        return None
+
+    def take_distinct(self, count: int, session_id: Optional[str] = None) -> List[Any]:
+        """서로 다른 키에서 최대 count개의 항목을 꺼냅니다."""
+        seen = self._seen_by(session_id)
+        items = []
+        for key in random.sample(self.keys, len(self.keys)):
+            if len(items) >= count:
+                break
+            item = self._pop_unseen(key, seen)
+            if item is not None:
+                items.append(item)
+        self.served += len(items)
+        self.misses += count - len(items)
+        return items
+
+    def add(self, key: str, item: Any, session_id: Optional[str] = None):
+        if key not in self._entries:
+            return
+        item_id = _item_id(item)
+        if session_id:
+            self._seen_by(session_id).add(item_id)
+        entries = self._entries[key]
+        if len(entries) >= self.size or any(entry["id"] == item_id for entry in entries):
+            return
+        entries.append({"id": item_id, "item": item, "uses": 0})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "served": self.served,
+            "misses": self.misses,
+            "available": {key: len(entries) for key, entries in self._entries.items()},
+        }
+
+    # --- 디스크 저장/복원 ---
+    def _read(self) -> Dict[str, List[Dict[str, Any]]]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logger.exception("Failed to load content pool %s", self.name)
+        return {}
+
+    def load(self):
+        for key, entries in self._read().items():
+            if key in self._entries:
+                self._entries[key] = entries[: self.size]
+        for key, entries in self._entries.items():
+            if len(entries) < self.low_water:
+                self._filling.add(key)
+
+    def _write(self, snapshot: str):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # 워커마다 따로 보충해 같은 파일에 쓰므로 임시 파일 이름이 겹치지 않게 합니다.
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+        os.replace(tmp_path, self.path)
+
+    async def save(self):
+        snapshot = json.dumps(self._entries, ensure_ascii=False)
+        await asyncio.to_thread(self._write, snapshot)
+
+    async def merge_saved(self):
+        """다른 워커가 보충해 저장한 항목을 합칩니다. 이 워커에서 다 쓴(max_uses) 항목은 되살리지 않습니다."""
+        for key, entries in (await asyncio.to_thread(self._read)).items():
+            current = self._entries.get(key)
+            if current is None:
+                continue
+            ids = {entry["id"] for entry in current} | self._retired
+            for entry in entries:
+                if len(current) >= self.size:
+                    break
+                if entry["id"] not in ids:
+                    current.append({**entry, "uses": 0})
+                    ids.add(entry["id"])
+
+    # --- 백그라운드 보충 ---
+    async def _refill(self, needy: List[str]):
+        for key, item in await self.producer(needy):
+            self.add(key, item)
+        await self.save()
+
+    async def _refill_shared(self, needy: List[str]):
+        # 잠금을 기다리는 동안 다른 워커가 채웠을 수 있으므로 저장된 파일을 먼저 합치고, 그래도 모자란 키만 만듭니다.
+        async with self.state.lock(f"content-pool:{self.name}", ttl=REFILL_LOCK_TTL):
+            await self.merge_saved()
+            needy = [key for key in needy if len(self._entries[key]) < self.size]
+            if needy:
+                await self._refill(needy)
+
+    async def _refill_forever(self):
+        while True:
+            needy = [key for key in self.keys if key in self._filling]
+            if not needy:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            before = sum(len(self._entries[key]) for key in needy)
+            try:
+                if self.state is not None and self.state.shared:
+                    await self._refill_shared(needy)
+                else:
+                    await self._refill(needy)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Content pool %s refill failed", self.name)
+            if sum(len(self._entries[key]) for key in needy) == before:
+                # 실패했거나 새 항목이 하나도 없으면 잠시 쉬었다가 다시 시도합니다.
+                await asyncio.sleep(REFILL_RETRY_DELAY)
+            for key in needy:
+                if len(self._entries[key]) >= self.size:
+                    self._filling.discard(key)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refill_forever())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
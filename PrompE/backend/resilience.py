@@ -0,0 +1,283 @@
+# --- OpenAI 호출 보호 계층 ---
+# 조직의 RPM/TPM 한도에 맞춘 토큰 버킷으로 호출 속도를 고르게 하고,
+# 429/5xx/연결 오류는 Retry-After 를 따르거나 지터를 섞은 지수 백오프로 다시 시도합니다.
+# 실패가 이어지면 서킷 브레이커가 열려 잠시 동안 곧바로 실패시키고(503), 이후 한 번의 시험 호출로 회복을 확인합니다.
+# 버킷 앞에서 너무 오래 기다려야 하는 요청은 큐에 쌓지 않고 바로 거절(shed)합니다.
+# 공유 상태(shared_state.py)를 주면 여러 워커가 한 버킷을 나눠 써서, 워커 수와 상관없이 조직 한도를 지킵니다.
+# openai 패키지는 불러오는 데 오래 걸리므로 오류를 분류할 때(이미 호출이 한 번 나간 뒤)에만 불러옵니다.
+import asyncio
+import email.utils
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from shared_state import SharedState
+
+
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "30000"))
+OPENAI_IMAGE_RPM = int(os.getenv("OPENAI_IMAGE_RPM", "50"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "20"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "30"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "256"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+
+class UpstreamUnavailableError(Exception):
+    """OpenAI를 지금 호출할 수 없는 경우. retry_after 초 뒤에 다시 시도하면 됩니다."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamUnavailableError):
+    pass
+
+
+class UpstreamOverloadedError(UpstreamUnavailableError):
+    pass
+
+
+def is_retryable(error: BaseException) -> bool:
+    import openai
+
+    if isinstance(error, openai.RateLimitError):
+        # 크레딧 소진은 기다려도 풀리지 않습니다.
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def is_request_rejected(error: BaseException) -> bool:
+    """모델을 쓸 수 없거나 요청 자체가 거절된 경우(400/403/404). 다른 모델로 바꿔 볼 만한 오류입니다."""
+    import openai
+
+    return isinstance(error, (openai.BadRequestError, openai.PermissionDeniedError, openai.NotFoundError))
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """429/503 응답의 retry-after-ms 또는 retry-after(초나 HTTP 날짜) 헤더를 읽습니다."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value) if value else None
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    # full jitter: 동시에 실패한 요청들이 같은 순간에 다시 몰리지 않게 흩어 놓습니다.
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """분당 한도(per_minute)를 초당 비율로 채우는 버킷. 먼저 온 요청부터 순서대로 가져갑니다."""
+
+    def __init__(self, per_minute: int, state: Optional[SharedState] = None, key: str = ""):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = 0
+        self.queued_amount = 0.0
+        self._lock = asyncio.Lock()
+        # 공유 버킷을 쓰면 잔량의 기준은 공유 상태이고, self.tokens 는 마지막으로 본 값(대기 예측용)입니다.
+        # 워커 안에서는 여전히 먼저 온 순서대로, 워커끼리는 먼저 가져가는 쪽이 씁니다.
+        self.state = state if state is not None and state.shared else None
+        self.key = key
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        shortage = max(0.0, amount - self.tokens)
+        return max(shortage / self.rate, self.paused_until - now)
+
+    async def acquire(self, amount: float, deadline: float):
+        amount = min(amount, self.capacity)
+        # 앞에서 기다리는 양까지 합쳐 예상 대기 시간이 기한을 넘으면 줄을 서기 전에 바로 거절합니다.
+        now = time.monotonic()
+        projected = self._wait_time(self.queued_amount + amount, now)
+        if now + projected > deadline:
+            raise UpstreamOverloadedError("OpenAI 호출 한도에 도달해 요청을 처리할 수 없습니다.", retry_after=projected)
+        self.waiting += 1
+        self.queued_amount += amount
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if self.state is not None:
+                        wait, self.tokens = await self.state.take(self.key, amount, self.rate, self.capacity)
+                        self.updated = now
+                        if wait <= 0:
+                            return
+                    else:
+                        wait = self._wait_time(amount, now)
+                        if wait <= 0:
+                            self.tokens -= amount
+                            return
+                    if now + wait > deadline:
+                        raise UpstreamOverloadedError("OpenAI 호출 한도에 도달해 요청을 처리할 수 없습니다.", retry_after=wait)
+                    await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+            self.queued_amount -= amount
+
+    async def settle(self, estimated: float, actual: float):
+        """추정으로 미리 뺀 토큰을 실제 사용량에 맞춰 돌려주거나 더 뺍니다."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.capacity, self.tokens + estimated - actual)
+        if self.state is not None:
+            await self.state.adjust(self.key, estimated - actual, self.rate, self.capacity)
+
+    async def pause(self, seconds: float):
+        # 429를 받으면 버킷 전체를 멈춰 대기 중인 요청들이 한꺼번에 다시 두드리지 않게 합니다 (공유 버킷이면 모든 워커가).
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        if self.state is not None:
+            await self.state.pause(self.key, seconds)
+
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_seconds: float = CIRCUIT_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._probing = False
+
+    def before_call(self):
+        if self.state == self.CLOSED:
+            return
+        remaining = self.opened_at + self.reset_seconds - time.monotonic()
+        if self.state == self.OPEN and remaining <= 0:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            self._probing = True
+            return
+        raise CircuitOpenError("OpenAI 응답이 불안정해 잠시 요청을 멈췄습니다.", retry_after=max(1.0, remaining))
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def release_probe(self):
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                self.opens += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class UpstreamGuard:
+    def __init__(self, name: str, rpm: int, tpm: Optional[int] = None, state: Optional[SharedState] = None,
+                 max_retries: int = LLM_MAX_RETRIES, queue_timeout: float = LLM_QUEUE_TIMEOUT, max_queue: int = LLM_MAX_QUEUE):
+        self.name = name
+        self.requests = TokenBucket(rpm, state, f"bucket:{name}:requests")
+        self.tokens = TokenBucket(tpm, state, f"bucket:{name}:tokens") if tpm else None
+        self.breaker = CircuitBreaker()
+        self.max_retries = max_retries
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.retries = 0
+        self.shed = 0
+        self.rate_limited = 0
+
+    async def _admit(self, tokens: int):
+        if self.requests.waiting >= self.max_queue:
+            raise UpstreamOverloadedError("대기 중인 OpenAI 요청이 너무 많습니다.", retry_after=self.queue_timeout)
+        deadline = time.monotonic() + self.queue_timeout
+        await self.requests.acquire(1, deadline)
+        if self.tokens is not None and tokens:
+            await self.tokens.acquire(tokens, deadline)
+
+    async def settle(self, estimated: int, actual: Optional[int]):
+        """admit 때 추정으로 뺀 토큰을 실제 사용량에 맞춥니다. 스트림처럼 사용량을 나중에 아는 호출이 직접 부릅니다."""
+        if self.tokens is not None and estimated and actual is not None:
+            await self.tokens.settle(estimated, actual)
+
+    async def run(self, call: Callable[[], Awaitable[Any]], tokens: int = 0,
+                  used_tokens: Callable[[Any], Optional[int]] = lambda result: None) -> Any:
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                await self._admit(tokens)
+                result = await call()
+            except UpstreamOverloadedError:
+                self.shed += 1
+                self.breaker.release_probe()
+                raise
+            except asyncio.CancelledError:
+                self.breaker.release_probe()
+                raise
+            except Exception as e:
+                import openai
+
+                if not is_retryable(e):
+                    # 4xx 응답은 OpenAI 자체는 살아 있다는 뜻입니다.
+                    if isinstance(e, openai.APIStatusError):
+                        self.breaker.record_success()
+                    else:
+                        self.breaker.release_probe()
+                    raise
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                if isinstance(e, openai.RateLimitError):
+                    # 429는 장애가 아니라 속도 문제이므로 브레이커 대신 버킷을 멈춥니다.
+                    self.rate_limited += 1
+                    await self.requests.pause(delay)
+                    self.breaker.release_probe()
+                else:
+                    self.breaker.record_failure()
+                if attempt >= self.max_retries or self.breaker.state == CircuitBreaker.OPEN:
+                    raise UpstreamUnavailableError(f"OpenAI 호출 실패: {e}", retry_after=max(1.0, delay)) from e
+                self.retries += 1
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            await self.settle(tokens, used_tokens(result))
+            return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self.requests.waiting + (self.tokens.waiting if self.tokens else 0),
+            "shed": self.shed,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "circuit_state": self.breaker.state,
+            "circuit_open": self.breaker.state == CircuitBreaker.OPEN,
+            "circuit_opens": self.breaker.opens,
+        }
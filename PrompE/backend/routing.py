@@ -0,0 +1,234 @@
+# --- 엔드포인트별 모델 라우팅 ---
+# 엔드포인트(의 각 OpenAI 호출 단계)마다 빠른 티어(fast)와 품질 티어(quality)를 두고, 티어마다 모델과 max_tokens,
+# 이미지라면 size/quality 를 정합니다. 호출하는 쪽은 모델 이름 대신 route 이름만 넘기고, LLMGateway 가 티어를 골라 채웁니다.
+# 설정된 티어가 quality 여도 아래 경우에는 잠시(ROUTING_DOWNGRADE_SECONDS) fast 로 내립니다.
+#   - 부하: 게이트웨이의 동시 호출 슬롯과 한도 버킷 대기열이 ROUTING_LOAD_THRESHOLD 이상 찼을 때
+#   - SLO: 최근 호출의 p95 지연이 그 route 의 slo_ms 를 넘었을 때 (표본이 ROUTING_MIN_SAMPLES 개 이상일 때만)
+# 이미지 route 는 기본으로 강등하지 않습니다. 이미지 작업 큐와 미리 그리기만으로도 슬롯이 평소에 가득 차고,
+# fast 티어(512px)는 눈에 띄게 다른 결과라서 필요하면 MODEL_ROUTES 의 auto_downgrade 로 켭니다.
+# 시간이 지나면 표본을 비우고 원래 티어로 돌아가 다시 잽니다. 지연 표본과 강등 상태는 워커마다 따로 둡니다.
+#
+# MODEL_ROUTES 로 기본값을 바꿀 수 있습니다 (JSON 문자열 또는 .json 파일 경로). "*" 는 모든 route 에 먼저 적용됩니다.
+#   MODEL_ROUTES='{"suggest-keywords": {"tier": "fast", "slo_ms": 2500, "fast": {"model": "gpt-4o-mini", "max_tokens": 300}}}'
+#   MODEL_ROUTES='{"*": {"tier": "fast", "auto_downgrade": false}}'
+# ROUTING_RECORD_PATH 를 주면 route 를 거친 호출을 JSONL 로 남깁니다. bench.routing_eval 이 이것을 티어마다 다시 보내
+# 지연, 토큰, 출력 유효율을 비교합니다.
+import json
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field, replace
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from paths import resolve_data_path
+
+
+# 싼 티어부터. 평가 도구는 이 순서로 SLO 를 만족하는 첫 티어를 추천합니다.
+TIERS = ("fast", "quality")
+ROUTING_LOAD_THRESHOLD = float(os.getenv("ROUTING_LOAD_THRESHOLD", "0.8"))
+ROUTING_DOWNGRADE_SECONDS = float(os.getenv("ROUTING_DOWNGRADE_SECONDS", "60"))
+ROUTING_WINDOW = int(os.getenv("ROUTING_WINDOW", "50"))
+ROUTING_WINDOW_SECONDS = float(os.getenv("ROUTING_WINDOW_SECONDS", "300"))
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "10"))
+
+
+@dataclass(frozen=True)
+class Tier:
+    model: str
+    max_tokens: Optional[int] = None
+    size: Optional[str] = None
+    quality: Optional[str] = None
+
+    def options(self) -> Dict[str, Any]:
+        """OpenAI 호출 인자로 넣을 값들. 정하지 않은 값은 넣지 않습니다."""
+        return {key: value for key, value in vars(self).items() if value is not None}
+
+
+@dataclass
+class Route:
+    name: str
+    kind: str  # "chat" 또는 "image"
+    tiers: Dict[str, Tier]
+    tier: str = "quality"
+    slo_ms: float = 5000
+    auto_downgrade: bool = True
+
+
+def chat_route(name: str, slo_ms: float, max_tokens: Optional[int] = None, fast_max_tokens: Optional[int] = None, **settings) -> Route:
+    return Route(name, "chat", {
+        "fast": Tier("gpt-4o-mini", fast_max_tokens or max_tokens),
+        "quality": Tier("gpt-4o", max_tokens),
+    }, slo_ms=slo_ms, **settings)
+
+
+def image_route(name: str, quality_tier: Tier, fast_tier: Tier, slo_ms: float) -> Route:
+    return Route(name, "image", {"fast": fast_tier, "quality": quality_tier}, slo_ms=slo_ms, auto_downgrade=False)
+
+
+DALLE3 = Tier("dall-e-3", size="1024x1024", quality="standard")
+DALLE2_FAST = Tier("dall-e-2", size="512x512")
+
+DEFAULT_ROUTES = [
+    chat_route("chat", 4000),
+    Route("chat-summary", "chat", {
+        "fast": Tier(os.getenv("CHAT_SUMMARY_MODEL", "gpt-4o-mini"), 300),
+        "quality": Tier("gpt-4o", 300),
+    }, tier="fast", slo_ms=4000),
+    chat_route("suggest-keywords", 3000, fast_max_tokens=400),
+    chat_route("generate-hints", 3000, fast_max_tokens=400),
+    chat_route("suggest-adjectives", 4000, fast_max_tokens=300),
+    chat_route("suggest-mood-style", 4000, fast_max_tokens=400),
+    chat_route("compose-prompt", 6000, max_tokens=400),
+    chat_route("merch-mockup-prompt", 6000, max_tokens=200),
+    chat_route("emoji-quiz", 8000),
+    chat_route("prompt-puzzle", 10000),
+    chat_route("prompt-puzzle-image-prompt", 3000, max_tokens=120),
+    image_route("generate-image", DALLE3, DALLE2_FAST, 30000),
+    image_route("generate-image-edit", Tier("gpt-image-1", size="1024x1024", quality="medium"),
+                Tier("gpt-image-1", size="1024x1024", quality="low"), 45000),
+    image_route("merch-mockup", DALLE3, DALLE2_FAST, 30000),
+    image_route("prompt-puzzle-image", DALLE3, DALLE2_FAST, 30000),
+]
+
+
+def load_route_settings(value: Optional[str]) -> Dict[str, Dict[str, Any]]:
+    if not value:
+        return {}
+    if value.strip().endswith(".json"):
+        with open(resolve_data_path(value.strip()), encoding="utf-8") as f:
+            return json.load(f)
+    return json.loads(value)
+
+
+def configure_route(route: Route, settings: Dict[str, Any]) -> Route:
+    tiers = dict(route.tiers)
+    for tier_name in TIERS:
+        if tier_name in settings:
+            base = tiers.get(tier_name)
+            tiers[tier_name] = Tier(**settings[tier_name]) if base is None else replace(base, **settings[tier_name])
+    values = {key: settings[key] for key in ("tier", "slo_ms", "auto_downgrade") if key in settings}
+    route = replace(route, tiers=tiers, **values)
+    if route.tier not in route.tiers:
+        raise ValueError(f"route '{route.name}' 에 '{route.tier}' 티어가 없습니다.")
+    return route
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))] if ordered else 0.0
+
+
+@dataclass
+class TierStats:
+    latencies: Deque[Tuple[float, float]] = field(default_factory=lambda: deque(maxlen=ROUTING_WINDOW))
+    calls: int = 0
+    errors: int = 0
+    tokens: int = 0
+    images: int = 0
+
+    def recent(self, now: float):
+        return [seconds for at, seconds in self.latencies if now - at <= ROUTING_WINDOW_SECONDS]
+
+
+class RequestRecorder:
+    """route 를 거친 호출 인자를 JSONL 한 줄씩 남깁니다. 티어가 정하는 값(모델, max_tokens 등)은 빼고 남깁니다."""
+
+    def __init__(self, path: str):
+        self.path = resolve_data_path(path)
+        self.records = 0
+        self._lock = threading.Lock()
+
+    def record(self, route: str, kind: str, kwargs: Dict[str, Any]):
+        line = json.dumps({"route": route, "kind": kind, "kwargs": kwargs}, ensure_ascii=False, default=str)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+        self.records += 1
+
+
+class ModelRouter:
+    def __init__(self, settings: Optional[Dict[str, Dict[str, Any]]] = None, record_path: Optional[str] = None):
+        settings = load_route_settings(os.getenv("MODEL_ROUTES")) if settings is None else settings
+        common = settings.get("*", {})
+        self.routes = {route.name: configure_route(configure_route(route, common), settings.get(route.name, {}))
+                       for route in DEFAULT_ROUTES}
+        unknown = set(settings) - set(self.routes) - {"*"}
+        if unknown:
+            raise ValueError(f"알 수 없는 route: {', '.join(sorted(unknown))}")
+        record_path = os.getenv("ROUTING_RECORD_PATH") if record_path is None else record_path
+        self.recorder = RequestRecorder(record_path) if record_path else None
+        self._stats = {(name, tier): TierStats() for name, route in self.routes.items() for tier in route.tiers}
+        self._downgraded_until: Dict[str, float] = {}
+        self.downgrades: Dict[str, Dict[str, int]] = {name: {"load": 0, "slo": 0} for name in self.routes}
+
+    def model(self, name: str) -> str:
+        """설정된 티어의 모델. 캐시 키에 씁니다. 강등된 호출의 결과는 downgraded_since 로 걸러 캐시하지 않습니다."""
+        route = self.routes[name]
+        return route.tiers[route.tier].model
+
+    def downgraded_since(self, started: float, *names: str) -> bool:
+        """started(time.monotonic()) 이후 names 중 하나라도 강등된 적이 있는지. 강등 티어의 결과를 캐시에 남기지 않을 때 씁니다."""
+        return any(self._downgraded_until.get(name, 0.0) > started for name in names)
+
+    def options(self, name: str, tier: str) -> Dict[str, Any]:
+        return self.routes[name].tiers[tier].options()
+
+    def select(self, name: str, load: float = 0.0) -> str:
+        """이번 호출에 쓸 티어를 고릅니다. load 는 게이트웨이가 잰 0~1 의 포화도입니다."""
+        route = self.routes[name]
+        if not route.auto_downgrade or route.tier == "fast" or "fast" not in route.tiers:
+            return route.tier
+        now = time.monotonic()
+        if now < self._downgraded_until.get(name, 0.0):
+            return "fast"
+        if load >= ROUTING_LOAD_THRESHOLD:
+            return self._downgrade(route, "load", now)
+        recent = self._stats[(name, route.tier)].recent(now)
+        if len(recent) >= ROUTING_MIN_SAMPLES and percentile(recent, 95) * 1000 > route.slo_ms:
+            return self._downgrade(route, "slo", now)
+        return route.tier
+
+    def _downgrade(self, route: Route, reason: str, now: float) -> str:
+        self._downgraded_until[route.name] = now + ROUTING_DOWNGRADE_SECONDS
+        self.downgrades[route.name][reason] += 1
+        # 돌아왔을 때 강등 전의 느린 표본으로 바로 다시 내려가지 않도록 비웁니다.
+        self._stats[(route.name, route.tier)].latencies.clear()
+        return "fast"
+
+    def observe(self, name: str, tier: str, seconds: float, ok: bool = True, tokens: Optional[int] = None, images: int = 0):
+        stats = self._stats[(name, tier)]
+        stats.calls += 1
+        if not ok:
+            stats.errors += 1
+            return
+        stats.latencies.append((time.monotonic(), seconds))
+        stats.tokens += tokens or 0
+        stats.images += images
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        result: Dict[str, Any] = {}
+        for name, route in self.routes.items():
+            tiers = {}
+            for tier_name, tier in route.tiers.items():
+                stats = self._stats[(name, tier_name)]
+                recent = stats.recent(now)
+                tiers[tier_name] = {
+                    **tier.options(),
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "tokens": stats.tokens,
+                    "images": stats.images,
+                    "p50_ms": round(percentile(recent, 50) * 1000, 1),
+                    "p95_ms": round(percentile(recent, 95) * 1000, 1),
+                }
+            result[name] = {
+                "kind": route.kind,
+                "tier": route.tier,
+                "slo_ms": route.slo_ms,
+                "auto_downgrade": route.auto_downgrade,
+                "downgraded_for": round(max(0.0, self._downgraded_until.get(name, 0.0) - now), 1),
+                "downgrades": self.downgrades[name],
+                "tiers": tiers,
+            }
+        return result
@@ -0,0 +1,393 @@
+# --- 워커 간 공유 상태 ---
+# uvicorn/gunicorn 워커를 여러 개 띄우면 각 워커는 따로 메모리를 씁니다. 워커끼리 맞춰야 하는 것만 여기에 둡니다.
+#   - 키/값 (TTL): 응답 캐시, 이미지 작업 상태, 대화 세션
+#   - 토큰 버킷: OpenAI RPM/TPM 한도는 조직 전체 한도이므로 모든 워커가 한 버킷을 나눠 씁니다
+#   - 임대(lease) 잠금: 스키마 마이그레이션처럼 한 워커만 해야 하는 일
+# SHARED_STATE_URL 로 고릅니다.
+#   memory://                    한 프로세스 안에서만 (기본값, 워커 1개)
+#   sqlite:////abs/path/state.db 같은 머신의 워커들이 한 파일을 나눠 씀 (WEB_CONCURRENCY>1 이면 기본값)
+#   redis://host:6379/0          여러 머신 (redis 패키지 필요, Redis 호환 서버면 됩니다)
+# 여러 워커로 띄울 때는 `WEB_CONCURRENCY=4 uvicorn main:app` 처럼 WEB_CONCURRENCY 로 워커 수를 주면
+# (uvicorn/gunicorn 모두 이 값을 기본 워커 수로 씁니다) 공유 상태도 함께 켜집니다. --workers 만 주면 켜지지 않고,
+# 시작할 때 워커마다 한도 버킷을 따로 쓴다는 경고를 남깁니다.
+# 버킷과 임대는 여러 워커가 동시에 고쳐도 어긋나지 않게 SQLite 는 BEGIN IMMEDIATE, Redis 는 Lua 스크립트로 처리합니다.
+# 시각은 프로세스마다 다른 monotonic 대신 벽시계(time.time)를 씁니다.
+import asyncio
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from paths import DATA_DIR
+
+
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL") or (
+    f"sqlite:///{os.path.join(DATA_DIR, 'shared_state.db')}" if WEB_CONCURRENCY > 1 else "memory://"
+)
+SHARED_STATE_SWEEP_INTERVAL = 60.0
+LOCK_POLL_INTERVAL = 0.05
+# 상태를 쓴 워커를 구분하는 이름 (작업 상태의 owner, 임대 소유자)
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class SharedState(ABC):
+    """공유 상태 인터페이스. shared 가 False 인 구현은 한 프로세스 안에서만 보입니다."""
+
+    shared = True
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: float):
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str):
+        ...
+
+    @abstractmethod
+    async def take(self, key: str, amount: float, rate: float, capacity: float) -> Tuple[float, float]:
+        """
+        초당 rate 로 capacity 까지 차는 버킷에서 amount 를 가져갑니다.
+        (기다려야 할 초, 남은 양)을 돌려주며, 기다려야 하면(>0) 아무것도 빼지 않습니다.
+        """
+
+    @abstractmethod
+    async def adjust(self, key: str, delta: float, rate: float, capacity: float):
+        """버킷에 delta 만큼 돌려주거나(양수) 더 뺍니다(음수)."""
+
+    @abstractmethod
+    async def pause(self, key: str, seconds: float):
+        ...
+
+    @abstractmethod
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        ...
+
+    @abstractmethod
+    async def release_lease(self, name: str, owner: str):
+        ...
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float = 60.0) -> AsyncIterator[None]:
+        """모든 워커에 걸친 잠금. ttl 안에 끝나지 않으면 (죽은 워커로 보고) 다른 워커가 가져갈 수 있습니다."""
+        owner = f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+        while not await self.acquire_lease(name, owner, ttl):
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            await self.release_lease(name, owner)
+
+    async def aclose(self):
+        pass
+
+    def describe(self) -> Dict[str, str]:
+        return {"backend": type(self).__name__, "worker": WORKER_ID}
+
+
+def _refill(tokens: float, updated: float, now: float, rate: float, capacity: float) -> float:
+    return min(capacity, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryState(SharedState):
+    shared = False
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[str, float]] = {}
+        self._buckets: Dict[str, Tuple[float, float, float]] = {}
+        self._leases: Dict[str, Tuple[str, float]] = {}
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._values.get(key)
+        if entry is None or entry[1] < time.time():
+            self._values.pop(key, None)
+            return None
+        return entry[0]
+
+    async def set(self, key: str, value: str, ttl: float):
+        self._values[key] = (value, time.time() + ttl)
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+
+    def _bucket(self, key: str, rate: float, capacity: float) -> Tuple[float, float, float]:
+        now = time.time()
+        tokens, updated, paused_until = self._buckets.get(key, (capacity, now, 0.0))
+        return _refill(tokens, updated, now, rate, capacity), now, paused_until
+
+    async def take(self, key: str, amount: float, rate: float, capacity: float) -> Tuple[float, float]:
+        tokens, now, paused_until = self._bucket(key, rate, capacity)
+        wait = max((amount - tokens) / rate, paused_until - now)
+        if wait <= 0:
+            tokens -= amount
+        self._buckets[key] = (tokens, now, paused_until)
+        return wait, tokens
+
+    async def adjust(self, key: str, delta: float, rate: float, capacity: float):
+        tokens, now, paused_until = self._bucket(key, rate, capacity)
+        self._buckets[key] = (min(capacity, tokens + delta), now, paused_until)
+
+    async def pause(self, key: str, seconds: float):
+        tokens, updated, paused_until = self._buckets.get(key, (float("inf"), time.time(), 0.0))
+        self._buckets[key] = (tokens, updated, max(paused_until, time.time() + seconds))
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        holder = self._leases.get(name)
+        if holder is not None and holder[0] != owner and holder[1] > time.time():
+            return False
+        self._leases[name] = (owner, time.time() + ttl)
+        return True
+
+    async def release_lease(self, name: str, owner: str):
+        if self._leases.get(name, ("",))[0] == owner:
+            del self._leases[name]
+
+
+class SQLiteState(SharedState):
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        # 트랜잭션을 직접 여닫습니다 (BEGIN IMMEDIATE 로 쓰기 잠금을 먼저 잡아 읽고-고치는 사이에 끼어들지 못하게).
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL,"
+            " paused_until REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL);"
+        )
+        self._last_sweep = 0.0
+
+    def _transaction(self, work):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    async def _run(self, work):
+        return await asyncio.to_thread(self._transaction, work)
+
+    async def get(self, key: str) -> Optional[str]:
+        def read():
+            with self._lock:
+                return self._conn.execute(
+                    "SELECT value FROM kv WHERE key = ? AND expires_at >= ?", (key, time.time())
+                ).fetchone()
+
+        row = await asyncio.to_thread(read)
+        return row[0] if row else None
+
+    async def set(self, key: str, value: str, ttl: float):
+        now = time.time()
+
+        def write(conn):
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, value, now + ttl))
+            # 만료된 키는 읽을 때 걸러지고, 가끔 한꺼번에 지웁니다.
+            if now - self._last_sweep > SHARED_STATE_SWEEP_INTERVAL:
+                self._last_sweep = now
+                conn.execute("DELETE FROM kv WHERE expires_at < ?", (now,))
+
+        await self._run(write)
+
+    async def delete(self, key: str):
+        await self._run(lambda conn: conn.execute("DELETE FROM kv WHERE key = ?", (key,)))
+
+    @staticmethod
+    def _bucket(conn, key: str, rate: float, capacity: float) -> Tuple[float, float, float]:
+        now = time.time()
+        row = conn.execute("SELECT tokens, updated, paused_until FROM buckets WHERE key = ?", (key,)).fetchone()
+        tokens, updated, paused_until = row or (capacity, now, 0.0)
+        return _refill(tokens, updated, now, rate, capacity), now, paused_until
+
+    @staticmethod
+    def _store_bucket(conn, key: str, tokens: float, now: float, paused_until: float):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (key, tokens, updated, paused_until) VALUES (?, ?, ?, ?)",
+            (key, tokens, now, paused_until),
+        )
+
+    async def take(self, key: str, amount: float, rate: float, capacity: float) -> Tuple[float, float]:
+        def work(conn):
+            tokens, now, paused_until = self._bucket(conn, key, rate, capacity)
+            wait = max((amount - tokens) / rate, paused_until - now)
+            if wait <= 0:
+                tokens -= amount
+                self._store_bucket(conn, key, tokens, now, paused_until)
+            return wait, tokens
+
+        return await self._run(work)
+
+    async def adjust(self, key: str, delta: float, rate: float, capacity: float):
+        def work(conn):
+            tokens, now, paused_until = self._bucket(conn, key, rate, capacity)
+            self._store_bucket(conn, key, min(capacity, tokens + delta), now, paused_until)
+
+        await self._run(work)
+
+    async def pause(self, key: str, seconds: float):
+        def work(conn):
+            until = time.time() + seconds
+            updated = conn.execute(
+                "UPDATE buckets SET paused_until = MAX(paused_until, ?) WHERE key = ?", (until, key)
+            ).rowcount
+            if not updated:
+                # 아직 한 번도 쓰지 않은 버킷은 가득 찬 것으로 봅니다 (take 에서 capacity 로 잘립니다).
+                self._store_bucket(conn, key, float("inf"), time.time(), until)
+
+        await self._run(work)
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        def work(conn):
+            now = time.time()
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)", (name, owner, now + ttl))
+            return True
+
+        return await self._run(work)
+
+    async def release_lease(self, name: str, owner: str):
+        await self._run(lambda conn: conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)))
+
+    async def aclose(self):
+        with self._lock:
+            self._conn.close()
+
+    def describe(self) -> Dict[str, str]:
+        return {**super().describe(), "path": self.path}
+
+
+# 버킷 해시: tokens, updated, paused_until. KEYS[1]=버킷, ARGV: now, amount, rate, capacity
+_REDIS_TAKE = """
+local now, amount, rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated', 'paused_until')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+local paused_until = tonumber(state[3]) or 0
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = math.max((amount - tokens) / rate, paused_until - now)
+if wait <= 0 then
+  tokens = tokens - amount
+  redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now), 'paused_until', tostring(paused_until))
+  redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+end
+return {tostring(wait), tostring(tokens)}
+"""
+_REDIS_ADJUST = """
+local now, delta, rate, capacity = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate + delta)
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return 1
+"""
+_REDIS_PAUSE = """
+local until = tonumber(ARGV[1])
+local current = tonumber(redis.call('HGET', KEYS[1], 'paused_until')) or 0
+if until > current then redis.call('HSET', KEYS[1], 'paused_until', tostring(until)) end
+return 1
+"""
+_REDIS_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+class RedisState(SharedState):
+    def __init__(self, url: str, prefix: str = "prompe:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError:
+            raise RuntimeError("SHARED_STATE_URL 이 redis:// 이면 redis 패키지가 필요합니다 (pip install redis).") from None
+        self.url = url
+        self.prefix = prefix
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._take = self._redis.register_script(_REDIS_TAKE)
+        self._adjust = self._redis.register_script(_REDIS_ADJUST)
+        self._pause = self._redis.register_script(_REDIS_PAUSE)
+        self._release = self._redis.register_script(_REDIS_RELEASE)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._redis.get(self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float):
+        await self._redis.set(self.prefix + key, value, px=max(1, int(ttl * 1000)))
+
+    async def delete(self, key: str):
+        await self._redis.delete(self.prefix + key)
+
+    async def take(self, key: str, amount: float, rate: float, capacity: float) -> Tuple[float, float]:
+        wait, tokens = await self._take(keys=[self.prefix + key], args=[time.time(), amount, rate, capacity])
+        return float(wait), float(tokens)
+
+    async def adjust(self, key: str, delta: float, rate: float, capacity: float):
+        await self._adjust(keys=[self.prefix + key], args=[time.time(), delta, rate, capacity])
+
+    async def pause(self, key: str, seconds: float):
+        await self._pause(keys=[self.prefix + key], args=[time.time() + seconds])
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        key = f"{self.prefix}lease:{name}"
+        if await self._redis.set(key, owner, nx=True, px=max(1, int(ttl * 1000))):
+            return True
+        # 이미 가진 임대는 연장합니다 (다른 임대 구현과 같게).
+        if await self._redis.get(key) == owner:
+            await self._redis.pexpire(key, max(1, int(ttl * 1000)))
+            return True
+        return False
+
+    async def release_lease(self, name: str, owner: str):
+        await self._release(keys=[f"{self.prefix}lease:{name}"], args=[owner])
+
+    async def aclose(self):
+        await self._redis.aclose()
+
+    def describe(self) -> Dict[str, str]:
+        return {**super().describe(), "url": self.url.split("@")[-1]}
+
+
+def detect_worker_count() -> int:
+    """워커 수. WEB_CONCURRENCY 가 없으면 부모 프로세스(uvicorn/gunicorn)의 --workers/-w 인자로 짐작합니다 (리눅스만)."""
+    if WEB_CONCURRENCY > 1:
+        return WEB_CONCURRENCY
+    try:
+        with open(f"/proc/{os.getppid()}/cmdline", "rb") as f:
+            args = f.read().decode(errors="replace").split("\0")
+    except OSError:
+        return 1
+    for index, arg in enumerate(args):
+        name, _, value = arg.partition("=")
+        if name in ("--workers", "-w"):
+            value = value or (args[index + 1] if index + 1 < len(args) else "")
+            return int(value) if value.isdigit() else 1
+    return 1
+
+
+def create_shared_state(url: str = SHARED_STATE_URL) -> SharedState:
+    if url.startswith("memory:"):
+        return MemoryState()
+    if url.startswith("sqlite:///"):
+        path = url[len("sqlite:///"):]
+        return SQLiteState(path if os.path.isabs(path) else os.path.join(DATA_DIR, path))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisState(url)
+    raise ValueError(f"지원하지 않는 SHARED_STATE_URL 입니다: {url}")
@@ -0,0 +1,164 @@
+# --- 이미지 저장 서비스 ---
+# 외부 URL(DALL-E 임시 URL 등)이나 생성 API가 돌려준 바이트를 uploads/ 에 영구 저장합니다.
+# 하나의 keep-alive 커넥션 풀을 공유하고, 응답을 청크 단위로 임시 파일에 바로 흘려 쓴 뒤
+# 원자적으로 이름을 바꿉니다. 이미지 크기와 상관없이 메모리 사용량이 일정합니다.
+# 파일은 내용의 SHA-256 다이제스트 이름으로 한 번만 저장됩니다(같은 이미지는 다시 쓰지 않음).
+import asyncio
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import BinaryIO, NamedTuple, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+from paths import data_path
+
+try:
+    import h2  # noqa: F401  (httpx의 HTTP/2 지원은 선택 의존성입니다)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+UPLOAD_DIR = data_path("UPLOAD_DIR", "uploads")
+# 저장된 파일은 디렉터리가 어디에 있든 항상 이 경로로 제공됩니다 (main.py 의 StaticFiles).
+UPLOAD_URL_PREFIX = "/uploads"
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+WRITE_CHUNK_BYTES = 256 * 1024
+
+
+class StoredBlob(NamedTuple):
+    digest: str
+    filename: str
+    size: int
+    url: str
+
+
+class ImageDownloadError(Exception):
+    pass
+
+
+class ImageTooLargeError(ImageDownloadError):
+    pass
+
+
+class ImageIngestor:
+    def __init__(self, upload_dir: str = UPLOAD_DIR, max_bytes: int = IMAGE_MAX_BYTES):
+        self.upload_dir = upload_dir
+        self.max_bytes = max_bytes
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def _http(self) -> httpx.AsyncClient:
+        # 대부분의 이미지는 b64_json 으로 받으므로 외부 URL을 처음 내려받을 때 커넥션 풀을 만듭니다.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+                timeout=httpx.Timeout(30.0, connect=10.0),
+            )
+        return self._client
+
+    def _blob(self, filename: str) -> StoredBlob:
+        size = os.path.getsize(os.path.join(self.upload_dir, filename))
+        return StoredBlob(os.path.splitext(filename)[0], filename, size, f"{UPLOAD_URL_PREFIX}/{filename}")
+
+    def local_blob(self, url: str) -> Optional[StoredBlob]:
+        """이미 uploads/ 에 있는 이미지를 가리키는 URL이면 다시 내려받지 않고 그 파일을 돌려줍니다."""
+        parsed = urlparse(url)
+        prefix = f"{UPLOAD_URL_PREFIX}/"
+        if not parsed.path.startswith(prefix):
+            return None
+        filename = os.path.basename(parsed.path)
+        stem = os.path.splitext(filename)[0]
+        is_digest = len(stem) == 64 and all(c in "0123456789abcdef" for c in stem)
+        # 다이제스트 이름은 내용이 같음을 보장하므로 호스트와 상관없이, 예전 UUID 이름은 상대 경로일 때만 재사용합니다.
+        if parsed.netloc and not is_digest:
+            return None
+        if not os.path.isfile(os.path.join(self.upload_dir, filename)):
+            return None
+        return self._blob(filename)
+
+    async def _stream_to_file(self, response: httpx.Response, buffer: BinaryIO, hasher) -> int:
+        declared = response.headers.get("content-length")
+        if declared and declared.isdigit() and int(declared) > self.max_bytes:
+            raise ImageTooLargeError(f"이미지가 너무 큽니다 ({declared} bytes).")
+        received = 0
+        pending = bytearray()
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            if received > self.max_bytes:
+                raise ImageTooLargeError(f"이미지가 너무 큽니다 (최대 {self.max_bytes} bytes).")
+            hasher.update(chunk)
+            pending += chunk
+            if len(pending) >= WRITE_CHUNK_BYTES:
+                await asyncio.to_thread(buffer.write, bytes(pending))
+                pending.clear()
+        if pending:
+            await asyncio.to_thread(buffer.write, bytes(pending))
+        return received
+
+    def _commit(self, tmp_path: str, filename: str) -> bool:
+        final_path = os.path.join(self.upload_dir, filename)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+            return False
+        os.replace(tmp_path, final_path)
+        return True
+
+    async def download(self, url: str) -> StoredBlob:
+        """url의 이미지를 내려받아 다이제스트 이름으로 저장합니다. 이미 있는 내용이면 새로 쓰지 않습니다."""
+        os.makedirs(self.upload_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.upload_dir, suffix=".part")
+        hasher = hashlib.sha256()
+        try:
+            with os.fdopen(fd, "wb") as buffer:
+                try:
+                    async with self._http.stream("GET", url) as response:
+                        response.raise_for_status()
+                        size = await self._stream_to_file(response, buffer, hasher)
+                except httpx.HTTPError as e:
+                    raise ImageDownloadError(str(e)) from e
+            digest = hasher.hexdigest()
+            filename = f"{digest}.png"
+            await asyncio.to_thread(self._commit, tmp_path, filename)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return StoredBlob(digest, filename, size, f"{UPLOAD_URL_PREFIX}/{filename}")
+
+    async def store_bytes(self, data: bytes) -> StoredBlob:
+        """이미 받아 둔 이미지 바이트(b64_json 응답 등)를 다이제스트 이름으로 저장합니다."""
+        if len(data) > self.max_bytes:
+            raise ImageTooLargeError(f"이미지가 너무 큽니다 ({len(data)} bytes).")
+
+        def write() -> str:
+            # 해시 계산과 쓰기 모두 워커 스레드에서 하므로 이벤트 루프를 막지 않습니다.
+            os.makedirs(self.upload_dir, exist_ok=True)
+            filename = f"{hashlib.sha256(data).hexdigest()}.png"
+            if os.path.exists(os.path.join(self.upload_dir, filename)):
+                return filename
+            fd, tmp_path = tempfile.mkstemp(dir=self.upload_dir, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as buffer:
+                    buffer.write(data)
+                self._commit(tmp_path, filename)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            return filename
+
+        filename = await asyncio.to_thread(write)
+        return StoredBlob(os.path.splitext(filename)[0], filename, len(data), f"{UPLOAD_URL_PREFIX}/{filename}")
+
+    async def read_bytes(self, blob: StoredBlob) -> bytes:
+        return await asyncio.to_thread(Path(self.upload_dir, blob.filename).read_bytes)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
@@ -0,0 +1,222 @@
+# --- 스키마로 강제하는 구조화 출력 ---
+# JSON 엔드포인트는 응답 Pydantic 모델에서 strict JSON 스키마를 만들어 response_format={"type": "json_schema"} 로 보냅니다.
+# 모양(키, 타입)은 스키마가 보장하지만 개수나 값의 범위(보기 4개, correctIndex 0~3, 블록 종류별 2개 등)는
+# 여전히 어긋날 수 있습니다. 그런 문제는 엔드포인트별 repair 함수가 로컬에서 고치고(남는 항목 자르기,
+# 빠진 correctBlocks 채우기 등), 고칠 수 없는 부분만 호출한 쪽이 그 부분만 다시 요청합니다(partial re-ask).
+# 출력마다 호출 수, 로컬 수리, 다시 요청한 횟수, 버린 응답의 토큰(wasted_tokens)을 셉니다.
+import json
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Type
+
+from pydantic import BaseModel, ValidationError, create_model
+
+from llm import total_tokens
+
+
+# 스키마에서 뺄 키워드: 모델에는 쓸모없고 토큰만 늘리거나, strict 모드가 받지 않는 것들입니다.
+UNSUPPORTED_SCHEMA_KEYS = ("title", "default", "examples")
+
+# repair(data) -> 고칠 수 없어 다시 받아야 하는 필드 이름들. data 는 제자리에서 고칩니다.
+Repair = Callable[[Dict[str, Any]], List[str]]
+# reask(data, problems) -> 그 부분만 다시 받아 data 에 채웁니다.
+Reask = Callable[[Dict[str, Any], List[str]], Awaitable[None]]
+
+
+# 지금 진행 중인 generate 한 번이 다시 받느라 쓴 토큰. 동시에 도는 다른 호출의 토큰과 섞이지 않게 합니다.
+_reask_spent: ContextVar[Optional[List[int]]] = ContextVar("reask_spent", default=None)
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+def strict_json_schema(model: Type[BaseModel]) -> Dict[str, Any]:
+    """Pydantic 모델의 JSON 스키마를 OpenAI strict 모드 규칙(모든 키 required, additionalProperties=false)에 맞춥니다."""
+    schema = model.model_json_schema()
+    definitions = schema.pop("$defs", {})
+
+    def convert(node: Dict[str, Any]) -> Dict[str, Any]:
+        if "$ref" in node:
+            return convert(definitions[node["$ref"].rsplit("/", 1)[-1]])
+        node = {key: value for key, value in node.items() if key not in UNSUPPORTED_SCHEMA_KEYS}
+        if node.get("type") == "object":
+            properties = {name: convert(value) for name, value in node.get("properties", {}).items()}
+            node.update(properties=properties, required=list(properties), additionalProperties=False)
+        if "items" in node:
+            node["items"] = convert(node["items"])
+        if "anyOf" in node:
+            node["anyOf"] = [convert(option) for option in node["anyOf"]]
+        return node
+
+    return convert(schema)
+
+
+def json_schema_format(model: Type[BaseModel], name: Optional[str] = None) -> Dict[str, Any]:
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name or model.__name__, "strict": True, "schema": strict_json_schema(model)},
+    }
+
+
+def batch_model(model: Type[BaseModel]) -> Type[BaseModel]:
+    """{"results": [{"id": 0, ...model 필드}]} 모양의 묶음 응답 모델."""
+    item = create_model(f"{model.__name__}Item", __base__=model, id=(int, ...))
+    return create_model(f"{model.__name__}Batch", results=(List[item], ...))
+
+
+def partial_model(model: Type[BaseModel], fields: Iterable[str]) -> Type[BaseModel]:
+    """model 의 일부 필드만 가진 모델. 다시 요청할 때 그 필드만 받도록 씁니다."""
+    fields = list(fields)
+    return create_model(f"{model.__name__}Part", **{name: (model.model_fields[name].annotation, ...) for name in fields})
+
+
+def matches_schema(value: Any, schema: Dict[str, Any]) -> bool:
+    """strict_json_schema 가 만드는 범위(object/array/string/integer/number/boolean/enum/anyOf)에서 value 가 스키마에 맞는지 봅니다."""
+    if "anyOf" in schema:
+        return any(matches_schema(value, option) for option in schema["anyOf"])
+    if "enum" in schema and value not in schema["enum"]:
+        return False
+    kind = schema.get("type")
+    if kind == "object":
+        properties = schema.get("properties", {})
+        return (isinstance(value, dict) and all(key in value for key in schema.get("required", []))
+                and (schema.get("additionalProperties", True) is not False or set(value) <= set(properties))
+                and all(matches_schema(value[key], properties[key]) for key in value if key in properties))
+    if kind == "array":
+        return isinstance(value, list) and all(matches_schema(item, schema.get("items", {})) for item in value)
+    checks = {
+        "string": lambda v: isinstance(v, str),
+        "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+        "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+        "boolean": lambda v: isinstance(v, bool),
+        "null": lambda v: v is None,
+    }
+    return checks.get(kind, lambda v: True)(value)
+
+
+# --- 로컬 수리 도구 ---
+def clean_strings(value: Any, limit: Optional[int] = None) -> List[str]:
+    """문자열 목록으로 바꿉니다. 빈 값과 중복을 빼고, limit 개를 넘으면 자릅니다."""
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        return []
+    cleaned: List[str] = []
+    for item in value:
+        if isinstance(item, (int, float)) and not isinstance(item, bool):
+            item = str(item)
+        if isinstance(item, str) and item.strip() and item.strip() not in cleaned:
+            cleaned.append(item.strip())
+    return cleaned[:limit] if limit is not None else cleaned
+
+
+def repair_string_lists(data: Dict[str, Any], keys: Iterable[str], count: int, min_count: int) -> List[str]:
+    """키마다 문자열 count 개까지 남기고, min_count 개보다 적은 키를 돌려줍니다."""
+    short = []
+    for key in keys:
+        data[key] = clean_strings(data.get(key), count)
+        if len(data[key]) < min_count:
+            short.append(key)
+    return short
+
+
+def as_index(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value.strip())
+    return None
+
+
+class StructuredOutput:
+    def __init__(self, name: str, model: Type[BaseModel], repair: Repair = lambda data: []):
+        self.name = name
+        self.model = model
+        self.repair = repair
+        self.response_format = json_schema_format(model)
+        self._part_formats: Dict[tuple, Dict[str, Any]] = {}
+        self.calls = 0
+        self.repaired = 0
+        self.reasks = 0
+        self.failures = 0
+        self.tokens = 0
+        self.reask_tokens = 0
+        self.wasted_tokens = 0
+
+    def read(self, completion: Any) -> Dict[str, Any]:
+        content = completion.choices[0].message.content
+        try:
+            data = json.loads(content or "")
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            # 거절(refusal)이나 max_tokens 로 잘린 응답입니다.
+            raise StructuredOutputError(f"{self.name} 응답이 JSON 객체가 아닙니다.")
+        return data
+
+    def repair_data(self, data: Dict[str, Any], repair: Optional[Repair] = None) -> List[str]:
+        """data 를 제자리에서 고치고 남은 문제를 돌려줍니다. 묶음 응답의 항목을 하나씩 고칠 때도 씁니다."""
+        before = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+        problems = (repair or self.repair)(data)
+        if json.dumps(data, ensure_ascii=False, sort_keys=True, default=str) != before:
+            self.repaired += 1
+        return problems
+
+    async def ask_part(self, call: Callable[[Dict[str, Any]], Awaitable[Any]], fields: Iterable[str]) -> Dict[str, Any]:
+        """모델의 fields 만 가진 스키마로 다시 받습니다. reask 안에서 부릅니다."""
+        fields = tuple(fields)
+        if fields not in self._part_formats:
+            self._part_formats[fields] = json_schema_format(partial_model(self.model, fields))
+        completion = await call(self._part_formats[fields])
+        tokens = total_tokens(completion) or 0
+        self.reask_tokens += tokens
+        spent = _reask_spent.get()
+        if spent is not None:
+            spent.append(tokens)
+        return self.read(completion)
+
+    async def generate(self, call: Callable[[Dict[str, Any]], Awaitable[Any]], reask: Optional[Reask] = None,
+                       repair: Optional[Repair] = None) -> BaseModel:
+        """
+        call(response_format) 으로 한 번 받아 로컬에서 고칩니다. 그래도 남은 문제는 reask 로 그 부분만 다시 받고,
+        그래도 안 되면 StructuredOutputError 를 냅니다. 이때 쓴 토큰(다시 받은 것 포함)은 wasted_tokens 로 셉니다.
+        repair 를 주면 이번 호출에만 기본 repair 대신 씁니다 (요청마다 기대하는 개수가 다를 때).
+        """
+        self.calls += 1
+        completion = await call(self.response_format)
+        tokens = total_tokens(completion) or 0
+        self.tokens += tokens
+        spent: List[int] = []
+        reset = _reask_spent.set(spent)
+        try:
+            data = self.read(completion)
+            problems = self.repair_data(data, repair)
+            if problems and reask is not None:
+                self.reasks += 1
+                await reask(data, problems)
+                problems = self.repair_data(data, repair)
+            if problems:
+                raise StructuredOutputError(f"{self.name} 응답을 고칠 수 없습니다: {', '.join(problems)}")
+            return self.model.model_validate(data)
+        except (StructuredOutputError, ValidationError):
+            self.failures += 1
+            self.wasted_tokens += tokens + sum(spent)
+            raise
+        finally:
+            _reask_spent.reset(reset)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "repaired": self.repaired,
+            "reasks": self.reasks,
+            "failures": self.failures,
+            "reask_rate": round(self.reasks / self.calls, 4) if self.calls else 0.0,
+            "tokens": self.tokens,
+            "reask_tokens": self.reask_tokens,
+            "wasted_tokens": self.wasted_tokens,
+        }
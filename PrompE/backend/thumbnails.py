@@ -0,0 +1,100 @@
+# --- 갤러리 썸네일 ---
+# uploads/ 의 원본(1024x1024 PNG)에서 몇 가지 너비의 WebP 썸네일을 만들어 uploads/thumbs/ 에 저장합니다.
+# 변환은 프로세스 풀에서 실행되어 요청 처리를 막지 않고, 같은 원본에 대한 동시 요청은 한 번만 변환합니다.
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence
+
+from PIL import Image
+
+from storage import UPLOAD_DIR, UPLOAD_URL_PREFIX
+
+
+THUMBNAIL_WIDTHS = (240, 480, 768)
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+THUMBNAIL_QUALITY = 80
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def upload_stem(image_url: str) -> Optional[str]:
+    """/uploads/<stem>.png 형태의 URL이면 stem을, 아니면 None을 돌려줍니다."""
+    prefix = f"{UPLOAD_URL_PREFIX}/"
+    if not image_url or not image_url.startswith(prefix) or not image_url.endswith(".png"):
+        return None
+    stem = image_url[len(prefix):-len(".png")]
+    return stem if stem and "/" not in stem else None
+
+
+def render_thumbnails(source_path: str, targets: Dict[int, str]):
+    # 프로세스 풀에서 실행되므로 모듈 최상위 함수여야 합니다.
+    with Image.open(source_path) as image:
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for width, target_path in targets.items():
+            if os.path.exists(target_path):
+                continue
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS) if width < image.width else image
+            # 여러 워커가 같은 썸네일을 동시에 만들어도 서로의 임시 파일을 덮어쓰지 않게 합니다.
+            tmp_path = f"{target_path}.{os.getpid()}.tmp"
+            resized.save(tmp_path, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+            os.replace(tmp_path, target_path)
+
+
+class Thumbnailer:
+    def __init__(self, upload_dir: str = UPLOAD_DIR, widths: Sequence[int] = THUMBNAIL_WIDTHS, workers: int = THUMBNAIL_WORKERS):
+        self.upload_dir = upload_dir
+        self.thumb_dir = os.path.join(upload_dir, "thumbs")
+        self.widths = tuple(widths)
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._background: set = set()
+
+    def source_path(self, stem: str) -> str:
+        return os.path.join(self.upload_dir, f"{stem}.png")
+
+    def thumb_path(self, stem: str, width: int) -> str:
+        return os.path.join(self.thumb_dir, f"{stem}_{width}.webp")
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def ensure(self, stem: str) -> List[str]:
+        """모든 너비의 썸네일이 디스크에 있도록 보장하고 경로 목록을 돌려줍니다."""
+        targets = {width: self.thumb_path(stem, width) for width in self.widths}
+        if all(os.path.exists(path) for path in targets.values()):
+            return list(targets.values())
+        inflight = self._inflight.get(stem)
+        if inflight is None:
+            if not os.path.exists(self.source_path(stem)):
+                raise FileNotFoundError(self.source_path(stem))
+            os.makedirs(self.thumb_dir, exist_ok=True)
+            loop = asyncio.get_running_loop()
+            inflight = asyncio.ensure_future(
+                loop.run_in_executor(self._pool(), render_thumbnails, self.source_path(stem), targets)
+            )
+            self._inflight[stem] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(stem, None))
+        await asyncio.shield(inflight)
+        return list(targets.values())
+
+    def schedule(self, stem: str):
+        """업로드 직후 백그라운드에서 썸네일을 미리 만듭니다. 실패해도 요청에는 영향이 없습니다."""
+        async def run():
+            try:
+                await self.ensure(stem)
+            except Exception:
+                logger.exception("Thumbnail generation failed for %s", stem)
+        task = asyncio.create_task(run())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,113 @@
+# --- 비전 입력 정규화 ---
+# 캔버스에서 온 base64 data URL을 gpt-4o에 보내기 전에 한 번만 디코딩해서,
+# 모델이 실제로 쓰는 해상도로 줄이고 작은 JPEG로 다시 인코딩합니다.
+# 디코딩/인코딩은 워커 스레드 풀에서 실행하고, 같은 그림은 내용 해시로 한 번만 처리합니다.
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from PIL import Image
+
+
+# gpt-4o 기준: low 는 512px 한 장, high 는 짧은 변 768px 타일로 처리됩니다.
+VISION_MAX_SIDE = {"low": 512, "high": 1024}
+VISION_JPEG_QUALITY = 85
+VISION_WORKERS = int(os.getenv("VISION_WORKERS", "4"))
+VISION_MEMO_SIZE = int(os.getenv("VISION_MEMO_SIZE", "256"))
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+def decode_data_url(data_url: str) -> bytes:
+    header, _, encoded = data_url.partition(",")
+    if not header.startswith("data:image/") or ";base64" not in header:
+        raise InvalidImageError("이미지 data URL 형식이 아닙니다.")
+    try:
+        return base64.b64decode(encoded, validate=False)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidImageError(f"base64 디코딩 실패: {e}") from e
+
+
+def normalize_image_bytes(raw: bytes, max_side: int) -> bytes:
+    try:
+        image = Image.open(io.BytesIO(raw))
+        image.load()
+    except Exception as e:
+        raise InvalidImageError(f"이미지를 열 수 없습니다: {e}") from e
+    if image.mode in ("RGBA", "LA", "P"):
+        # 투명한 캔버스 배경은 JPEG에서 검게 변하므로 흰 배경 위에 합성합니다.
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    else:
+        image = image.convert("RGB")
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def _normalize_bytes(raw: bytes, max_side: int) -> str:
+    return "data:image/jpeg;base64," + base64.b64encode(normalize_image_bytes(raw, max_side)).decode("ascii")
+
+
+def _normalize_data_url(data_url: str, max_side: int) -> str:
+    return _normalize_bytes(decode_data_url(data_url), max_side)
+
+
+class VisionInputNormalizer:
+    def __init__(self, workers: int = VISION_WORKERS, memo_size: int = VISION_MEMO_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="vision")
+        self._memo: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.memo_size = memo_size
+        self.hits = 0
+        self.misses = 0
+
+    async def image_part(self, url: str, detail: str = "low") -> Dict:
+        """chat 메시지에 넣을 image_url 파트를 만듭니다. data URL이 아니면 그대로 전달합니다."""
+        detail = detail if detail in VISION_MAX_SIDE else "low"
+        if not url.startswith("data:"):
+            return {"type": "image_url", "image_url": {"url": url, "detail": detail}}
+        key = hashlib.sha256(f"{detail}:{url}".encode("utf-8")).hexdigest()
+        return await self._normalized(key, detail, _normalize_data_url, url)
+
+    async def image_bytes_part(self, raw: bytes, digest: str, detail: str = "low") -> Dict:
+        """이미 디코딩된 그림(업로드 핸들 등)으로 image_url 파트를 만듭니다. digest 는 raw 의 내용 해시입니다."""
+        detail = detail if detail in VISION_MAX_SIDE else "low"
+        return await self._normalized(f"{detail}:bytes:{digest}", detail, _normalize_bytes, raw)
+
+    async def _normalized(self, key: str, detail: str, normalize, source) -> Dict:
+        cached = self._memo.get(key)
+        if cached is not None:
+            self._memo.move_to_end(key)
+            self.hits += 1
+            return {"type": "image_url", "image_url": {"url": cached, "detail": detail}}
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            self.misses += 1
+            loop = asyncio.get_running_loop()
+            inflight = asyncio.ensure_future(
+                loop.run_in_executor(self._executor, normalize, source, VISION_MAX_SIDE[detail])
+            )
+            self._inflight[key] = inflight
+            inflight.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.hits += 1
+        normalized = await asyncio.shield(inflight)
+        self._memo[key] = normalized
+        while len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return {"type": "image_url", "image_url": {"url": normalized, "detail": detail}}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
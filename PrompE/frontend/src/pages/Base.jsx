@@ -34,6 +34,7 @@ function Base() {
   const [sharingStates, setSharingStates] = useState({});
   const [socialCreations, setSocialCreations] = useState([]);
   const [isLoadingSocial, setIsLoadingSocial] = useState(false);
+  const [socialCursor, setSocialCursor] = useState(null);
 
   const { gainExp, checkAndSetDailyLogin, todayCompletedCount, weekCompletedCount, level, exp, expForNextLevel } = useUser();
   const { missions, completeMission, isMissionCompleted } = useMissions();
@@ -158,8 +159,9 @@ function Base() {
       const fetchSocialCreations = async () => {
         setIsLoadingSocial(true);
         try {
-          const posts = await api.getSharedPosts();
-          setSocialCreations(posts.reverse());
+          const page = await api.getSharedPosts();
+          setSocialCreations(page.items);
+          setSocialCursor(page.next_cursor);
         } catch (error) {
           console.error("Failed to fetch social creations:", error);
         } finally {
@@ -170,6 +172,20 @@ function Base() {
     }
   }, [activeMenu]);
 
+  const loadMoreSocialCreations = async () => {
+    if (!socialCursor || isLoadingSocial) return;
+    setIsLoadingSocial(true);
+    try {
+      const page = await api.getSharedPosts(socialCursor);
+      setSocialCreations(prev => [...prev, ...page.items]);
+      setSocialCursor(page.next_cursor);
+    } catch (error) {
+      console.error("Failed to fetch more social creations:", error);
+    } finally {
+      setIsLoadingSocial(false);
+    }
+  };
+
   // --- Share Logic ---
   const handleShare = async (creation) => {
     if (sharingStates[creation.id]) return;
@@ -324,14 +340,18 @@ function Base() {
         return (
           <div className="gallery-content">
             <h2 className="welcome-title">소셜 갤러리</h2>
-            {isLoadingSocial ? (
+            {isLoadingSocial && socialCreations.length === 0 ? (
               <div className="empty-gallery">불러오는 중...</div>
             ) : (
               <div className="creations-grid">
                 {socialCreations.length > 0 ? socialCreations.map(post => (
                   <div key={post.id} className="creation-card">
                     <img
-                      src={post.image_url.startsWith('http') ? post.image_url : `${BACKEND_URL}${post.image_url}`}
+                      src={post.thumb_url ? `${BACKEND_URL}${post.thumb_url}` : (post.image_url.startsWith('http') ? post.image_url : `${BACKEND_URL}${post.image_url}`)}
+                      srcSet={post.srcset ? post.srcset.split(', ').map(entry => `${BACKEND_URL}${entry}`).join(', ') : undefined}
+                      sizes="(max-width: 600px) 50vw, 280px"
+                      loading="lazy"
+                      decoding="async"
                       className="creation-image"
                       alt="shared art"
                     />
@@ -342,6 +362,11 @@ function Base() {
                 )) : (
                   <div className="empty-gallery">아직 공유된 작품이 없습니다.</div>
                 )}
+                {socialCursor && (
+                  <button className="btn-load-more" onClick={loadMoreSocialCreations} disabled={isLoadingSocial}>
+                    {isLoadingSocial ? '불러오는 중...' : '더 보기'}
+                  </button>
+                )}
               </div>
             )}
           </div>
@@ -18,6 +18,8 @@ function Chat() {
   const [isModalOpen, setIsModalOpen] = useState(false); // 모달 상태 추가
   const messagesEndRef = useRef(null);
   const textareaRef = useRef(null);
+  // 서버가 대화 기록을 들고 있는 대화의 ID입니다. 첫 답을 받으면 채워지고, 이후에는 새 메시지만 보냅니다.
+  const conversationIdRef = useRef(null);
 
   const examplePrompts = ['프로그래밍을 배우고 싶어요', '오늘 저녁 메뉴 추천해줘', '재미있는 이야기 들려줘', '영어 공부 방법 알려줘'];
   const userMessageCount = messages.filter(msg => msg.type === 'user').length;
@@ -65,12 +67,21 @@ function Chat() {
     
     try {
       const messagesForAPI = updatedMessages.filter(msg => msg.id !== 1).map(msg => ({ role: msg.type === 'ai' ? 'assistant' : 'user', content: msg.content }));
-      const data = await api.chatWithAI(messagesForAPI);
-      const newAiMessage = { id: Date.now() + 1, type: 'ai', content: data.reply, timestamp: new Date() };
-      setMessages(prev => [...prev, newAiMessage]);
+      // 첫 토큰이 도착하면 AI 말풍선을 만들고, 이후 토큰은 같은 말풍선에 이어 붙입니다.
+      const aiMessageId = Date.now() + 1;
+      let started = false;
+      const { conversationId } = await api.chatWithAIStream(messagesForAPI, (delta) => {
+        if (!started) {
+          started = true;
+          setMessages(prev => [...prev, { id: aiMessageId, type: 'ai', content: delta, timestamp: new Date() }]);
+          return;
+        }
+        setMessages(prev => prev.map(msg => msg.id === aiMessageId ? { ...msg, content: msg.content + delta } : msg));
+      }, conversationIdRef.current);
+      conversationIdRef.current = conversationId;
     } catch (error) {
       console.error("Failed to get AI response:", error);
-      const errorMessage = { id: Date.now() + 1, type: 'ai', content: '죄송합니다, AI와 연결하는 데 문제가 발생했어요. 😥', timestamp: new Date() };
+      const errorMessage = { id: Date.now() + 2, type: 'ai', content: '죄송합니다, AI와 연결하는 데 문제가 발생했어요. 😥', timestamp: new Date() };
       setMessages(prev => [...prev, errorMessage]);
     } finally {
       setIsTyping(false);
@@ -120,7 +131,7 @@ function Chat() {
         <div className="messages-container">
           <div className="messages-wrapper">
             {messages.map((message) => (<div key={message.id} className={`message ${message.type === 'user' ? 'message-user' : 'message-ai'}`}><div className="message-avatar">{message.type === 'user' ? '👤' : '🤖'}</div><div className="message-content"><div className="message-bubble">{message.content}</div><span className="message-time">{formatTime(message.timestamp)}</span></div></div>))}
-            {isTyping && (<div className="message message-ai"><div className="message-avatar">🤖</div><div className="message-content"><div className="message-bubble typing-indicator"><span></span><span></span><span></span></div></div></div>)}
+            {isTyping && messages[messages.length - 1]?.type !== 'ai' && (<div className="message message-ai"><div className="message-avatar">🤖</div><div className="message-content"><div className="message-bubble typing-indicator"><span></span><span></span><span></span></div></div></div>)}
             <div ref={messagesEndRef} />
           </div>
           {messages.length === 1 && (
@@ -1,3 +1,5 @@
+import { v4 as uuidv4 } from 'uuid';
+
 // Vite 환경 변수에서 백엔드 API의 전체 URL을 가져옵니다.
 // 예: https://promp-e.onrender.com/api
 const API_FULL_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000/api';
@@ -9,21 +11,124 @@ const SERVER_URL = API_FULL_URL.replace('/api', '');
 // 다른 파일에서 이미지 경로를 만들 때 사용할 수 있도록 서버 주소를 export 합니다.
 export const BACKEND_URL = SERVER_URL;
 
+// 서버가 저장해 둔 생성 이미지는 /uploads/... 상대 경로로 오므로, 화면에서 바로 쓸 수 있게 서버 주소를 붙입니다.
+const withServerUrl = (data) => (
+  data && typeof data.image_url === 'string' && data.image_url.startsWith('/')
+    ? { ...data, image_url: `${SERVER_URL}${data.image_url}` }
+    : data
+);
+
+// 브라우저 탭마다 고유한 세션 ID입니다. 서버는 이 값으로 같은 아이에게 같은 퀴즈를 다시 주지 않고,
+// 이미지 생성 작업도 아이별로 돌아가며 처리합니다.
+const getSessionId = () => {
+  let sessionId = sessionStorage.getItem('prompeSessionId');
+  if (!sessionId) {
+    sessionId = uuidv4();
+    sessionStorage.setItem('prompeSessionId', sessionId);
+  }
+  return sessionId;
+};
+
+// 채팅 요청을 보냅니다. 대화 ID가 있으면 새 메시지만 보내고, 서버가 대화를 잃어버렸으면(404) 전체 기록으로 다시 보냅니다.
+const sendChat = async (path, messages, conversationId) => {
+  const post = (body) => fetch(`${API_FULL_URL}${path}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    body: JSON.stringify(body),
+  });
+  const message = messages[messages.length - 1].content;
+  if (!conversationId) return post({ message });
+  const response = await post({ conversation_id: conversationId, message });
+  return response.status === 404 ? post({ conversation_id: conversationId, messages }) : response;
+};
+
+// 비전 API에 보낼 그림의 최대 변 길이(px). 서버도 같은 크기로 다시 줄이지만, 미리 줄이면 업로드 크기가 크게 줄어듭니다.
+const VISION_MAX_SIDE = 1024;
+
+/**
+ * 캔버스 data URL을 VISION_MAX_SIDE 이하로 줄이고 흰 배경의 JPEG로 다시 인코딩합니다.
+ * @param {string} dataUrl - 원본 이미지 data URL
+ * @returns {Promise<string>} 줄어든 data URL (data URL이 아니면 그대로 반환)
+ */
+const downscaleDataUrl = (dataUrl, maxSide = VISION_MAX_SIDE) => new Promise((resolve) => {
+  if (!dataUrl || !dataUrl.startsWith('data:image/')) {
+    resolve(dataUrl);
+    return;
+  }
+  const image = new Image();
+  image.onload = () => {
+    const scale = Math.min(1, maxSide / Math.max(image.width, image.height));
+    const canvas = document.createElement('canvas');
+    canvas.width = Math.round(image.width * scale);
+    canvas.height = Math.round(image.height * scale);
+    const ctx = canvas.getContext('2d');
+    ctx.fillStyle = '#ffffff';
+    ctx.fillRect(0, 0, canvas.width, canvas.height);
+    ctx.drawImage(image, 0, 0, canvas.width, canvas.height);
+    resolve(canvas.toDataURL('image/jpeg', 0.85));
+  };
+  image.onerror = () => resolve(dataUrl);
+  image.src = dataUrl;
+});
+
+// 같은 캔버스 그림을 Stage3 단계마다 다시 보내지 않도록, 그림은 /drawings/ 에 바이너리로 한 번만 올리고 핸들만 보냅니다.
+// data URL → 업로드 Promise(핸들). 최근 그림 몇 장만 기억합니다.
+const MAX_DRAWING_HANDLES = 8;
+const drawingHandles = new Map();
+
+const isDataUrl = (value) => typeof value === 'string' && value.startsWith('data:image/');
+
+const uploadDrawing = (dataUrl) => {
+  if (!drawingHandles.has(dataUrl)) {
+    const upload = (async () => {
+      const form = new FormData();
+      form.append('file', await (await fetch(dataUrl)).blob(), 'drawing');
+      const response = await fetch(`${API_FULL_URL}/drawings/`, { method: 'POST', body: form });
+      if (!response.ok) throw new Error(`Upload error: ${response.statusText}`);
+      return (await response.json()).handle;
+    })();
+    upload.catch(() => drawingHandles.delete(dataUrl));
+    drawingHandles.set(dataUrl, upload);
+    if (drawingHandles.size > MAX_DRAWING_HANDLES) drawingHandles.delete(drawingHandles.keys().next().value);
+  }
+  return drawingHandles.get(dataUrl);
+};
+
+/**
+ * 그림(data URL)을 핸들로 바꿔 요청을 보냅니다.
+ * 올리기에 실패했거나 핸들이 만료되어 404가 오면 data URL 그대로 한 번 더 보냅니다.
+ * @param {Array<string|null>} images - 요청에 들어갈 그림들 (data URL이 아닌 값은 그대로 둡니다)
+ * @param {function(Array<string|null>): Promise<Response>} send - 그림 값들을 받아 요청을 보내는 함수
+ */
+const sendWithDrawings = async (images, send) => {
+  let handles;
+  try {
+    handles = await Promise.all(images.map(image => (isDataUrl(image) ? uploadDrawing(image) : image)));
+  } catch (error) {
+    console.warn("Drawing upload failed, sending inline:", error);
+    return send(images);
+  }
+  const response = await send(handles);
+  if (response.status !== 404 || handles.every((handle, index) => handle === images[index])) return response;
+  images.forEach(image => drawingHandles.delete(image));
+  return send(images);
+};
+
 /**
  * 모든 API 요청을 관리하는 객체
  */
 export const api = {
   /**
    * ChatGPT와 대화하는 API
-   * @param {Array<object>} messages - 전체 대화 기록 배열
+   * 서버가 대화 기록을 들고 있으므로 conversationId 가 있으면 새 메시지만 보냅니다.
+   * 서버가 대화를 잃어버렸으면(404) 전체 기록으로 한 번 더 보내 서버 기록을 다시 채웁니다.
+   * @param {Array<object>} messages - 전체 대화 기록 배열 (마지막이 새 사용자 메시지)
+   * @param {string|null} conversationId - 이전 답에서 받은 대화 ID (첫 메시지면 null)
+   * @returns {Promise<{reply: string, conversation_id: string}>}
    */
-  async chatWithAI(messages) {
+  async chatWithAI(messages, conversationId = null) {
     try {
-      const response = await fetch(`${API_FULL_URL}/chat/`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ messages: messages }),
-      });
+      const response = await sendChat('/chat/', messages, conversationId);
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
       return response.json();
     } catch (error) {
@@ -32,6 +137,47 @@ export const api = {
     }
   },
 
+  /**
+   * ChatGPT 답변을 토큰 단위로 스트리밍 받는 API (Server-Sent Events)
+   * @param {Array<object>} messages - 전체 대화 기록 배열 (마지막이 새 사용자 메시지)
+   * @param {function(string): void} onDelta - 새 토큰 조각이 도착할 때마다 호출됩니다
+   * @param {string|null} conversationId - 이전 답에서 받은 대화 ID (첫 메시지면 null)
+   * @returns {Promise<{reply: string, conversationId: string|null}>} 완성된 전체 답변과 다음 턴에 보낼 대화 ID
+   */
+  async chatWithAIStream(messages, onDelta, conversationId = null) {
+    try {
+      const response = await sendChat('/chat/stream/', messages, conversationId);
+      if (!response.ok || !response.body) throw new Error(`Server error: ${response.statusText}`);
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let reply = '';
+      for (;;) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        for (const rawEvent of events) {
+          const lines = rawEvent.split('\n');
+          const eventType = (lines.find(line => line.startsWith('event: ')) || 'event: message').slice(7);
+          const dataLine = lines.find(line => line.startsWith('data: '));
+          const data = dataLine ? JSON.parse(dataLine.slice(6)) : {};
+          if (eventType === 'error') throw new Error(data.detail || 'Stream error');
+          if (eventType === 'done') return { reply, conversationId: data.conversation_id || null };
+          if (data.delta) {
+            reply += data.delta;
+            onDelta(data.delta);
+          }
+        }
+      }
+      return { reply, conversationId: null };
+    } catch (error) {
+      console.error("API Error (chatWithAIStream):", error);
+      throw error;
+    }
+  },
+
   /**
    * 프롬프트와 이미지 URL을 공유(게시)하는 API
    * @param {string} prompt - 사용자가 작성한 프롬프트
@@ -53,11 +199,14 @@ export const api = {
   },
 
   /**
-   * 모든 공유된 게시글 목록을 가져오는 API
+   * 공유된 게시글을 최신순으로 한 페이지씩 가져오는 API
+   * @param {string | null} cursor - 이전 응답의 next_cursor (첫 페이지는 null)
+   * @returns {Promise<{items: Array<object>, next_cursor: string | null}>}
    */
-  async getSharedPosts() {
+  async getSharedPosts(cursor = null) {
     try {
-      const response = await fetch(`${API_FULL_URL}/posts/`);
+      const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+      const response = await fetch(`${API_FULL_URL}/posts/feed/${query}`);
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
       return response.json();
     } catch (error) {
@@ -92,11 +241,11 @@ export const api = {
    */
   async suggestAdjectives(objectName, imageData) {
     try {
-      const response = await fetch(`${API_FULL_URL}/suggest-adjectives/`, {
+      const response = await sendWithDrawings([imageData], async ([image]) => fetch(`${API_FULL_URL}/suggest-adjectives/`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ object_name: objectName, image_data: imageData }),
-      });
+        body: JSON.stringify({ object_name: objectName, image_data: await downscaleDataUrl(image) }),
+      }));
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
       return response.json();
     } catch (error) {
@@ -112,11 +261,11 @@ export const api = {
    */
   async suggestMoodStyle(prompt, imageData) {
     try {
-      const response = await fetch(`${API_FULL_URL}/suggest-mood-style/`, {
+      const response = await sendWithDrawings([imageData], async ([image]) => fetch(`${API_FULL_URL}/suggest-mood-style/`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ prompt: prompt, image_data: imageData }),
-      });
+        body: JSON.stringify({ prompt: prompt, image_data: await downscaleDataUrl(image) }),
+      }));
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
       return response.json();
     } catch (error) {
@@ -134,11 +283,11 @@ export const api = {
     try {
       const response = await fetch(`${API_FULL_URL}/generate-merch-mockup/`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'X-Session-Id': getSessionId() },
         body: JSON.stringify({ design_url: designUrl, product }),
       });
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
-      return response.json();
+      return withServerUrl(await response.json());
     } catch (error) {
       console.error("API Error (generateMerchMockup):", error);
       throw error;
@@ -152,17 +301,13 @@ export const api = {
    */
   async generateImage(prompt, userImage = null) {
     try {
-      const payload = {
-        prompt: prompt,
-        user_image: userImage || "none"
-      };
-      const response = await fetch(`${API_FULL_URL}/generate-image/`, {
+      const response = await sendWithDrawings([userImage], ([image]) => fetch(`${API_FULL_URL}/generate-image/`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload),
-      });
+        headers: { 'Content-Type': 'application/json', 'X-Session-Id': getSessionId() },
+        body: JSON.stringify({ prompt: prompt, user_image: image || "none" }),
+      }));
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
-      return response.json();
+      return withServerUrl(await response.json());
     } catch (error) {
       console.error("API Error (generateImage):", error);
       throw error;
@@ -195,7 +340,7 @@ export const api = {
     try {
       const response = await fetch(`${API_FULL_URL}/emoji-quiz/`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'X-Session-Id': getSessionId() },
         body: JSON.stringify({ topic }),
       });
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
@@ -213,7 +358,7 @@ export const api = {
     try {
       const response = await fetch(`${API_FULL_URL}/prompt-puzzle/`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'X-Session-Id': getSessionId() },
         body: JSON.stringify({ level_count: levelCount }),
       });
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
@@ -234,11 +379,11 @@ export const api = {
     try {
       const response = await fetch(`${API_FULL_URL}/prompt-puzzle-image/`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: { 'Content-Type': 'application/json', 'X-Session-Id': getSessionId() },
         body: JSON.stringify({ prompt_kr: promptKr, subject, action, location }),
       });
       if (!response.ok) throw new Error(`Server error: ${response.statusText}`);
-      return response.json();
+      return withServerUrl(await response.json());
     } catch (error) {
       console.error("API Error (generatePromptPuzzleImage):", error);
       throw error;
@@ -271,10 +416,16 @@ export const api = {
    */
   async composePrompt(layers) {
     try {
-      const response = await fetch(`${API_FULL_URL}/compose-prompt/`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ layers: layers }),
+      const images = layers.map(layer => (layer.type === 'image' ? layer.data : null));
+      const response = await sendWithDrawings(images, async (sentImages) => {
+        const sentLayers = await Promise.all(layers.map(async (layer, index) => (
+          layer.type === 'image' ? { ...layer, data: await downscaleDataUrl(sentImages[index]) } : layer
+        )));
+        return fetch(`${API_FULL_URL}/compose-prompt/`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ layers: sentLayers }),
+        });
       });
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({ detail: response.statusText }));